@@ -0,0 +1,247 @@
+"""
+Benchmark of the /process_ocr hot path.
+
+Drives the FastAPI APP in-process with generated documents (page counts x DPI) at the given
+concurrency levels and reports pages/sec, latency percentiles, peak RSS (web server + workers)
+and the time spent in each stage of a request. Results are written as JSON, so that
+the numbers of different releases can be compared.
+
+Usage (from the repository root):
+    python -m benchmark.run --pages 1,10 --dpi 150,300 --concurrency 1,4 --requests 8 --output benchmark.json
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+import base64
+import io
+import itertools
+import json
+import os
+import platform
+import re
+import statistics
+import sys
+import threading
+import time
+import timeit
+
+from dotenv import load_dotenv
+from fastapi.testclient import TestClient
+import img2pdf
+import ocrmypdf
+from PIL import Image, ImageDraw, ImageFont
+
+# Same environment as the tests (AppAPI secret etc.), see ".env"
+load_dotenv(override=True)
+
+from workflow_ocr_backend import metrics, parameters as ocr_parameters  # noqa: E402
+from workflow_ocr_backend.app import APP, SETTINGS, logger  # noqa: E402
+from workflow_ocr_backend.ocrservice import OcrService  # noqa: E402
+
+_STAGE_SAMPLE = re.compile(r'^ocr_stage_duration_seconds_(sum|count)\{stage="(\w+)"\} (\S+)$', re.MULTILINE)
+_TEXT = "The quick brown fox jumps over the lazy dog. Pack my box with five dozen liquor jugs."
+
+
+@dataclass
+class Scenario:
+    pages: int
+    dpi: int
+    concurrency: int
+
+
+@dataclass
+class ScenarioResult:
+    pages: int
+    dpi: int
+    concurrency: int
+    input_bytes: int
+    requests: int
+    errors: int
+    duration_seconds: float
+    pages_per_second: float
+    latency_p50_seconds: float
+    latency_p95_seconds: float
+    latency_p99_seconds: float
+    peak_rss_bytes: int | None
+    # Mean time per request spent in each stage (see ocr_stage_duration_seconds)
+    stage_seconds: dict[str, float]
+
+
+def generate_document(pages: int, dpi: int) -> bytes:
+    """
+    Generates a PDF of A4 pages with rendered text, i.e. without a text layer.
+    """
+    width, height = round(8.27 * dpi), round(11.69 * dpi)
+    font = ImageFont.load_default(size=max(8, dpi // 6))
+    images = []
+    for page in range(pages):
+        image = Image.new("L", (width, height), 255)
+        draw = ImageDraw.Draw(image)
+        y = dpi
+        for line in range(30):
+            draw.text((dpi, y), f"Page {page + 1}, line {line + 1}: {_TEXT}", fill=0, font=font)
+            y += dpi // 3
+        buffer = io.BytesIO()
+        image.save(buffer, format="PNG", dpi=(dpi, dpi))
+        images.append(buffer.getvalue())
+    return img2pdf.convert(images)
+
+
+def percentile(values: list[float], percent: int) -> float:
+    if len(values) < 2:
+        return values[0] if values else 0.0
+    return statistics.quantiles(values, n=100, method="inclusive")[percent - 1]
+
+
+def stage_totals(client: TestClient, headers: dict[str, str]) -> dict[str, tuple[float, float]]:
+    """
+    Returns (sum, count) of each stage histogram, as exposed by /metrics.
+    """
+    totals: dict[str, list[float]] = {}
+    for kind, stage, value in _STAGE_SAMPLE.findall(client.get("/metrics", headers=headers).text):
+        totals.setdefault(stage, [0.0, 0.0])[0 if kind == "sum" else 1] = float(value)
+    return {stage: (total, count) for stage, (total, count) in totals.items()}
+
+
+class RssSampler:
+    """
+    Samples the resident memory of the web server and all OCR worker processes in the background.
+    """
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.peak: int | None = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self) -> "RssSampler":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *_):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            pids = ["self"] + APP.state.scheduler.worker_pids
+            sizes = [size for pid in pids if (size := metrics.resident_memory(pid)) is not None]
+            if sizes:
+                self.peak = max(self.peak or 0, sum(sizes))
+
+
+def run_scenario(client: TestClient, headers: dict[str, str], scenario: Scenario, document: bytes, requests: int, parameters: str, multipart: bool) -> ScenarioResult:
+    request_headers = {**headers, "Accept": "multipart/mixed"} if multipart else headers
+
+    def send(_) -> tuple[float, bool]:
+        started_at = time.perf_counter()
+        response = client.post(
+            "/process_ocr",
+            files={"file": ("benchmark.pdf", document, "application/pdf")},
+            data={"ocrmypdf_parameters": parameters},
+            headers=request_headers)
+        return time.perf_counter() - started_at, response.status_code == 200
+
+    # Warm up the workers, so that the process start is not measured
+    send(None)
+    stages_before = stage_totals(client, headers)
+    with RssSampler() as sampler, ThreadPoolExecutor(max_workers=scenario.concurrency) as executor:
+        started_at = time.perf_counter()
+        results = list(executor.map(send, range(requests)))
+        duration = time.perf_counter() - started_at
+    stages_after = stage_totals(client, headers)
+
+    latencies = [latency for latency, _ in results]
+    succeeded = sum(1 for _, ok in results if ok)
+    stage_seconds = {}
+    for stage, (total, count) in stages_after.items():
+        total_before, count_before = stages_before.get(stage, (0.0, 0.0))
+        if count > count_before:
+            stage_seconds[stage] = (total - total_before) / (count - count_before)
+    return ScenarioResult(
+        pages=scenario.pages, dpi=scenario.dpi, concurrency=scenario.concurrency, input_bytes=len(document),
+        requests=requests, errors=requests - succeeded, duration_seconds=duration,
+        pages_per_second=succeeded * scenario.pages / duration,
+        latency_p50_seconds=percentile(latencies, 50), latency_p95_seconds=percentile(latencies, 95),
+        latency_p99_seconds=percentile(latencies, 99), peak_rss_bytes=sampler.peak, stage_seconds=stage_seconds)
+
+
+def parameter_parsing_seconds(parameters: str, repeat: int = 100) -> dict[str, float]:
+    """
+    Returns the time to get the parameters of a request: "cold" parses them (e.g. the first request with these parameters),
+    "warm" looks them up in the cache of parsed parameters.
+    """
+    service = OcrService(logger)
+
+    def parse():
+        ocr_parameters._parse.cache_clear()
+        service.requested_languages(parameters)
+
+    cold = timeit.timeit(parse, number=repeat) / repeat
+    warm = timeit.timeit(lambda: service.requested_languages(parameters), number=repeat * 100) / (repeat * 100)
+    return {"cold": cold, "warm": warm}
+
+
+def environment() -> dict:
+    service = OcrService(logger)
+    try:
+        tesseract_version = service.tesseract_version()
+    except FileNotFoundError:
+        tesseract_version = None
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "ocrmypdf_version": ocrmypdf.__version__,
+        "tesseract_version": tesseract_version,
+        "settings": SETTINGS.model_dump(),
+    }
+
+
+def _int_list(value: str) -> list[int]:
+    return [int(item) for item in value.split(",") if item]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the /process_ocr endpoint")
+    parser.add_argument("--pages", type=_int_list, default=[1, 10], help="Comma separated page counts of the generated documents")
+    parser.add_argument("--dpi", type=_int_list, default=[150, 300], help="Comma separated resolutions of the generated documents")
+    parser.add_argument("--concurrency", type=_int_list, default=[1, 4], help="Comma separated numbers of concurrent requests")
+    parser.add_argument("--requests", type=int, default=8, help="Number of measured requests per scenario")
+    parser.add_argument("--parameters", default="--language eng", help="OCRmyPDF parameters sent with every request")
+    parser.add_argument("--multipart", action="store_true", help="Request multipart/mixed instead of JSON responses")
+    parser.add_argument("--output", help="File to write the JSON results to (default: stdout)")
+    args = parser.parse_args()
+
+    headers = {
+        "AA-VERSION": os.getenv("AA_VERSION"),
+        "EX-APP-ID": os.getenv("APP_ID"),
+        "EX-APP-VERSION": os.getenv("APP_VERSION"),
+        "AUTHORIZATION-APP-API": base64.b64encode(("benchmark:" + os.getenv("APP_SECRET")).encode()).decode(),
+    }
+    documents = {(pages, dpi): generate_document(pages, dpi) for pages, dpi in itertools.product(args.pages, args.dpi)}
+    results = []
+    with TestClient(APP, raise_server_exceptions=False) as client:
+        for pages, dpi, concurrency in itertools.product(args.pages, args.dpi, args.concurrency):
+            scenario = Scenario(pages, dpi, concurrency)
+            result = run_scenario(client, headers, scenario, documents[(pages, dpi)], args.requests, args.parameters, args.multipart)
+            print(f"{pages} pages @ {dpi} dpi, concurrency {concurrency}: {result.pages_per_second:.2f} pages/s, "
+                  f"p95 {result.latency_p95_seconds:.2f}s, {result.errors} errors", file=sys.stderr)
+            results.append(asdict(result))
+
+    report = json.dumps({
+        "environment": environment(),
+        "parameters": args.parameters,
+        "multipart": args.multipart,
+        "parameter_parsing_seconds": parameter_parsing_seconds(args.parameters),
+        "scenarios": results,
+    }, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(report)
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+import asyncio
+import logging
+import os
+
+import pytest
+
+from workflow_ocr_backend.admission import AdmissionControl, MemoryBudget, estimate_memory
+from workflow_ocr_backend.exceptions import DocumentTooLargeError
+from workflow_ocr_backend.ocrservice import DocumentInfo
+from workflow_ocr_backend.settings import Settings
+
+logger = logging.getLogger(__name__)
+testdata_dir = os.path.join(os.path.dirname(__file__), "testdata")
+
+
+def _read(file_name: str) -> bytes:
+    with open(os.path.join(testdata_dir, file_name), "rb") as file:
+        return file.read()
+
+def test_estimate_memory_grows_with_page_size_and_jobs():
+    small = DocumentInfo(pages=10, max_page_pixels=1_000_000, total_pixels=10_000_000)
+    large = DocumentInfo(pages=10, max_page_pixels=8_000_000, total_pixels=80_000_000)
+    assert estimate_memory(small, 0, 1) < estimate_memory(large, 0, 1)
+    assert estimate_memory(large, 0, 1) < estimate_memory(large, 0, 4)
+    # No more pages are processed at the same time than the document has
+    single_page = DocumentInfo(pages=1, max_page_pixels=8_000_000, total_pixels=8_000_000)
+    assert estimate_memory(single_page, 0, 4) == estimate_memory(single_page, 0, 1)
+    assert estimate_memory(None, 1000, 4) < estimate_memory(single_page, 1000, 4)
+
+def test_admit_disabled():
+    admission = AdmissionControl(Settings(), logger)
+    assert asyncio.run(admission.admit(_read("document-ready-for-ocr.pdf"), "document.pdf")) is None
+
+def test_admit_estimates_cost(tmp_path):
+    admission = AdmissionControl(Settings(ocr_memory_budget=8 * 1024 ** 3, ocr_jobs_per_worker=1), logger)
+    cost = asyncio.run(admission.admit(_read("document-ready-for-ocr.pdf"), "document.pdf"))
+    assert cost.pages == 1
+    assert cost.megapixels > 1
+    # Spooled files are inspected by path
+    spooled = tmp_path / "document.pdf"
+    spooled.write_bytes(_read("document-ready-for-ocr.pdf"))
+    assert asyncio.run(admission.admit(str(spooled), "document.pdf")) == cost
+    # Files which are neither a PDF nor an image are left to OCRmyPDF
+    assert asyncio.run(admission.admit(_read("document-invalid.pdf"), "document.pdf")).pages == 0
+
+def test_admit_rejects_too_many_megapixels():
+    admission = AdmissionControl(Settings(ocr_max_megapixels=1), logger)
+    assert asyncio.run(admission.admit(_read("document-image.jpg"), "image.jpg")) is not None
+    with pytest.raises(DocumentTooLargeError) as exc_info:
+        asyncio.run(admission.admit(_read("document-ready-for-ocr.pdf"), "document.pdf"))
+    assert exc_info.value.status_code == 413
+
+def test_admit_rejects_documents_exceeding_the_budget():
+    admission = AdmissionControl(Settings(ocr_memory_budget=1024 * 1024), logger)
+    with pytest.raises(DocumentTooLargeError):
+        asyncio.run(admission.admit(_read("document-image.jpg"), "image.jpg"))
+
+def test_memory_budget_fifo():
+    async def run():
+        budget = MemoryBudget(100)
+        await budget.acquire(60)
+        large = asyncio.ensure_future(budget.acquire(80))
+        await asyncio.sleep(0)
+        # Would fit, but has to wait behind the large one
+        small = asyncio.ensure_future(budget.acquire(10))
+        await asyncio.sleep(0)
+        assert not large.done() and not small.done()
+        budget.release(60)
+        await large
+        await small
+        assert budget.reserved == 90
+    asyncio.run(run())
+
+def test_memory_budget_without_estimate():
+    async def run():
+        budget = MemoryBudget(100)
+        await budget.acquire(60)
+        large = asyncio.ensure_future(budget.acquire(80))
+        await asyncio.sleep(0)
+        await asyncio.wait_for(budget.acquire(0), 1)
+        assert not large.done() and budget.reserved == 60
+        large.cancel()
+    asyncio.run(run())
+
+def test_memory_budget_cancelled_waiter():
+    async def run():
+        budget = MemoryBudget(100)
+        await budget.acquire(60)
+        large = asyncio.ensure_future(budget.acquire(80))
+        await asyncio.sleep(0)
+        small = asyncio.ensure_future(budget.acquire(10))
+        await asyncio.sleep(0)
+        large.cancel()
+        await asyncio.wait_for(small, 1)
+        assert budget.reserved == 70
+    asyncio.run(run())
+
+def test_memory_budget_clamps_to_limit():
+    async def run():
+        budget = MemoryBudget(100)
+        await asyncio.wait_for(budget.acquire(500), 1)
+        assert budget.reserved == 100
+        budget.release(500)
+        assert budget.reserved == 0
+    asyncio.run(run())
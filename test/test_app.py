@@ -1,7 +1,17 @@
+import asyncio
 import base64
+import email
+import json
 import os
+import time
 from fastapi.testclient import TestClient
-from workflow_ocr_backend.app import APP
+import pytest
+from workflow_ocr_backend import app as app_module
+from workflow_ocr_backend.app import APP, SETTINGS, _with_deadline, logger
+from workflow_ocr_backend.exceptions import DeadlineExceededError
+from workflow_ocr_backend.model.ocrresult import OcrResult
+from workflow_ocr_backend.ocrplugin import ProgressEvent
+from workflow_ocr_backend.ocrservice import OcrOutput, OcrService
 from dotenv import load_dotenv
 
 # Define environemnt variables in ".env" file
@@ -47,20 +57,20 @@ def test_process_ocr_image():
     assert "recognizedText" in response_json
     assert response_json["recognizedText"] == ocr_content
 
-def test_process_ocr_error_already_processed_file():
+def test_process_ocr_already_processed_file():
     current_dir = os.path.dirname(__file__)
     file_name = "document-already-processed.pdf"
-    with open(f"{current_dir}/testdata/{file_name}", "rb") as file, TestClient(APP, headers=headers, raise_server_exceptions=False) as client:
+    with open(f"{current_dir}/testdata/{file_name}", "rb") as file, TestClient(APP, headers=headers) as client:
+        content = file.read()
         response = client.post(
             "/process_ocr",
-            files={"file": (file_name, file, "application/pdf")}
+            files={"file": (file_name, content, "application/pdf")}
         )
-    assert response.status_code == 500
+    # Documents which already have a text layer aren't passed to Tesseract, but still converted by OCRmyPDF
+    assert response.status_code == 200
     response_json = response.json()
-    assert "message" in response_json
-    assert response_json["message"] == "page already has text! - aborting (use --force-ocr to force OCR;  see also help for the arguments --skip-text and --redo-ocr (PriorOcrFoundError)"
-    assert "ocrMyPdfExitCode" in response_json
-    assert response_json["ocrMyPdfExitCode"] == 6
+    assert response_json["recognizedText"] == "This document has already been\n\nprocessed via OCR\n\n"
+    assert base64.b64decode(response_json["fileContent"]).startswith(b"%PDF")
 
 def test_process_ocr_error_invalid_file():
     current_dir = os.path.dirname(__file__)
@@ -91,4 +101,357 @@ def test_enabled_handler():
     assert response.status_code == 200
     response_json = response.json()
     assert "error" in response_json
-    assert response_json["error"] == ""
\ No newline at end of file
+    assert response_json["error"] == ""
+
+def test_process_ocr_job():
+    current_dir = os.path.dirname(__file__)
+    file_name = "document-ready-for-ocr.pdf"
+    with open(f"{current_dir}/testdata/{file_name}", "rb") as file, TestClient(APP, headers=headers) as client:
+        response = client.post(
+            "/jobs",
+            files={"file": (file_name, file, "application/pdf")},
+            data={"ocrmypdf_parameters": "--skip-text --tesseract-pagesegmode 7 --language eng"}
+        )
+        assert response.status_code == 202
+        job_id = response.json()["jobId"]
+        for _ in range(600):
+            status = client.get(f"/jobs/{job_id}").json()
+            if status["state"] in ("succeeded", "failed"):
+                break
+            time.sleep(0.1)
+        assert status["state"] == "succeeded"
+        assert status["pagesDone"] == status["pagesTotal"] == 1
+        response = client.get(f"/jobs/{job_id}/result")
+    assert response.status_code == 200
+    assert response.json()["recognizedText"] == "This document is ready for OCR\n"
+
+def test_process_ocr_durable_job(monkeypatch, tmp_path):
+    monkeypatch.setattr(SETTINGS, "ocr_job_queue_dir", str(tmp_path / "queue"))
+    current_dir = os.path.dirname(__file__)
+    file_name = "document-ready-for-ocr.pdf"
+    data = {"ocrmypdf_parameters": "--skip-text --tesseract-pagesegmode 7 --language eng", "job_id": "document-1"}
+    with TestClient(APP, headers=headers) as client:
+        with open(f"{current_dir}/testdata/{file_name}", "rb") as file:
+            response = client.post("/jobs", files={"file": (file_name, file, "application/pdf")}, data=data)
+        assert response.status_code == 202
+        assert response.json()["jobId"] == "document-1"
+        # Retries return the existing job
+        with open(f"{current_dir}/testdata/{file_name}", "rb") as file:
+            retry = client.post("/jobs", files={"file": (file_name, file, "application/pdf")}, data=data)
+        assert retry.json()["createdAt"] == response.json()["createdAt"]
+        for _ in range(600):
+            status = client.get("/jobs/document-1").json()
+            if status["state"] in ("succeeded", "failed"):
+                break
+            time.sleep(0.1)
+        assert status["state"] == "succeeded"
+    # Jobs survive restarts
+    with TestClient(APP, headers=headers) as client:
+        response = client.get("/jobs/document-1/result")
+    assert response.status_code == 200
+    assert response.json()["recognizedText"] == "This document is ready for OCR\n"
+
+def test_job_not_found():
+    with TestClient(APP, headers=headers) as client:
+        response = client.get("/jobs/unknown")
+    assert response.status_code == 404
+    assert response.json()["message"] == "Job unknown does not exist (or its result already expired)"
+
+def test_process_ocr_multipart():
+    current_dir = os.path.dirname(__file__)
+    file_name = "document-ready-for-ocr.pdf"
+    with open(f"{current_dir}/testdata/{file_name}", "rb") as file, TestClient(APP, headers=headers) as client:
+        response = client.post(
+            "/process_ocr",
+            files={"file": (file_name, file, "application/pdf")},
+            data={"ocrmypdf_parameters": "--skip-text --tesseract-pagesegmode 7 --language eng"},
+            headers={"Accept": "multipart/mixed"}
+        )
+    assert response.status_code == 200
+    message = email.message_from_bytes(f"Content-Type: {response.headers['content-type']}\r\n\r\n".encode() + response.content)
+    text_part, file_part = message.get_payload()
+    assert text_part.get_payload(decode=True).decode("utf-8") == "This document is ready for OCR\n"
+    assert file_part.get_content_type() == "application/pdf"
+    assert file_part.get_payload(decode=True).startswith(b"%PDF")
+
+def test_process_ocr_spooled(monkeypatch, tmp_path):
+    monkeypatch.setattr(SETTINGS, "ocr_spool_threshold", 0)
+    monkeypatch.setattr(SETTINGS, "ocr_scratch_dir", str(tmp_path))
+    current_dir = os.path.dirname(__file__)
+    file_name = "document-ready-for-ocr.pdf"
+    with open(f"{current_dir}/testdata/{file_name}", "rb") as file, TestClient(APP, headers=headers) as client:
+        response = client.post(
+            "/process_ocr",
+            files={"file": (file_name, file, "application/pdf")},
+            data={"ocrmypdf_parameters": "--skip-text --tesseract-pagesegmode 7 --language eng"}
+        )
+    assert response.status_code == 200
+    response_json = response.json()
+    assert response_json["recognizedText"] == "This document is ready for OCR\n"
+    assert base64.b64decode(response_json["fileContent"]).startswith(b"%PDF")
+    assert os.listdir(tmp_path) == []
+
+def test_process_ocr_cached(monkeypatch, tmp_path):
+    monkeypatch.setattr(SETTINGS, "ocr_cache_dir", str(tmp_path / "cache"))
+    current_dir = os.path.dirname(__file__)
+    file_name = "document-ready-for-ocr.pdf"
+    parameters = "--skip-text --language eng"
+    cached_pdf = tmp_path / "cached.pdf"
+    cached_pdf.write_bytes(b"%PDF-cached")
+    with open(f"{current_dir}/testdata/{file_name}", "rb") as file, TestClient(APP, headers=headers) as client:
+        cache = client.app.state.cache
+        content = file.read()
+        cache.put(cache.key(content, OcrService(logger).normalize_parameters(parameters)), OcrOutput(file_name, "application/pdf", "Cached text\n", str(cached_pdf)))
+        response = client.post(
+            "/process_ocr",
+            files={"file": (file_name, content, "application/pdf")},
+            data={"ocrmypdf_parameters": parameters}
+        )
+    assert response.status_code == 200
+    response_json = response.json()
+    assert response_json["recognizedText"] == "Cached text\n"
+    assert base64.b64decode(response_json["fileContent"]) == b"%PDF-cached"
+    assert cache.hits == 1
+
+def test_process_ocr_error_unknown_language():
+    current_dir = os.path.dirname(__file__)
+    file_name = "document-ready-for-ocr.pdf"
+    with open(f"{current_dir}/testdata/{file_name}", "rb") as file, TestClient(APP, headers=headers) as client:
+        response = client.post(
+            "/process_ocr",
+            files={"file": (file_name, file, "application/pdf")},
+            data={"ocrmypdf_parameters": "--language eng+xyz"}
+        )
+    assert response.status_code == 400
+    assert response.json()["message"] == "Language(s) not installed: xyz"
+
+def test_process_ocr_error_invalid_parameters():
+    with TestClient(APP, headers=headers) as client:
+        invalid = client.post("/process_ocr", files={"file": ("a.pdf", b"%PDF", "application/pdf")}, data={"ocrmypdf_parameters": "--force-ocr --skip-text"})
+        unknown_profile = client.post("/process_ocr/text", files={"file": ("a.pdf", b"%PDF", "application/pdf")}, data={"parameter_profile": "receipts"})
+        no_output = client.post("/process_ocr", files={"file": ("a.pdf", b"%PDF", "application/pdf")}, data={"ocrmypdf_parameters": "--output-type none"})
+    assert invalid.status_code == 400
+    assert invalid.json()["message"] == "Invalid OCR parameters: Choose only one of --force-ocr, --skip-text, --redo-ocr."
+    assert no_output.status_code == 400
+    assert no_output.json()["message"] == "Invalid OCR parameters: --output-type none produces no PDF, it can only be used when requesting the text"
+    assert unknown_profile.status_code == 400
+    assert unknown_profile.json()["message"] == "Unknown OCR profile: receipts (available: none)"
+
+def test_parameter_profiles(monkeypatch):
+    monkeypatch.setattr(SETTINGS, "ocr_parameter_profiles", '{"fast-text": "-l eng -s"}')
+    with TestClient(APP, headers=headers) as client:
+        profiles = client.get("/parameter_profiles")
+        invalid = client.post("/process_ocr", files={"file": ("a.pdf", b"%PDF", "application/pdf")},
+                              data={"parameter_profile": "fast-text", "ocrmypdf_parameters": "--redo-ocr"})
+    assert profiles.json() == {"fast-text": "--language eng --skip-text"}
+    assert invalid.status_code == 400
+    assert invalid.json()["message"] == "Invalid OCR parameters: Choose only one of --force-ocr, --skip-text, --redo-ocr."
+
+def test_invalid_parameter_profiles(monkeypatch):
+    monkeypatch.setattr(SETTINGS, "ocr_parameter_profiles", '{"broken": "--unknown"}')
+    with pytest.raises(ValueError, match="Invalid OCR profile broken"):
+        with TestClient(APP, headers=headers):
+            pass
+
+def test_engine_info():
+    with TestClient(APP, headers=headers) as client:
+        response = client.get("/engine_info")
+    assert response.status_code == 200
+    response_json = response.json()
+    assert "deu" in response_json["languages"]
+    assert response_json["tesseractVersion"].startswith("5.")
+    assert response_json["ocrmypdfVersion"]
+
+def test_metrics():
+    with TestClient(APP, headers=headers) as client:
+        client.get("/jobs/unknown")
+        response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    assert 'ocr_http_requests_total{method="GET",route="/jobs/{job_id}",status="404"}' in response.text
+    assert "ocr_queue_depth 0" in response.text
+    assert "ocr_in_flight 0" in response.text
+    assert 'ocr_running_tasks{priority="bulk"} 0' in response.text
+
+def test_process_ocr_document_too_large(monkeypatch):
+    monkeypatch.setattr(SETTINGS, "ocr_max_megapixels", 1)
+    current_dir = os.path.dirname(__file__)
+    file_name = "document-ready-for-ocr.pdf"
+    with open(f"{current_dir}/testdata/{file_name}", "rb") as file, TestClient(APP, headers=headers) as client:
+        response = client.post("/process_ocr", files={"file": (file_name, file, "application/pdf")})
+    assert response.status_code == 413
+    assert "megapixels" in response.json()["message"]
+
+def test_deadline_exceeded():
+    with pytest.raises(DeadlineExceededError) as exc_info:
+        asyncio.run(_with_deadline(asyncio.sleep(10), 0.01))
+    assert exc_info.value.status_code == 504
+    assert asyncio.run(_with_deadline(asyncio.sleep(0, "done"), None)) == "done"
+
+def test_process_ocr_cancelled_on_disconnect(monkeypatch):
+    monkeypatch.setattr(app_module, "_DISCONNECT_POLL_INTERVAL", 0.05)
+    started, cancelled = asyncio.Event(), asyncio.Event()
+
+    async def run(*args, **kwargs):
+        started.set()
+        try:
+            await asyncio.sleep(60)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    with TestClient(APP, headers=headers) as client:
+        monkeypatch.setattr(APP.state.scheduler, "run", run)
+        request = client.build_request("POST", "/process_ocr", files={"file": ("document.pdf", b"%PDF-1.7", "application/pdf")})
+        body = request.read()
+        scope = {"type": "http", "http_version": "1.1", "method": "POST", "scheme": "http", "path": "/process_ocr", "raw_path": b"/process_ocr",
+                 "root_path": "", "query_string": b"", "server": ("testserver", 80), "client": ("testclient", 50000),
+                 "headers": [(name.lower().encode(), value.encode()) for name, value in request.headers.items()]}
+        messages = []
+
+        async def receive():
+            if not messages:
+                messages.append("request")
+                return {"type": "http.request", "body": body, "more_body": False}
+            # The client goes away once the OCR started
+            await started.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            messages.append(message)
+
+        async def request_and_disconnect():
+            # Through the whole middleware stack (request counting, compression, AppAPI authentication, tracing)
+            await asyncio.wait_for(APP(scope, receive, send), 10)
+            return cancelled.is_set()
+
+        assert client.portal.call(request_and_disconnect)
+    assert messages[1]["status"] == 499
+
+def test_process_ocr_priority():
+    current_dir = os.path.dirname(__file__)
+    file_name = "document-already-processed.pdf"
+    with open(f"{current_dir}/testdata/{file_name}", "rb") as file, TestClient(APP, headers=headers) as client:
+        content = file.read()
+        response = client.post("/process_ocr", files={"file": (file_name, content, "application/pdf")}, data={"priority": "bulk"})
+        invalid_response = client.post("/process_ocr", files={"file": (file_name, content, "application/pdf")}, data={"priority": "urgent"})
+    assert response.status_code == 200
+    assert invalid_response.status_code == 422
+
+def test_process_ocr_stream():
+    current_dir = os.path.dirname(__file__)
+    file_name = "document-ready-for-ocr.pdf"
+    with open(f"{current_dir}/testdata/{file_name}", "rb") as file, TestClient(APP, headers=headers) as client:
+        response = client.post(
+            "/process_ocr/stream",
+            files={"file": (file_name, file, "application/pdf")},
+            data={"ocrmypdf_parameters": "--skip-text --tesseract-pagesegmode 7 --language eng"}
+        )
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    events = [json.loads(line) for line in response.text.splitlines()]
+    assert {"type": "page", "page": 1, "text": "This document is ready for OCR\n"} in events
+    assert events[-1]["type"] == "result"
+    assert events[-1]["result"]["recognizedText"] == "This document is ready for OCR\n"
+    assert base64.b64decode(events[-1]["result"]["fileContent"]).startswith(b"%PDF")
+
+def test_process_ocr_stream_error():
+    current_dir = os.path.dirname(__file__)
+    file_name = "document-invalid.pdf"
+    with open(f"{current_dir}/testdata/{file_name}", "rb") as file, TestClient(APP, headers=headers) as client:
+        response = client.post(
+            "/process_ocr/stream",
+            files={"file": (file_name, file, "application/pdf")}
+        )
+    assert response.status_code == 200
+    events = [json.loads(line) for line in response.text.splitlines()]
+    assert events[-1] == {"type": "error", "error": {"message": " (UnsupportedImageFormatError)", "ocrMyPdfExitCode": 2}}
+
+def test_stream_closed_after_ocr_finished(tmp_path):
+    source, output_path = tmp_path / "source.pdf", tmp_path / "output.pdf"
+    source.write_bytes(b"%PDF")
+    output_path.write_bytes(b"%PDF")
+
+    async def run():
+        events, result = asyncio.Queue(), asyncio.get_running_loop().create_future()
+        events.put_nowait(ProgressEvent("OCR", "page", 1, 1))
+        stream = app_module._stream_ocr(None, str(source), None, result, events, None)
+        await anext(stream)
+        # The client goes away after the OCR finished, but before the result was sent
+        result.set_result(OcrOutput("source.pdf", "application/pdf", "", str(output_path)))
+        await stream.aclose()
+    asyncio.run(run())
+
+    assert list(tmp_path.iterdir()) == []
+
+def test_process_ocr_batch():
+    current_dir = os.path.dirname(__file__)
+    with open(f"{current_dir}/testdata/document-already-processed.pdf", "rb") as processed, \
+            open(f"{current_dir}/testdata/document-ready-for-ocr.pdf", "rb") as ready, \
+            TestClient(APP, headers=headers) as client:
+        response = client.post(
+            "/process_ocr/batch",
+            files=[("files", ("processed.pdf", processed, "application/pdf")), ("files", ("ready.pdf", ready, "application/pdf"))],
+            data={"ocrmypdf_parameters": ["", "--language xyz"]}
+        )
+    assert response.status_code == 200
+    processed_result, ready_result = response.json()
+    assert processed_result["statusCode"] == 200
+    assert processed_result["result"]["recognizedText"] == "This document has already been\n\nprocessed via OCR\n\n"
+    assert ready_result["statusCode"] == 400
+    assert ready_result["error"]["message"] == "Language(s) not installed: xyz"
+
+def test_process_ocr_batch_parameter_mismatch():
+    with TestClient(APP, headers=headers) as client:
+        response = client.post(
+            "/process_ocr/batch",
+            files=[("files", ("a.pdf", b"%PDF", "application/pdf"))],
+            data={"ocrmypdf_parameters": ["--language eng", "--language deu"]}
+        )
+    assert response.status_code == 400
+    assert response.json()["message"] == "Got 2 OCR parameters for 1 files"
+
+def test_process_ocr_batch_exceeding_queue(monkeypatch):
+    monkeypatch.setattr(SETTINGS, "ocr_workers", 1)
+    monkeypatch.setattr(SETTINGS, "ocr_queue_size", 1)
+
+    with TestClient(APP, headers=headers) as client:
+        scheduler = APP.state.scheduler
+
+        async def execute(fn, args, on_event, owner, memory):
+            try:
+                await asyncio.sleep(0.5)
+                return OcrResult(filename=args[1], content_type="application/pdf", recognized_text="text", file_content="")
+            finally:
+                scheduler._pending -= 1
+
+        monkeypatch.setattr(scheduler, "_execute", execute)
+        response = client.post(
+            "/process_ocr/batch",
+            files=[("files", (f"{index}.pdf", b"%PDF-1.7", "application/pdf")) for index in range(3)])
+    assert response.status_code == 200
+    # One file runs, one waits in the queue, the last one doesn't fit anymore
+    assert sorted(item["statusCode"] for item in response.json()) == [200, 200, 503]
+
+def test_process_ocr_text():
+    current_dir = os.path.dirname(__file__)
+    file_name = "document-ready-for-ocr.pdf"
+    with open(f"{current_dir}/testdata/{file_name}", "rb") as file, TestClient(APP, headers=headers) as client:
+        response = client.post(
+            "/process_ocr/text",
+            files={"file": (file_name, file, "application/pdf")},
+            data={"ocrmypdf_parameters": "--tesseract-pagesegmode 7 --language eng", "per_page": "true"}
+        )
+    assert response.status_code == 200
+    assert response.json() == {"filename": file_name, "recognizedText": "This document is ready for OCR\n", "pages": ["This document is ready for OCR\n"]}
+
+def test_process_ocr_text_already_processed_file():
+    current_dir = os.path.dirname(__file__)
+    file_name = "document-already-processed.pdf"
+    with open(f"{current_dir}/testdata/{file_name}", "rb") as file, TestClient(APP, headers=headers) as client:
+        response = client.post(
+            "/process_ocr/text",
+            files={"file": (file_name, file, "application/pdf")}
+        )
+    assert response.status_code == 200
+    assert response.json() == {"filename": file_name, "recognizedText": "This document has already been\n\nprocessed via OCR\n\n"}
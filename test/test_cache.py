@@ -0,0 +1,77 @@
+import logging
+import os
+
+from workflow_ocr_backend.cache import ResultCache
+from workflow_ocr_backend.ocrservice import OcrOutput, OcrService
+
+logger = logging.getLogger(__name__)
+
+def create_output(directory, name: str, content: bytes, text: str) -> OcrOutput:
+    path = directory / f"{name}.pdf"
+    path.write_bytes(content)
+    return OcrOutput(name, "application/pdf", text, str(path))
+
+def test_cache_roundtrip(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"), 1024, "v1", logger)
+    key = cache.key(b"input", "{}")
+    assert cache.get(key, "input.pdf", str(tmp_path)) is None
+    cache.put(key, create_output(tmp_path, "output", b"%PDF", "text"))
+
+    cached = cache.get(key, "renamed.pdf", str(tmp_path))
+
+    assert cached.filename == "renamed.pdf"
+    assert cached.recognized_text == "text"
+    with open(cached.file_path, "rb") as file:
+        assert file.read() == b"%PDF"
+    assert (cache.hits, cache.misses) == (1, 1)
+    # Private copy can be deleted without affecting the cache
+    os.unlink(cached.file_path)
+    assert cache.get(key, "input.pdf", str(tmp_path)) is not None
+
+def test_cache_roundtrip_detected_languages(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"), 1024, "v1", logger)
+    output = create_output(tmp_path, "output", b"%PDF", "text")
+    output.detected_languages = ["deu"]
+    cache.put("auto", output)
+    cache.put("manual", create_output(tmp_path, "manual", b"%PDF", "text"))
+
+    assert cache.get("auto", "input.pdf", str(tmp_path)).detected_languages == ["deu"]
+    assert cache.get("manual", "input.pdf", str(tmp_path)).detected_languages is None
+    # Entries survive a restart including their languages
+    restarted = ResultCache(str(tmp_path / "cache"), 1024, "v1", logger)
+    assert restarted.size == cache.size
+    assert restarted.get("auto", "input.pdf", str(tmp_path)).detected_languages == ["deu"]
+
+def test_cache_key(tmp_path):
+    cache = ResultCache(str(tmp_path), 1024, "v1", logger)
+    spooled = tmp_path / "spooled"
+    spooled.write_bytes(b"input")
+    assert cache.key(b"input", "{}") == cache.key(str(spooled), "{}")
+    assert cache.key(b"input", "{}") != cache.key(b"other", "{}")
+    assert cache.key(b"input", "{}") != cache.key(b"input", '{"force-ocr": true}')
+    assert cache.key(b"input", "{}") != ResultCache(str(tmp_path), 1024, "v2", logger).key(b"input", "{}")
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"), 20, "v1", logger)
+    cache.put("a", create_output(tmp_path, "a", b"a" * 8, ""))
+    cache.put("b", create_output(tmp_path, "b", b"b" * 8, ""))
+    assert cache.get("a", "a.pdf", str(tmp_path)) is not None
+    cache.put("c", create_output(tmp_path, "c", b"c" * 8, ""))
+
+    assert cache.get("b", "b.pdf", str(tmp_path)) is None
+    assert cache.get("a", "a.pdf", str(tmp_path)) is not None
+    assert cache.size == 16
+    # Entries survive a restart
+    assert len(ResultCache(str(tmp_path / "cache"), 20, "v1", logger)) == 2
+
+def test_normalize_parameters():
+    service = OcrService(logger)
+    assert service.normalize_parameters("--language eng+deu --skip-text") == service.normalize_parameters("--skip-text --jobs 4 --language eng+deu")
+    assert service.normalize_parameters(None) == "{}"
+
+def test_normalize_parameters_max_dpi():
+    service = OcrService(logger)
+    # The server default is part of the key, unless the request sets its own resolution
+    assert service.normalize_parameters("--skip-text", max_dpi=300) == service.normalize_parameters("--skip-text --max-ocr-dpi 300")
+    assert service.normalize_parameters("--max-ocr-dpi 200", max_dpi=300) == service.normalize_parameters("--max-ocr-dpi 200")
+    assert service.normalize_parameters("--max-ocr-dpi 0 --downsample-output", max_dpi=300) == service.normalize_parameters(None)
@@ -0,0 +1,33 @@
+import multiprocessing
+import subprocess
+import time
+import uuid
+
+from workflow_ocr_backend.cancellation import CancelledTasks, kill_descendants
+
+
+def test_cancelled_tasks_ring_buffer():
+    cancelled = CancelledTasks(multiprocessing.get_context("spawn"), size=2)
+    task_ids = [uuid.uuid4().hex for _ in range(3)]
+    cancelled.add(task_ids[0])
+    assert task_ids[0] in cancelled
+    assert task_ids[1] not in cancelled
+    cancelled.add(task_ids[1])
+    cancelled.add(task_ids[2])
+    # The oldest id was overwritten
+    assert task_ids[0] not in cancelled
+    assert task_ids[1] in cancelled and task_ids[2] in cancelled
+
+def test_kill_descendants():
+    shell = subprocess.Popen(["sh", "-c", "sleep 60 & wait"])
+    try:
+        killed, started_at = 0, time.monotonic()
+        # Wait for the shell to start its child process
+        while killed == 0 and time.monotonic() - started_at < 5:
+            killed = kill_descendants(shell.pid)
+            time.sleep(0.05)
+        assert killed == 1
+        # The shell finishes as soon as its child is gone
+        shell.wait(timeout=10)
+    finally:
+        shell.kill()
@@ -0,0 +1,106 @@
+import gzip
+import json
+
+from fastapi import FastAPI, File, UploadFile
+from fastapi.responses import Response, StreamingResponse
+from fastapi.testclient import TestClient
+import pytest
+import zstandard
+
+from workflow_ocr_backend.compression import CompressionMiddleware, negotiate
+from workflow_ocr_backend.settings import Settings
+
+TEXT = "This document is ready for OCR\n" * 100
+
+
+def _create_app(**settings) -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/text")
+    async def text(size: int = len(TEXT)):
+        return {"recognizedText": TEXT[:size]}
+
+    @app.get("/pdf")
+    async def pdf():
+        return Response(b"%PDF" * 1000, media_type="application/pdf")
+
+    @app.get("/stream")
+    async def stream():
+        async def lines():
+            for page in range(3):
+                yield json.dumps({"type": "page", "page": page, "text": TEXT}).encode("utf-8") + b"\n"
+        return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+    @app.post("/upload")
+    async def upload(file: UploadFile = File(...)):
+        return {"filename": file.filename, "size": len(await file.read())}
+
+    app.add_middleware(CompressionMiddleware, settings=Settings(**settings))
+    return app
+
+@pytest.mark.parametrize("accept_encoding, expected", [
+    ("", None),
+    ("gzip, deflate", "gzip"),
+    ("gzip, zstd", "zstd"),
+    ("zstd;q=0.5, gzip", "gzip"),
+    ("br, *;q=0.1", "zstd"),
+    ("*, zstd;q=0", "gzip"),
+    ("identity", None),
+])
+def test_negotiate(accept_encoding, expected):
+    assert negotiate(accept_encoding) == expected
+
+@pytest.mark.parametrize("encoding", ["gzip", "zstd"])
+def test_compressed_response(encoding):
+    with TestClient(_create_app()) as client:
+        response = client.get("/text", headers={"Accept-Encoding": encoding})
+    assert response.headers["content-encoding"] == encoding
+    assert response.headers["vary"] == "Accept-Encoding"
+    assert int(response.headers["content-length"]) < len(TEXT) / 10
+    assert response.json()["recognizedText"] == TEXT
+
+def test_uncompressed_responses():
+    with TestClient(_create_app(ocr_compression_min_size=1024)) as client:
+        small = client.get("/text", params={"size": 100}, headers={"Accept-Encoding": "gzip"})
+        pdf = client.get("/pdf", headers={"Accept-Encoding": "gzip"})
+        not_accepted = client.get("/text", headers={"Accept-Encoding": "identity"})
+    with TestClient(_create_app(ocr_compression_level=0)) as client:
+        disabled = client.get("/text", headers={"Accept-Encoding": "gzip"})
+    for response in (small, pdf, not_accepted, disabled):
+        assert "content-encoding" not in response.headers
+    assert pdf.content == b"%PDF" * 1000
+
+def test_streamed_response_is_flushed_per_chunk():
+    with TestClient(_create_app()) as client:
+        with client.stream("GET", "/stream", headers={"Accept-Encoding": "zstd"}) as response:
+            assert response.headers["content-encoding"] == "zstd"
+            decompressor = zstandard.ZstdDecompressor().decompressobj()
+            # Every chunk can be decompressed as soon as it arrived
+            chunks = [decompressor.decompress(chunk) for chunk in response.iter_raw()]
+    assert all(chunks)
+    assert [json.loads(line)["page"] for line in b"".join(chunks).splitlines()] == [0, 1, 2]
+
+@pytest.mark.parametrize("encoding, compress", [("gzip", gzip.compress), ("zstd", zstandard.ZstdCompressor().compress)])
+def test_compressed_upload(encoding, compress):
+    with TestClient(_create_app()) as client:
+        request = client.build_request("POST", "/upload", files={"file": ("document.pdf", b"%PDF" * 100_000, "application/pdf")})
+        body = compress(request.read())
+        response = client.post("/upload", content=body, headers={"Content-Type": request.headers["content-type"], "Content-Encoding": encoding})
+    assert response.status_code == 200
+    assert response.json() == {"filename": "document.pdf", "size": 400_000}
+
+def test_invalid_compressed_uploads():
+    files = {"file": ("document.pdf", b"%PDF" * 100_000, "application/pdf")}
+    with TestClient(_create_app(ocr_max_decompressed_size=100_000)) as client:
+        request = client.build_request("POST", "/upload", files=files)
+        content_type = request.headers["content-type"]
+        body = gzip.compress(request.read())
+        too_large = client.post("/upload", content=body, headers={"Content-Type": content_type, "Content-Encoding": "gzip"})
+        truncated = client.post("/upload", content=body[:len(body) // 10], headers={"Content-Type": content_type, "Content-Encoding": "gzip"})
+        unsupported = client.post("/upload", content=body, headers={"Content-Type": content_type, "Content-Encoding": "br"})
+    assert too_large.status_code == 413
+    assert too_large.json() == {"message": "Decompressed request body exceeds 100000 bytes"}
+    assert truncated.status_code == 400
+    assert truncated.json() == {"message": "Truncated gzip request body"}
+    assert unsupported.status_code == 415
+    assert unsupported.json()["message"] == "Unsupported Content-Encoding of the request body: br (supported: zstd, gzip)"
@@ -0,0 +1,89 @@
+import asyncio
+
+import pytest
+
+from workflow_ocr_backend.fairshare import FairSlots, TaskOwner
+from workflow_ocr_backend.model.priority import Priority
+
+ALICE = TaskOwner("alice", Priority.INTERACTIVE)
+ALICE_BULK = TaskOwner("alice", Priority.BULK)
+BOB = TaskOwner("bob", Priority.INTERACTIVE)
+BOB_BULK = TaskOwner("bob", Priority.BULK)
+
+
+def _order_of(slots: FairSlots, owners: list[TaskOwner]) -> list[str]:
+    """
+    Lets all owners wait for the (occupied) slots and returns the order in which they are granted,
+    releasing every slot right after it was granted.
+    """
+    granted = []
+
+    async def run():
+        async def wait(index: int, owner: TaskOwner):
+            await slots.acquire(owner)
+            granted.append(f"{owner.user}-{owner.priority.value}-{index}")
+            await asyncio.sleep(0)
+            slots.release(owner)
+
+        blocker = TaskOwner("blocker")
+        for _ in range(slots.slots):
+            await slots.acquire(blocker)
+        tasks = [asyncio.ensure_future(wait(index, owner)) for index, owner in enumerate(owners)]
+        await asyncio.sleep(0)
+        for _ in range(slots.slots):
+            slots.release(blocker)
+        await asyncio.gather(*tasks)
+    asyncio.run(run())
+    return granted
+
+def test_interactive_before_bulk():
+    order = _order_of(FairSlots(1), [ALICE_BULK, BOB_BULK, ALICE, BOB])
+    assert order == ["alice-interactive-2", "bob-interactive-3", "alice-bulk-0", "bob-bulk-1"]
+
+def test_round_robin_between_users():
+    order = _order_of(FairSlots(1), [ALICE_BULK, ALICE_BULK, ALICE_BULK, BOB_BULK])
+    assert order == ["alice-bulk-0", "bob-bulk-3", "alice-bulk-1", "alice-bulk-2"]
+
+def test_user_limit():
+    async def run():
+        slots = FairSlots(3, user_limit=1)
+        await slots.acquire(ALICE)
+        waiting = asyncio.ensure_future(slots.acquire(ALICE))
+        await asyncio.sleep(0)
+        assert not waiting.done()
+        # Other users still get the free slots
+        await slots.acquire(BOB)
+        assert slots.running(Priority.INTERACTIVE) == 2
+        assert slots.waiting(Priority.INTERACTIVE) == 1
+        slots.release(ALICE)
+        await waiting
+    asyncio.run(run())
+
+def test_reserved_interactive_slots():
+    async def run():
+        slots = FairSlots(2, reserved_interactive=1)
+        await slots.acquire(ALICE_BULK)
+        waiting = asyncio.ensure_future(slots.acquire(BOB_BULK))
+        await asyncio.sleep(0)
+        assert not waiting.done()
+        assert slots.waiting(Priority.BULK) == 1
+        # The reserved slot is still available for interactive tasks
+        await asyncio.wait_for(slots.acquire(BOB), 1)
+        slots.release(ALICE_BULK)
+        await waiting
+        assert slots.running(Priority.BULK) == 1
+    asyncio.run(run())
+
+def test_cancelled_waiter_is_removed():
+    async def run():
+        slots = FairSlots(1)
+        await slots.acquire(ALICE)
+        waiting = asyncio.ensure_future(slots.acquire(BOB))
+        await asyncio.sleep(0)
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        assert slots.waiting(Priority.INTERACTIVE) == 0
+        slots.release(ALICE)
+        assert slots.running(Priority.INTERACTIVE) == 0
+    asyncio.run(run())
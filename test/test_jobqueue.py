@@ -0,0 +1,168 @@
+import asyncio
+import logging
+import os
+import time
+
+import pytest
+
+from workflow_ocr_backend import jobqueue
+from workflow_ocr_backend.exceptions import JobNotFinishedError
+from workflow_ocr_backend.fairshare import TaskOwner
+from workflow_ocr_backend.jobqueue import MAX_ATTEMPTS, DurableJobStore, JobRunner
+from workflow_ocr_backend.model.jobstatus import JobState
+from workflow_ocr_backend.model.ocrresult import ErrorResult
+from workflow_ocr_backend.model.priority import Priority
+from workflow_ocr_backend.ocrplugin import ProgressEvent
+from workflow_ocr_backend.ocrservice import OcrOutput
+
+logger = logging.getLogger(__name__)
+
+BULK = TaskOwner("alice", Priority.BULK)
+INTERACTIVE = TaskOwner("bob", Priority.INTERACTIVE)
+
+
+def _store(tmp_path, replica_id: str, lease: float = 60) -> DurableJobStore:
+    return DurableJobStore(str(tmp_path / "queue"), ttl=60, lease=lease, logger=logger, replica_id=replica_id)
+
+def _create(store: DurableJobStore, job_id: str, owner: TaskOwner = BULK):
+    return store.create(job_id, f"{job_id}.pdf", "--language eng", owner, None, 1024, b"%PDF")
+
+def _error(exc: Exception) -> tuple[ErrorResult, int]:
+    return ErrorResult(message=str(exc)), 500
+
+def test_job_ids_are_idempotent(tmp_path):
+    replica_a, replica_b = _store(tmp_path, "a"), _store(tmp_path, "b")
+    job, created = _create(replica_a, "job-1")
+    assert created and job.state == JobState.QUEUED
+    again, created = _create(replica_b, "job-1")
+    assert not created and again.created_at == job.created_at
+    assert len(replica_a) == 1
+    assert len(os.listdir(tmp_path / "queue" / "inputs")) == 1
+
+def test_claim_order(tmp_path):
+    store = _store(tmp_path, "a")
+    _create(store, "bulk", BULK)
+    _create(store, "interactive", INTERACTIVE)
+    claimed = store.claim()
+    assert (claimed.job_id, claimed.owner, claimed.attempt) == ("interactive", INTERACTIVE, 1)
+    with open(claimed.input_path, "rb") as file:
+        assert file.read() == b"%PDF"
+    assert store.claim().job_id == "bulk"
+    assert store.claim() is None
+    assert store.count_by_state()[JobState.RUNNING] == 2
+
+def test_expired_lease_is_claimed_again(tmp_path):
+    replica_a, replica_b = _store(tmp_path, "a", lease=0.05), _store(tmp_path, "b")
+    _create(replica_a, "job-1")
+    job = replica_a.find(replica_a.claim().job_id)
+    assert replica_b.claim() is None
+    time.sleep(0.1)
+    claimed = replica_b.claim()
+    assert (claimed.job_id, claimed.attempt) == ("job-1", 2)
+
+    # Replica a lost the job, its result is discarded
+    output_a = tmp_path / "a.pdf"
+    output_a.write_bytes(b"a")
+    assert not replica_a.renew(job)
+    assert not replica_a.succeed(job, OcrOutput("job-1.pdf", "application/pdf", "a", str(output_a)))
+    with pytest.raises(JobNotFinishedError):
+        replica_a.get_result("job-1")
+
+    output_b = tmp_path / "b.pdf"
+    output_b.write_bytes(b"b")
+    assert replica_b.succeed(replica_b.find("job-1"), OcrOutput("job-1.pdf", "application/pdf", "b", str(output_b), ["eng"]))
+    result = replica_a.get_result("job-1").result
+    assert (result.recognized_text, result.detected_languages) == ("b", ["eng"])
+    with open(result.file_path, "rb") as file:
+        assert file.read() == b"b"
+    assert not os.listdir(tmp_path / "queue" / "inputs")
+
+def test_abandoned_job_fails(tmp_path):
+    store = _store(tmp_path, "a", lease=0)
+    _create(store, "job-1")
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        assert store.claim().attempt == attempt
+    assert store.claim() is None
+    job = store.get_result("job-1")
+    assert job.state == JobState.FAILED
+    assert job.error.message.startswith("Job was abandoned")
+
+def test_job_runner(tmp_path):
+    store = _store(tmp_path, "a")
+
+    async def process(job, on_event):
+        on_event(ProgressEvent("OCR", "page", 2, 1))
+        await asyncio.sleep(0.05)
+        if job.ocrmypdf_parameters is None:
+            raise ValueError("broken")
+        output = tmp_path / f"{job.job_id}.pdf"
+        output.write_bytes(b"%PDF-ocr")
+        return OcrOutput(job.filename, "application/pdf", "text", str(output))
+
+    async def run():
+        runner = JobRunner(store, process, _error, concurrency=2, logger=logger)
+        runner.start()
+        _create(store, "job-1")
+        store.create("job-2", "job-2.pdf", None, BULK, None, 1024, b"%PDF")
+        runner.wakeup()
+        await asyncio.sleep(0.02)
+        running = store.get("job-1")
+        assert running.state == JobState.RUNNING and running.pages_done == 1
+        for _ in range(100):
+            if store.count_by_state()[JobState.RUNNING] == 0:
+                break
+            await asyncio.sleep(0.01)
+        await runner.stop()
+
+    asyncio.run(run())
+    succeeded = store.get_result("job-1")
+    assert succeeded.state == JobState.SUCCEEDED and succeeded.pages_done == 1
+    with open(succeeded.result.file_path, "rb") as file:
+        assert file.read() == b"%PDF-ocr"
+    failed = store.get_result("job-2")
+    assert (failed.state, failed.error.message, failed.error_status_code) == (JobState.FAILED, "broken", 500)
+
+def test_job_runner_returns_jobs_on_stop(tmp_path):
+    store = _store(tmp_path, "a")
+
+    async def process(job, on_event):
+        await asyncio.sleep(60)
+
+    async def run():
+        runner = JobRunner(store, process, _error, concurrency=1, logger=logger)
+        runner.start()
+        _create(store, "job-1")
+        runner.wakeup()
+        await asyncio.sleep(0.05)
+        assert store.get("job-1").state == JobState.RUNNING
+        await runner.stop()
+
+    asyncio.run(run())
+    assert store.get("job-1").state == JobState.QUEUED
+    assert store.claim().attempt == 1
+
+def test_expired_jobs_evicted_in_background(tmp_path, monkeypatch):
+    monkeypatch.setattr(jobqueue, "_HOUSEKEEPING_INTERVAL", 0.05)
+    store = DurableJobStore(str(tmp_path / "queue"), ttl=0.1, lease=60, logger=logger, replica_id="a")
+    job, _ = _create(store, "job-1")
+    store.claim()
+    output = tmp_path / "job-1.pdf"
+    output.write_bytes(b"%PDF-ocr")
+    store.succeed(job, OcrOutput(job.filename, "application/pdf", "text", str(output)))
+    time.sleep(0.2)
+    # Reads skip the expired job, but don't evict it
+    assert store.find("job-1") is None
+    assert len(store) == 1
+
+    async def process(job, on_event):
+        raise ValueError("unexpected job")
+
+    async def run():
+        runner = JobRunner(store, process, _error, concurrency=1, logger=logger)
+        runner.start()
+        await asyncio.sleep(0.2)
+        await runner.stop()
+
+    asyncio.run(run())
+    assert len(store) == 0
+    assert os.listdir(tmp_path / "queue" / "results") == []
@@ -0,0 +1,38 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from workflow_ocr_backend.exceptions import JobNotFinishedError, JobNotFoundError
+from workflow_ocr_backend.jobs import JobStore
+from workflow_ocr_backend.model.jobstatus import JobState
+from workflow_ocr_backend.ocrplugin import ProgressEvent
+from workflow_ocr_backend.ocrservice import OcrOutput
+
+def test_job_progress():
+    store = JobStore(ttl=60)
+    job = store.create("file.pdf")
+    assert job.state == JobState.QUEUED
+    job.on_progress(ProgressEvent("Scanning contents", "page", 10, 10))
+    assert job.state == JobState.RUNNING
+    assert job.pages_total is None
+    job.on_progress(ProgressEvent("OCR", "page", 10, 4.5))
+    status = store.get(job.job_id).status()
+    assert status.stage == "OCR"
+    assert status.pages_total == 10
+    assert status.pages_done == 4
+    with pytest.raises(JobNotFinishedError):
+        store.get_result(job.job_id)
+
+def test_finished_jobs_are_evicted(tmp_path):
+    output_path = tmp_path / "output.pdf"
+    output_path.write_bytes(b"%PDF")
+    store = JobStore(ttl=60)
+    finished = store.create("finished.pdf")
+    finished.succeed(OcrOutput("finished.pdf", "application/pdf", "", str(output_path)))
+    running = store.create("running.pdf")
+    assert store.get_result(finished.job_id).result is not None
+    finished.finished_at = datetime.now(timezone.utc) - timedelta(seconds=61)
+    with pytest.raises(JobNotFoundError):
+        store.get(finished.job_id)
+    assert not output_path.exists()
+    assert store.get(running.job_id) is running
@@ -0,0 +1,53 @@
+import logging
+import os
+
+from workflow_ocr_backend.languagedetect import LanguageDetector, narrow_by_script, narrow_by_text
+from workflow_ocr_backend.ocrservice import OcrService
+
+logger = logging.getLogger(__name__)
+testdata_dir = os.path.join(os.path.dirname(__file__), "testdata")
+
+
+def test_narrow_by_script():
+    languages = ["eng", "deu", "rus", "ell", "xyz"]
+    assert narrow_by_script(languages, ["Latin"]) == ["eng", "deu", "xyz"]
+    assert narrow_by_script(languages, ["Cyrillic", "Latin"]) == ["eng", "deu", "rus", "xyz"]
+    # Nothing detected or nothing matching: keep everything
+    assert narrow_by_script(languages, []) == languages
+    assert narrow_by_script(["eng", "deu"], ["Arabic"]) == ["eng", "deu"]
+
+def test_narrow_by_text():
+    languages = ["eng", "deu", "fra", "ita", "spa", "xyz"]
+    german = "Das ist ein Text, der nicht auf Englisch ist und auch mit den Wörtern von dem Test zu tun hat."
+    english = "This is the English summary of the text, which is part of the document and was written for the readers."
+    assert narrow_by_text(languages, [german]) == ["deu", "xyz"]
+    assert narrow_by_text(languages, [german + " " + english]) == ["eng", "deu", "xyz"]
+    # Languages are only dropped if they don't occur on any sample page
+    assert narrow_by_text(languages, [german, english]) == ["eng", "deu", "xyz"]
+    # Not enough text to decide
+    assert narrow_by_text(languages, ["Rechnung 2024"]) == languages
+    assert narrow_by_text(languages, [german, "Rechnung 2024"]) == languages
+    assert narrow_by_text(languages, []) == languages
+
+def test_sample_images(tmp_path):
+    detector = LanguageDetector(logger)
+    with open(os.path.join(testdata_dir, "document-ready-for-ocr.pdf"), "rb") as file:
+        samples, page_count = detector._sample_images(file, None, str(tmp_path))
+        assert file.tell() == 0
+    assert page_count == 1
+    assert [os.path.basename(sample) for sample in samples] == ["sample-0.png"]
+    # Images are sampled as they are
+    samples, page_count = detector._sample_images(os.path.join(testdata_dir, "document-image.jpg"), None, str(tmp_path))
+    assert len(samples) == 1 and page_count == 1
+    samples, _ = detector._sample_images(os.path.join(testdata_dir, "document-invalid.pdf"), None, str(tmp_path))
+    assert samples == []
+
+def test_detect_keeps_languages_if_nothing_detected():
+    languages = ["eng", "deu"]
+    with open(os.path.join(testdata_dir, "document-invalid.pdf"), "rb") as file:
+        assert LanguageDetector(logger).detect(file, languages) == languages
+    assert LanguageDetector(logger).detect(os.path.join(testdata_dir, "document-ready-for-ocr.pdf"), ["eng"]) == ["eng"]
+
+def test_auto_language_changes_cache_key():
+    service = OcrService(logger)
+    assert service.normalize_parameters("--language eng+deu") != service.normalize_parameters("--language eng+deu", auto_language=True)
@@ -0,0 +1,53 @@
+import logging
+import os
+
+import pytest
+
+from workflow_ocr_backend.exceptions import UnknownLanguageError
+from workflow_ocr_backend.languages import LanguageCatalog
+from workflow_ocr_backend.ocrservice import OcrService
+
+logger = logging.getLogger(__name__)
+
+@pytest.fixture
+def tessdata(monkeypatch, tmp_path):
+    calls = []
+    def language_info(_):
+        calls.append(1)
+        return sorted(path.stem for path in tmp_path.glob("*.traineddata")), str(tmp_path)
+    (tmp_path / "eng.traineddata").touch()
+    monkeypatch.setattr(OcrService, "language_info", language_info)
+    monkeypatch.setattr(OcrService, "tesseract_version", lambda _: "5.5.0")
+    return tmp_path, calls
+
+def test_languages_are_cached(tessdata):
+    _, calls = tessdata
+    catalog = LanguageCatalog(logger)
+    assert catalog.current().languages == ["eng"]
+    assert catalog.current().tesseract_version == "5.5.0"
+    assert len(calls) == 1
+    assert catalog.refresh().languages == ["eng"]
+    assert len(calls) == 2
+
+def test_languages_are_refreshed_on_tessdata_change(tessdata):
+    directory, calls = tessdata
+    catalog = LanguageCatalog(logger)
+    catalog.current()
+    (directory / "deu.traineddata").touch()
+    os.utime(directory, (0, 0))
+    assert catalog.current().languages == ["deu", "eng"]
+    assert len(calls) == 2
+
+def test_validate_languages(tessdata):
+    catalog = LanguageCatalog(logger)
+    catalog.validate(["eng"])
+    with pytest.raises(UnknownLanguageError) as exc_info:
+        catalog.validate(["eng", "xyz"])
+    assert exc_info.value.status_code == 400
+    assert str(exc_info.value) == "Language(s) not installed: xyz"
+
+def test_requested_languages():
+    service = OcrService(logger)
+    assert service.requested_languages("--language eng+deu --skip-text") == ["eng", "deu"]
+    assert service.requested_languages("--language eng") == ["eng"]
+    assert service.requested_languages(None) == []
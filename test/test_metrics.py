@@ -0,0 +1,45 @@
+from workflow_ocr_backend import metrics
+from workflow_ocr_backend.metrics import Counter, Gauge, Histogram, Registry, count_pages
+from workflow_ocr_backend.ocrplugin import ProgressEvent
+
+def _pages() -> float:
+    return sum(value for _, _, value in metrics.PAGES.samples())
+
+def test_render():
+    registry = Registry()
+    counter = registry.register(Counter("requests_total", "Requests", ("status",)))
+    histogram = registry.register(Histogram("duration_seconds", "Duration", (1, 5)))
+    registry.register(Gauge("depth", "Queue depth", lambda: 3))
+    counter.inc(status="200")
+    counter.inc(2, status='a"b')
+    histogram.observe(0.5)
+    histogram.observe(3)
+    histogram.observe(10)
+
+    assert registry.render().splitlines() == [
+        "# HELP requests_total Requests",
+        "# TYPE requests_total counter",
+        'requests_total{status="200"} 1',
+        'requests_total{status="a\\"b"} 2',
+        "# HELP duration_seconds Duration",
+        "# TYPE duration_seconds histogram",
+        'duration_seconds_bucket{le="1"} 1',
+        'duration_seconds_bucket{le="5"} 2',
+        'duration_seconds_bucket{le="+Inf"} 3',
+        "duration_seconds_sum 13.5",
+        "duration_seconds_count 3",
+        "# HELP depth Queue depth",
+        "# TYPE depth gauge",
+        "depth 3",
+    ]
+
+def test_count_pages():
+    events = []
+    callback = count_pages(events.append)
+    before = _pages()
+    for completed in (0, 1, 1, 3):
+        callback(ProgressEvent("OCR", "page", 3, completed))
+    callback(ProgressEvent("Image processing", "page", 3, 3))
+
+    assert _pages() - before == 3
+    assert len(events) == 5
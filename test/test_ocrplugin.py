@@ -0,0 +1,139 @@
+from argparse import Namespace
+from pathlib import Path
+from types import SimpleNamespace
+from typing import NamedTuple
+
+from ocrmypdf.builtin_plugins import ghostscript
+from ocrmypdf.helpers import Resolution
+from PIL import Image
+import pytest
+
+from workflow_ocr_backend import ocrplugin
+from workflow_ocr_backend.exceptions import TaskCancelledError
+from workflow_ocr_backend.ocrplugin import PAGE_TEXT_STAGE, PageTextExecutor, ProgressEvent, ProgressReporter, StageTiming
+
+class FakePageResult(NamedTuple):
+    pageno: int
+    text: str | None
+
+def _process_page(args) -> FakePageResult:
+    pageno, text_path = args
+    return FakePageResult(pageno, text_path)
+
+def test_page_text_executor(tmp_path):
+    (tmp_path / "page1.txt").write_text("First page\n")
+    events: list[ProgressEvent] = []
+    finished: list[int] = []
+    ocrplugin.set_reporter(events.append)
+    try:
+        PageTextExecutor(pbar_class=ProgressReporter)(
+            use_threads=True, max_workers=1,
+            progress_kwargs=dict(total=2, desc="OCR", unit="page"),
+            worker_initializer=lambda: None,
+            task=_process_page,
+            task_arguments=[((0, str(tmp_path / "page1.txt")),), ((1, None),)],
+            task_finished=lambda result, pbar: finished.append(result.pageno))
+    finally:
+        ocrplugin.set_reporter(None)
+
+    assert finished == [0, 1]
+    page_events = [event for event in events if event.stage == PAGE_TEXT_STAGE]
+    assert page_events == [ProgressEvent(PAGE_TEXT_STAGE, page=1, text="First page\n"), ProgressEvent(PAGE_TEXT_STAGE, page=2)]
+
+def test_cancel_aborts_at_next_report():
+    events: list[ProgressEvent] = []
+    ocrplugin.set_reporter(events.append)
+    try:
+        with ProgressReporter(total=2, desc="OCR", unit="page") as progress:
+            progress.update()
+            ocrplugin.cancel()
+            with pytest.raises(TaskCancelledError):
+                progress.update()
+        # The next task is not cancelled
+        ocrplugin.set_reporter(events.append)
+        ocrplugin.report(ProgressEvent("Started"))
+    finally:
+        ocrplugin.set_reporter(None)
+    assert [event.completed for event in events] == [0, 1, 0]
+
+def _page(**options) -> SimpleNamespace:
+    defaults = dict(max_ocr_dpi=0, downsample_output=False, tesseract_downsample_above=32767, tesseract_downsample_large_images=True)
+    return SimpleNamespace(options=SimpleNamespace(**{**defaults, **options}))
+
+def test_downsample_scale():
+    assert ocrplugin.downsample_scale(Resolution(600, 600), 300) == 0.5
+    assert ocrplugin.downsample_scale(Resolution(300, 300), 300) is None
+    assert ocrplugin.downsample_scale(Resolution(600, 600), 0) is None
+
+def test_filter_ocr_image():
+    image = Image.new("1", (6000, 3000), 1)
+    image.info["dpi"] = (600, 600)
+    downsampled = ocrplugin.filter_ocr_image(page=_page(max_ocr_dpi=300), image=image)
+    assert downsampled.size == (3000, 1500)
+    assert downsampled.info["dpi"] == (300, 300)
+    assert downsampled.mode == "L"
+    # Images which are not over-resolved are left to the builtin plugin
+    assert ocrplugin.filter_ocr_image(page=_page(max_ocr_dpi=600), image=image) is None
+
+def test_filter_page_image(tmp_path):
+    image_path = tmp_path / "page.png"
+    Image.new("RGB", (1200, 1200)).save(image_path, dpi=(400, 400))
+    assert ocrplugin.filter_page_image(page=_page(max_ocr_dpi=200), image_filename=image_path) is None
+    downsampled_path = ocrplugin.filter_page_image(page=_page(max_ocr_dpi=200, downsample_output=True), image_filename=image_path)
+    with Image.open(downsampled_path) as downsampled:
+        assert downsampled.size == (600, 600)
+        assert downsampled.info["dpi"] == pytest.approx((200, 200), abs=0.01)
+
+@pytest.mark.parametrize("force_ocr, expected_dpi", [(False, Resolution(300, 300)), (True, None)])
+def test_rasterize_pdf_page(monkeypatch, force_ocr, expected_dpi):
+    rasterized = []
+    monkeypatch.setattr(ghostscript, "rasterize_pdf_page", lambda **kwargs: rasterized.append(kwargs) or kwargs["output_file"])
+    ocrplugin.check_options(Namespace(max_ocr_dpi=300, lossless_reconstruction=not force_ocr, clean=False))
+    try:
+        result = ocrplugin.rasterize_pdf_page(input_file="in.pdf", output_file="out.png", raster_device="pngmono", raster_dpi=Resolution(600, 600),
+                                              pageno=1, page_dpi=Resolution(600, 600), rotation=0, filter_vector=False, stop_on_soft_error=False)
+    finally:
+        ocrplugin.check_options(Namespace(max_ocr_dpi=0, lossless_reconstruction=True, clean=False))
+    if expected_dpi is None:
+        # The page image replaces the original page, so it's left to the builtin plugin
+        assert result is None and not rasterized
+    else:
+        assert result == "out.png"
+        assert rasterized[0]["raster_dpi"] == expected_dpi and rasterized[0]["page_dpi"] == expected_dpi
+
+def test_stage_timings():
+    events: list[ProgressEvent | StageTiming] = []
+    ocrplugin.set_reporter(events.append)
+    try:
+        with ProgressReporter(total=1, desc="PDF/A conversion", unit="page"):
+            pass
+        ocrplugin.set_timings(True)
+        with ProgressReporter(total=1, desc="PDF/A conversion", unit="page"):
+            pass
+    finally:
+        ocrplugin.set_timings(False)
+        ocrplugin.set_reporter(None)
+    timings = [event for event in events if isinstance(event, StageTiming)]
+    assert len(timings) == 1
+    assert timings[0].stage == "PDF/A conversion" and timings[0].start <= timings[0].end
+
+def test_timed_ocr_engine():
+    events: list[StageTiming] = []
+
+    class FakeEngine:
+        def generate_pdf(self, input_file, output_pdf, output_text, options):
+            return "pdf"
+
+        def creator_tag(self, options):
+            return "Fake"
+
+    engine = ocrplugin.TimedOcrEngine(FakeEngine())
+    ocrplugin.set_reporter(events.append)
+    ocrplugin.set_timings(True)
+    try:
+        assert engine.generate_pdf(Path("/tmp/000012_ocr.png"), None, None, None) == "pdf"
+    finally:
+        ocrplugin.set_timings(False)
+        ocrplugin.set_reporter(None)
+    assert engine.creator_tag(None) == "Fake"
+    assert [(event.stage, event.attributes) for event in events] == [("Tesseract", {"page": 12})]
@@ -0,0 +1,80 @@
+import io
+import logging
+import os
+import shutil
+
+import pikepdf
+import pytest
+
+from workflow_ocr_backend import ocrservice
+from workflow_ocr_backend.ocrservice import OcrService, PageScan
+
+logger = logging.getLogger(__name__)
+testdata = os.path.join(os.path.dirname(__file__), "testdata")
+
+def test_prescan():
+    service = OcrService(logger)
+    assert service.prescan(f"{testdata}/document-already-processed.pdf") == [PageScan(has_text=True, has_images=True)]
+    assert service.prescan(f"{testdata}/document-ready-for-ocr.pdf") == [PageScan(has_text=False, has_images=True)]
+    assert service.prescan(f"{testdata}/document-invalid.pdf") is None
+
+def test_prescan_mixed_document():
+    with pikepdf.new() as pdf:
+        pdf.pages.extend(pikepdf.open(f"{testdata}/document-already-processed.pdf").pages)
+        pdf.pages.extend(pikepdf.open(f"{testdata}/document-ready-for-ocr.pdf").pages)
+        pdf.add_blank_page()
+        buffer = io.BytesIO()
+        pdf.save(buffer)
+
+    scan = OcrService(logger).prescan(buffer)
+
+    assert [page.needs_ocr for page in scan] == [False, True, False]
+    assert buffer.tell() == 0
+
+def test_prescan_vector_page():
+    with pikepdf.new() as pdf:
+        pdf.add_blank_page()
+        # E.g. text converted to outlines
+        pdf.pages[0].obj.Contents = pdf.make_stream(b"0 0 m 100 100 l 100 0 l f")
+        buffer = io.BytesIO()
+        pdf.save(buffer)
+
+    assert OcrService(logger).prescan(buffer) == [PageScan(has_text=False, has_images=False, has_paths=True)]
+
+def test_ocr_skipped_for_searchable_document(monkeypatch):
+    monkeypatch.setattr(ocrservice.ocrmypdf, "ocr", lambda *args, **kwargs: pytest.fail("OCRmyPDF must not run"))
+    pages = OcrService(logger).ocr_text(f"{testdata}/document-already-processed.pdf", "document.pdf", None)
+    assert pages == ["This document has already been\n\nprocessed via OCR\n\n"]
+
+@pytest.mark.parametrize("ocrmypdf_parameters, option, value", [
+    (None, "skip_text", True),
+    ("--rotate-pages", "rotate_pages", True),
+    ("--title Report", "title", "Report"),
+])
+def test_ocrmypdf_runs_for_searchable_document(monkeypatch, tmp_path, ocrmypdf_parameters, option, value):
+    calls = []
+
+    def ocr(input_file, output_file, **kwargs):
+        calls.append(kwargs)
+        shutil.copyfile(input_file, output_file)
+        kwargs["sidecar"].write(b"[OCR skipped on page(s) 1]")
+        return 0
+
+    monkeypatch.setattr(ocrservice.ocrmypdf, "ocr", ocr)
+    output_path = str(tmp_path / "output.pdf")
+    # The output PDF is produced by OCRmyPDF (e.g. converted to PDF/A), only Tesseract is skipped
+    output = OcrService(logger).ocr_to_file(f"{testdata}/document-already-processed.pdf", "document.pdf", ocrmypdf_parameters, output_path)
+    assert calls[0][option] == value and calls[0]["skip_text"]
+    assert output.recognized_text == "This document has already been\n\nprocessed via OCR\n\n"
+
+@pytest.mark.parametrize("ocrmypdf_parameters, jobs", [(None, 2), ("--jobs 1", 1), ("--jobs 8", 2)])
+def test_jobs_capped_by_worker_budget(monkeypatch, ocrmypdf_parameters, jobs):
+    calls = []
+
+    def ocr(input_file, output_file, **kwargs):
+        calls.append(kwargs)
+        return 0
+
+    monkeypatch.setattr(ocrservice.ocrmypdf, "ocr", ocr)
+    OcrService(logger).ocr_text(f"{testdata}/document-image.jpg", "document.jpg", ocrmypdf_parameters, jobs=2)
+    assert calls[0]["jobs"] == jobs
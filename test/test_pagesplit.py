@@ -0,0 +1,148 @@
+import asyncio
+import logging
+import shutil
+
+import pikepdf
+
+from workflow_ocr_backend import worker
+from workflow_ocr_backend.ocrplugin import ProgressEvent
+from workflow_ocr_backend.ocrservice import OcrOutput, OcrService
+from workflow_ocr_backend.pagesplit import PageSplitter
+from workflow_ocr_backend.scheduler import OcrScheduler
+from workflow_ocr_backend.settings import Settings
+
+logger = logging.getLogger(__name__)
+
+def create_pdf(path, pages: int) -> str:
+    with pikepdf.new() as pdf:
+        for page in range(1, pages + 1):
+            # Page widths identify the pages after splitting and merging
+            pdf.add_blank_page(page_size=(100 + page, 100))
+        pdf.save(path)
+    return str(path)
+
+def page_widths(path: str) -> list[int]:
+    with pikepdf.open(path) as pdf:
+        return [int(page.mediabox[2]) - 100 for page in pdf.pages]
+
+class FakeChunkExecutor:
+    """
+    Copies the chunks instead of processing them, recognized text is the list of page widths.
+    """
+
+    def __init__(self, tmp_path):
+        self.tmp_path = tmp_path
+        self.chunks = 0
+
+    async def submit(self, chunk_path, file_name, ocrmypdf_parameters, output_dir, on_event, owner, memory):
+        self.chunks += 1
+        output_path = str(self.tmp_path / f"output-{self.chunks}.pdf")
+        shutil.copy(chunk_path, output_path)
+        widths = page_widths(output_path)
+        on_event(ProgressEvent("OCR", "page", len(widths), len(widths)))
+        return OcrOutput(file_name, "application/pdf", "\f".join(str(width) for width in widths), output_path)
+
+def test_split_and_merge_pdfs(tmp_path):
+    service = OcrService(logger)
+    source = create_pdf(tmp_path / "source.pdf", 5)
+    assert service.page_count(source) == 5
+
+    chunk_paths = service.split_pages(source, 2, str(tmp_path))
+    assert [page_widths(path) for path in chunk_paths] == [[1, 2], [3, 4], [5]]
+
+    service.merge_pdfs(chunk_paths, str(tmp_path / "merged.pdf"))
+    assert page_widths(str(tmp_path / "merged.pdf")) == [1, 2, 3, 4, 5]
+
+def test_merge_shifts_skipped_pages(tmp_path):
+    chunks = [OcrOutput("source.pdf", "application/pdf", text, create_pdf(tmp_path / f"chunk-{index}.pdf", 2))
+              for index, text in enumerate(["[OCR skipped on page(s) 1-2]", "A\f[OCR skipped on page(s) 2]", "[OCR skipped on page(s) 1]\fB"])]
+    output = worker.merge("task", chunks, "source.pdf", str(tmp_path))
+    assert output.recognized_text == "[OCR skipped on page(s) 1-2]\fA\f[OCR skipped on page(s) 4]\f[OCR skipped on page(s) 5]\fB"
+
+def create_pdfa(path, pages: int) -> str:
+    create_pdf(path, pages)
+    with pikepdf.open(path, allow_overwriting_input=True) as pdf:
+        with pdf.open_metadata() as metadata:
+            metadata["pdfaid:part"] = "2"
+            metadata["pdfaid:conformance"] = "B"
+        pdf.Root.OutputIntents = pdf.make_indirect(pikepdf.Array([pikepdf.Dictionary(S=pikepdf.Name.GTS_PDFA1)]))
+        pdf.save(path)
+    return str(path)
+
+def test_merge_claims_pdfa_of_all_chunks_only(tmp_path):
+    service = OcrService(logger)
+    pdfa_chunks = [create_pdfa(tmp_path / "chunk-1.pdf", 2), create_pdfa(tmp_path / "chunk-2.pdf", 2)]
+    service.merge_pdfs(pdfa_chunks, str(tmp_path / "pdfa.pdf"))
+    service.merge_pdfs([pdfa_chunks[0], create_pdf(tmp_path / "unchanged.pdf", 2)], str(tmp_path / "mixed.pdf"))
+    with pikepdf.open(tmp_path / "pdfa.pdf") as pdfa, pikepdf.open(tmp_path / "mixed.pdf") as mixed:
+        assert pdfa.open_metadata().pdfa_status == "2B"
+        assert "/OutputIntents" in pdfa.Root
+        assert mixed.open_metadata().pdfa_status == ""
+        assert "/OutputIntents" not in mixed.Root
+
+def test_page_count_of_non_pdf(tmp_path):
+    (tmp_path / "image.png").write_bytes(b"\x89PNG")
+    assert OcrService(logger).page_count(str(tmp_path / "image.png")) is None
+
+def test_page_splitter(tmp_path):
+    settings = Settings(ocr_workers=1, ocr_split_pages=2, ocr_scratch_dir=str(tmp_path))
+    source = create_pdf(tmp_path / "source.pdf", 5)
+    executor = FakeChunkExecutor(tmp_path)
+    events: list[ProgressEvent] = []
+
+    async def run():
+        scheduler = OcrScheduler(settings, logger)
+        scheduler.start()
+        try:
+            splitter = PageSplitter(settings, scheduler, executor, logger)
+            assert await splitter.should_split(source, None)
+            assert not await splitter.should_split(source, "--pages 1-3")
+            assert not await splitter.should_split(create_pdf(tmp_path / "small.pdf", 2), None)
+            return await splitter.submit(source, "source.pdf", None, on_event=events.append)
+        finally:
+            scheduler.shutdown()
+    output = asyncio.run(run())
+
+    assert executor.chunks == 3
+    assert page_widths(output.file_path) == [1, 2, 3, 4, 5]
+    assert output.recognized_text == "1\f2\f3\f4\f5"
+    assert events[-1] == ProgressEvent("OCR", "page", 5, 5)
+    # Chunks and their outputs are deleted after merging
+    assert sorted(path.name for path in tmp_path.iterdir()) == sorted(["source.pdf", "small.pdf", output.file_path.split("/")[-1]])
+
+def test_pdf_with_outlines_not_split(tmp_path):
+    source = create_pdf(tmp_path / "source.pdf", 5)
+    with pikepdf.open(source, allow_overwriting_input=True) as pdf:
+        with pdf.open_outline() as outline:
+            outline.root.append(pikepdf.OutlineItem("Chapter", 2))
+        pdf.save(source)
+    settings = Settings(ocr_workers=1, ocr_split_pages=2, ocr_scratch_dir=str(tmp_path))
+    splitter = PageSplitter(settings, OcrScheduler(settings, logger), FakeChunkExecutor(tmp_path), logger)
+    # Bookmarks refer to the pages of the document, they would be lost by merging
+    assert not asyncio.run(splitter.should_split(source, None))
+
+def test_page_splitter_cancelled_during_split(tmp_path):
+    settings = Settings(ocr_workers=1, ocr_split_pages=2, ocr_scratch_dir=str(tmp_path / "scratch"))
+    (tmp_path / "scratch").mkdir()
+    source = create_pdf(tmp_path / "source.pdf", 5)
+
+    async def run():
+        scheduler = OcrScheduler(settings, logger)
+        scheduler.start()
+        try:
+            splitter = PageSplitter(settings, scheduler, FakeChunkExecutor(tmp_path), logger)
+            output = splitter.submit(source, "source.pdf", None)
+            while not scheduler._running:
+                await asyncio.sleep(0.001)
+            output.cancel()
+            await asyncio.gather(output, return_exceptions=True)
+            # The split finishes in the worker, afterwards its chunks are deleted
+            for _ in range(200):
+                if not scheduler._pending and not any((tmp_path / "scratch").iterdir()):
+                    break
+                await asyncio.sleep(0.05)
+        finally:
+            scheduler.shutdown()
+    asyncio.run(run())
+
+    assert list((tmp_path / "scratch").iterdir()) == []
@@ -0,0 +1,72 @@
+import pytest
+
+from workflow_ocr_backend.exceptions import InvalidParametersError
+from workflow_ocr_backend.parameters import ParameterProfiles, check_output, format_parameters, merge_parameters, parse_parameters
+
+
+@pytest.mark.parametrize("ocrmypdf_parameters, expected", [
+    (None, {}),
+    ("", {}),
+    ("--language eng+deu --skip-text", {"language": ("eng", "deu"), "skip-text": True}),
+    ("-l eng -l deu -s", {"language": ("eng", "deu"), "skip-text": True}),
+    ("--jobs 4 --pages 1-3 --tesseract-pagesegmode 7", {"jobs": 4, "pages": "1-3", "tesseract-pagesegmode": 7}),
+    ("--max-ocr-dpi 0 --downsample-output", {"max-ocr-dpi": 0, "downsample-output": True}),
+    ("--title 'Annual report'", {"title": "Annual report"}),
+    ("--no-use-threads --no-progress-bar", {"no-use-threads": True, "no-progress-bar": True}),
+    ("--no-tesseract-downsample-large-images", {"no-tesseract-downsample-large-images": True}),
+])
+def test_parse_parameters(ocrmypdf_parameters, expected):
+    parsed = parse_parameters(ocrmypdf_parameters)
+    assert parsed == expected
+    assert parse_parameters(format_parameters(parsed)) == parsed
+
+@pytest.mark.parametrize("ocrmypdf_parameters, message", [
+    ("--unknown", "unrecognized arguments: --unknown"),
+    ("--jobs many", "invalid int value: 'many'"),
+    ("--max-ocr-dpi -1", "'-1' not in valid range"),
+    ("--language", "expected one argument"),
+    ("--title 'Annual report", "No closing quotation"),
+    ("--force-ocr --skip-text", "Choose only one of --force-ocr, --skip-text, --redo-ocr"),
+    ("--rotate-pages-threshold 5", "--rotate-pages is required for --rotate-pages-threshold"),
+    ("--sidecar /etc/passwd", "--sidecar can't be set by requests"),
+    ("--plugin=evil", "--plugin=evil can't be set by requests"),
+    ("--keep-temp", "unrecognized arguments: --keep-temp"),
+])
+def test_invalid_parameters(ocrmypdf_parameters, message):
+    with pytest.raises(InvalidParametersError) as exc_info:
+        parse_parameters(ocrmypdf_parameters)
+    assert message in str(exc_info.value)
+    assert exc_info.value.status_code == 400
+
+def test_check_output():
+    check_output("--output-type none", produces_pdf=False)
+    check_output("--output-type pdfa-2", produces_pdf=True)
+    check_output(None, produces_pdf=True)
+    with pytest.raises(InvalidParametersError, match="--output-type none produces no PDF") as exc_info:
+        check_output("--output-type none", produces_pdf=True)
+    assert exc_info.value.status_code == 400
+
+def test_merge_parameters():
+    assert merge_parameters("--language eng --skip-text --optimize 1", "--optimize 3 -l deu") == "--language deu --skip-text --optimize 3"
+    assert merge_parameters("--skip-text", None) == "--skip-text"
+
+def test_profiles():
+    profiles = ParameterProfiles.from_json('{"fast-text": "-l eng -s --tesseract-pagesegmode 6", "archive-pdfa": "--output-type pdfa-2 --optimize 3"}')
+    assert list(profiles) == ["fast-text", "archive-pdfa"]
+    assert profiles.parameters()["fast-text"] == "--language eng --skip-text --tesseract-pagesegmode 6"
+    assert profiles.resolve("fast-text", "--language eng+deu") == "--language eng --language deu --skip-text --tesseract-pagesegmode 6"
+    assert profiles.resolve(None, "-s -l eng") == "--language eng --skip-text"
+    assert profiles.resolve(None, None) is None
+    with pytest.raises(InvalidParametersError, match="Unknown OCR profile: receipts"):
+        profiles.resolve("receipts", None)
+    with pytest.raises(InvalidParametersError, match="Choose only one"):
+        profiles.resolve("fast-text", "--force-ocr")
+
+@pytest.mark.parametrize("profiles, message", [
+    ('{"broken": "--unknown"}', "Invalid OCR profile broken"),
+    ('["--skip-text"]', "expected a JSON object"),
+    ('{"fast-text": ', "Invalid OCR profiles"),
+])
+def test_invalid_profiles(profiles, message):
+    with pytest.raises(ValueError, match=message):
+        ParameterProfiles.from_json(profiles)
@@ -0,0 +1,51 @@
+import base64
+import email
+import os
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from workflow_ocr_backend.ocrservice import OcrOutput
+from workflow_ocr_backend.responses import BASE64_CHUNK_SIZE, json_response, multipart_response
+
+def parse_multipart(content_type: str, body: bytes) -> list[email.message.Message]:
+    message = email.message_from_bytes(f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+    assert message.is_multipart()
+    return message.get_payload()
+
+def test_multipart_response(tmp_path):
+    pdf_path = tmp_path / "output.pdf"
+    pdf_path.write_bytes(b"%PDF-1.7 dummy")
+    app = FastAPI()
+    app.get("/")(lambda: multipart_response(OcrOutput("input.pdf", "application/pdf", "Hällo\n", str(pdf_path))))
+
+    with TestClient(app) as client:
+        response = client.get("/")
+
+    assert response.status_code == 200
+    text_part, file_part = parse_multipart(response.headers["content-type"], response.content)
+    assert text_part.get_content_type() == "text/plain"
+    assert text_part.get_payload(decode=True).decode("utf-8") == "Hällo\n"
+    assert file_part.get_content_type() == "application/pdf"
+    assert file_part.get_filename() == "input.pdf"
+    assert file_part.get_payload(decode=True) == b"%PDF-1.7 dummy"
+    assert not os.path.exists(pdf_path)
+
+def test_json_response(tmp_path):
+    content = os.urandom(BASE64_CHUNK_SIZE * 2 + 1)
+    pdf_path = tmp_path / "output.pdf"
+    pdf_path.write_bytes(content)
+    app = FastAPI()
+    app.get("/")(lambda: json_response(OcrOutput("input.pdf", "application/pdf", "Text \"quoted\"\n", str(pdf_path)), delete=False))
+
+    with TestClient(app) as client:
+        response = client.get("/")
+
+    assert response.status_code == 200
+    assert response.json() == {
+        "filename": "input.pdf",
+        "contentType": "application/pdf",
+        "recognizedText": "Text \"quoted\"\n",
+        "fileContent": base64.b64encode(content).decode()
+    }
+    assert os.path.exists(pdf_path)
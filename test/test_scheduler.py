@@ -0,0 +1,217 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import subprocess
+import time
+
+import pytest
+
+from workflow_ocr_backend import ocrplugin, tracing
+from workflow_ocr_backend.exceptions import QueueFullError, WorkerCrashedError
+from workflow_ocr_backend.ocrplugin import ProgressEvent
+from workflow_ocr_backend.scheduler import OcrScheduler
+from workflow_ocr_backend.settings import Settings
+from workflow_ocr_backend.worker import cancellable, task_events
+
+logger = logging.getLogger(__name__)
+
+# Functions below are executed inside of the worker processes
+
+def _get_pid(_: str) -> int:
+    return os.getpid()
+
+def _sleep(_: str, seconds: float):
+    time.sleep(seconds)
+
+def _kill_worker(_: str):
+    os.kill(os.getpid(), signal.SIGKILL)
+
+def _get_pid_after(_: str, seconds: float) -> int:
+    time.sleep(seconds)
+    return os.getpid()
+
+def _report_pages(task_id: str, pages: int) -> str:
+    with task_events(task_id):
+        with ocrplugin.ProgressReporter(total=pages, desc="OCR", unit="page") as progress:
+            for _ in range(pages):
+                progress.update()
+    return "done"
+
+def _run_child_process(task_id: str, pid_file: str) -> int:
+    with cancellable(task_id):
+        child = subprocess.Popen(["sleep", "60"])
+        with open(pid_file, "w") as file:
+            file.write(str(child.pid))
+        return child.wait()
+
+def _run_with_scheduler(settings: Settings, fn):
+    async def run():
+        scheduler = OcrScheduler(settings, logger)
+        scheduler.start()
+        try:
+            return await fn(scheduler)
+        finally:
+            scheduler.shutdown()
+    return asyncio.run(run())
+
+def test_run_in_worker_process():
+    pid = _run_with_scheduler(Settings(ocr_workers=1), lambda scheduler: scheduler.run(_get_pid))
+    assert pid != os.getpid()
+
+def test_queue_full():
+    async def run(scheduler: OcrScheduler):
+        running = scheduler.submit(_sleep, 1)
+        await asyncio.sleep(0)
+        assert scheduler.in_flight == 1
+        with pytest.raises(QueueFullError) as exc_info:
+            scheduler.submit(_sleep, 0)
+        await running
+        return exc_info.value
+    error = _run_with_scheduler(Settings(ocr_workers=1, ocr_queue_size=0, ocr_retry_after=42), run)
+    assert error.status_code == 503
+    assert error.headers["Retry-After"] == "42"
+
+def test_progress_events_delivered_before_result():
+    events: list[ProgressEvent] = []
+    result = _run_with_scheduler(Settings(ocr_workers=1), lambda scheduler: scheduler.run(_report_pages, 3, on_event=events.append))
+    assert result == "done"
+    assert events[0].stage == "Started"
+    assert [event.completed for event in events[1:]] == [0, 1, 2, 3]
+    assert all(event.total == 3 for event in events[1:])
+
+def test_jobs_per_worker():
+    assert Settings(ocr_workers=2, ocr_jobs_per_worker=3).jobs_per_worker == 3
+    assert Settings(ocr_workers=os.cpu_count() * 2).jobs_per_worker == 1
+
+def test_workers_started_and_recycled():
+    async def run(scheduler: OcrScheduler):
+        first = await scheduler.run(_get_pid)
+        second = await scheduler.run(_get_pid)
+        return first, second
+    # Every worker exits after a single task
+    first, second = _run_with_scheduler(Settings(ocr_workers=1, ocr_worker_max_tasks=1), run)
+    assert first != second
+
+def test_workers_started_without_tasks():
+    async def run(scheduler: OcrScheduler):
+        # The worker is started before any task is submitted
+        while not scheduler.worker_pids:
+            await asyncio.sleep(0.05)
+        started = scheduler.worker_pids
+        return started, [await scheduler.run(_get_pid) for _ in range(3)]
+    # Starting the workers must not count towards the max. tasks of a worker
+    started, pids = _run_with_scheduler(Settings(ocr_workers=1, ocr_worker_max_tasks=2), run)
+    assert pids[0] == pids[1] == started[0]
+    assert pids[2] != pids[1]
+
+def test_worker_replaced_alone():
+    async def run(scheduler: OcrScheduler):
+        while len(scheduler.worker_pids) < 2:
+            await asyncio.sleep(0.05)
+        running = scheduler.submit(_get_pid_after, 3)
+        await asyncio.sleep(0.1)
+        # The other worker is replaced after its second task, the one running the first task isn't affected
+        pids = [await scheduler.run(_get_pid) for _ in range(3)]
+        assert len(multiprocessing.active_children()) <= 2
+        assert not running.done()
+        return pids, await running, scheduler.worker_pids
+    pids, running, worker_pids = _run_with_scheduler(Settings(ocr_workers=2, ocr_worker_max_tasks=2), run)
+    assert pids[0] == pids[1] != pids[2]
+    assert running not in pids
+    assert running in worker_pids
+
+def test_worker_crash_fails_only_its_task():
+    async def run(scheduler: OcrScheduler):
+        while len(scheduler.worker_pids) < 2:
+            await asyncio.sleep(0.05)
+        running = scheduler.submit(_get_pid_after, 2)
+        await asyncio.sleep(0.1)
+        with pytest.raises(WorkerCrashedError):
+            await scheduler.run(_kill_worker)
+        # A worker terminating while it's idle is replaced as well
+        idle = await scheduler.run(_get_pid)
+        os.kill(idle, signal.SIGKILL)
+        await asyncio.sleep(0.5)
+        # The task running in the other worker isn't affected
+        running_pid = await running
+        return running_pid, await scheduler.run(_get_pid), idle, scheduler.worker_pids
+    running, after_crash, idle, pids = _run_with_scheduler(Settings(ocr_workers=2), run)
+    assert after_crash != idle
+    assert running in pids and idle not in pids
+
+def test_task_waiting_for_memory_keeps_no_worker():
+    async def run(scheduler: OcrScheduler):
+        # Wait until both workers are up
+        await asyncio.gather(scheduler.run(_sleep, 0.1), scheduler.run(_sleep, 0.1))
+        running = scheduler.submit(_sleep, 2, memory=60)
+        await asyncio.sleep(0.1)
+        oversized = scheduler.submit(_sleep, 0, memory=80)
+        await asyncio.sleep(0.1)
+        # The second worker is free while the oversized task waits for memory
+        small = await asyncio.wait_for(scheduler.run(_get_pid), 1.5)
+        assert not running.done() and not oversized.done()
+        await asyncio.gather(running, oversized)
+        return small
+    assert _run_with_scheduler(Settings(ocr_workers=2, ocr_memory_budget=100), run)
+
+def test_worker_replaced_on_memory_limit():
+    async def run(scheduler: OcrScheduler):
+        first = await scheduler.run(_get_pid)
+        # The replacement is only started once the worker exited
+        assert len(multiprocessing.active_children()) <= 1
+        return first, await scheduler.run(_get_pid)
+    first, second = _run_with_scheduler(Settings(ocr_workers=1, ocr_worker_max_memory=1), run)
+    assert first != second
+
+def test_cancel_running_task(tmp_path):
+    pid_file = tmp_path / "child.pid"
+
+    async def run(scheduler: OcrScheduler):
+        running = scheduler.submit(_run_child_process, str(pid_file))
+        while not pid_file.exists() or not pid_file.read_text():
+            await asyncio.sleep(0.05)
+        started_at = time.monotonic()
+        running.cancel()
+        # The only worker is available again as soon as the child process was killed
+        await scheduler.run(_get_pid)
+        return time.monotonic() - started_at
+    duration = _run_with_scheduler(Settings(ocr_workers=1), run)
+    assert duration < 10
+    with pytest.raises(ProcessLookupError):
+        os.kill(int(pid_file.read_text()), 0)
+
+class _CollectingExporter:
+    def __init__(self):
+        self.spans: list[tracing.Span] = []
+
+    def export(self, spans: list[tracing.Span]):
+        self.spans.extend(spans)
+
+def test_traced_task(monkeypatch, tmp_path):
+    exporter = _CollectingExporter()
+    monkeypatch.setattr(tracing, "_exporter", exporter)
+    monkeypatch.setattr(tracing, "_profile_dir", str(tmp_path))
+    trace = tracing.Trace("0" * 32, profile=True)
+    trace.root = tracing.Span(trace, "request", None)
+
+    async def run(scheduler: OcrScheduler):
+        token = tracing._current.set(trace.root)
+        try:
+            return await scheduler.run(_report_pages, 2)
+        finally:
+            tracing._current.reset(token)
+    assert _run_with_scheduler(Settings(ocr_workers=1), run) == "done"
+    trace.root.end()
+
+    spans = {span.name: span for span in exporter.spans}
+    assert spans["queue"].parent_id == trace.root.span_id
+    task_span = spans["_report_pages"]
+    assert task_span.parent_id == trace.root.span_id
+    # Timings reported by the worker
+    assert spans["OCR"].parent_id == task_span.span_id
+    assert spans[ocrplugin.TASK_STAGE].parent_id == task_span.span_id
+    assert "cpu.self_seconds" in spans[ocrplugin.TASK_STAGE].attributes
+    assert spans[ocrplugin.TASK_STAGE].start <= spans["OCR"].start <= spans["OCR"].end_time <= spans[ocrplugin.TASK_STAGE].end_time
+    assert (tmp_path / trace.trace_id / f"{task_span.attributes['task_id']}.folded").exists()
@@ -0,0 +1,25 @@
+import asyncio
+import io
+import os
+
+from fastapi import UploadFile
+
+from workflow_ocr_backend.settings import Settings
+from workflow_ocr_backend.spooling import discard, is_spooled, spool_upload
+
+def test_small_upload_stays_in_memory(tmp_path):
+    upload = UploadFile(io.BytesIO(b"small"), size=5, filename="small.pdf")
+    source = asyncio.run(spool_upload(upload, Settings(ocr_scratch_dir=str(tmp_path), ocr_spool_threshold=5)))
+    assert source == b"small"
+    assert not is_spooled(source)
+    assert os.listdir(tmp_path) == []
+
+def test_large_upload_is_spooled(tmp_path):
+    upload = UploadFile(io.BytesIO(b"large"), size=5, filename="large.pdf")
+    source = asyncio.run(spool_upload(upload, Settings(ocr_scratch_dir=str(tmp_path), ocr_spool_threshold=4)))
+    assert is_spooled(source)
+    assert os.path.dirname(source) == str(tmp_path)
+    with open(source, "rb") as file:
+        assert file.read() == b"large"
+    discard(source)
+    assert not os.path.exists(source)
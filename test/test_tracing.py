@@ -0,0 +1,140 @@
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import logging
+import threading
+import time
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+import pytest
+
+from workflow_ocr_backend import tracing
+from workflow_ocr_backend.profiling import SamplingProfiler
+from workflow_ocr_backend.settings import Settings
+
+logger = logging.getLogger(__name__)
+
+PARENT_TRACE_ID = "4bf92f3577b34da6a3ce929d0e0e4736"
+PARENT_SPAN_ID = "00f067aa0ba902b7"
+
+
+def _create_app() -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/documents/{name}")
+    async def document(name: str):
+        with tracing.span("work", document=name):
+            pass
+        return {"profile": tracing.profile_path("task")}
+
+    app.add_middleware(tracing.TraceMiddleware)
+
+    @app.middleware("http")
+    async def authenticate(request, call_next):
+        # Like AppAPIAuthMiddleware
+        request.scope["username"] = request.headers.get("user", "")
+        return await call_next(request)
+
+    return app
+
+@pytest.fixture
+def configure():
+    def configure(**settings):
+        tracing.configure(Settings(**settings), logger)
+    yield configure
+    tracing.configure(Settings(), logger)
+
+def _read_spans(path) -> list[dict]:
+    tracing.shutdown()
+    with open(path) as file:
+        return [span for line in file for resource in json.loads(line)["resourceSpans"]
+                for scope in resource["scopeSpans"] for span in scope["spans"]]
+
+def test_untraced_by_default(configure):
+    configure()
+    with TestClient(_create_app()) as client:
+        response = client.get("/documents/a.pdf")
+    assert response.status_code == 200
+    assert tracing.TRACE_ID_HEADER not in response.headers
+    assert tracing.current() is None
+
+def test_trace_exported_to_file(configure, tmp_path):
+    trace_file = tmp_path / "traces.jsonl"
+    configure(ocr_trace_file=str(trace_file))
+    with TestClient(_create_app()) as client:
+        response = client.get("/documents/a.pdf", headers={"traceparent": f"00-{PARENT_TRACE_ID}-{PARENT_SPAN_ID}-01"})
+    assert response.headers[tracing.TRACE_ID_HEADER] == PARENT_TRACE_ID
+
+    spans = {span["name"]: span for span in _read_spans(trace_file)}
+    root = spans["GET /documents/{name}"]
+    assert root["traceId"] == PARENT_TRACE_ID and root["parentSpanId"] == PARENT_SPAN_ID
+    assert {"key": "http.response.status_code", "value": {"intValue": "200"}} in root["attributes"]
+    work = spans["work"]
+    assert work["parentSpanId"] == root["spanId"]
+    assert work["attributes"] == [{"key": "document", "value": {"stringValue": "a.pdf"}}]
+    assert int(root["startTimeUnixNano"]) <= int(work["startTimeUnixNano"]) <= int(work["endTimeUnixNano"]) <= int(root["endTimeUnixNano"])
+
+def test_trace_exported_to_endpoint(configure):
+    received = []
+
+    class Collector(BaseHTTPRequestHandler):
+        def do_POST(self):
+            received.append((self.path, self.headers["Content-Type"], json.loads(self.rfile.read(int(self.headers["Content-Length"])))))
+            self.send_response(200)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    with HTTPServer(("127.0.0.1", 0), Collector) as server:
+        threading.Thread(target=server.handle_request, daemon=True).start()
+        configure(ocr_trace_endpoint=f"http://127.0.0.1:{server.server_port}/v1/traces")
+        with TestClient(_create_app()) as client:
+            client.get("/documents/a.pdf")
+        tracing.shutdown()
+    path, content_type, payload = received[0]
+    assert (path, content_type) == ("/v1/traces", "application/json")
+    assert [span["name"] for span in payload["resourceSpans"][0]["scopeSpans"][0]["spans"]] == ["work", "GET /documents/{name}"]
+
+def test_profile_only_for_profile_users(configure, tmp_path):
+    configure(ocr_profile_dir=str(tmp_path), ocr_profile_users="admin, ops")
+    with TestClient(_create_app()) as client:
+        profiled = client.get("/documents/a.pdf", headers={"user": "admin", tracing.PROFILE_HEADER: "true"})
+        denied = client.get("/documents/a.pdf", headers={"user": "alice", tracing.PROFILE_HEADER: "true"})
+        not_requested = client.get("/documents/a.pdf", headers={"user": "admin"})
+    trace_id = profiled.headers[tracing.TRACE_ID_HEADER]
+    assert profiled.json()["profile"] == str(tmp_path / trace_id / "task.folded")
+    assert denied.json()["profile"] is None and tracing.TRACE_ID_HEADER not in denied.headers
+    assert not_requested.json()["profile"] is None
+
+def test_failed_span():
+    trace = tracing.Trace("0" * 32)
+    trace.root = tracing.Span(trace, "request", None)
+    token = tracing._current.set(trace.root)
+    try:
+        with pytest.raises(ValueError):
+            with tracing.span("work"):
+                raise ValueError("broken")
+    finally:
+        tracing._current.reset(token)
+    assert trace._spans[0].to_otlp()["status"] == {"code": 2, "message": "ValueError: broken"}
+
+def _busy_wait(stop: threading.Event):
+    while not stop.is_set():
+        time.sleep(0.001)
+
+def test_sampling_profiler(tmp_path):
+    stop = threading.Event()
+    thread = threading.Thread(target=_busy_wait, args=(stop,), name="busy")
+    thread.start()
+    try:
+        with SamplingProfiler(interval=0.001) as profiler:
+            time.sleep(0.1)
+    finally:
+        stop.set()
+        thread.join()
+    profiler.write(str(tmp_path / "profiles" / "task.folded"))
+    lines = (tmp_path / "profiles" / "task.folded").read_text().splitlines()
+    stack, count = lines[0].rsplit(" ", 1)
+    assert int(count) > 0
+    assert any(line.startswith("busy;") and "_busy_wait (test_tracing.py:" in line for line in lines)
@@ -0,0 +1,145 @@
+import asyncio
+from collections import deque
+from dataclasses import dataclass
+import io
+from logging import Logger
+import os
+
+from starlette.concurrency import run_in_threadpool
+
+from .exceptions import DocumentTooLargeError
+from .ocrservice import DocumentInfo, OcrService
+from .settings import Settings
+from .spooling import Source, is_spooled
+
+# Rough memory model of a single OCR run, see estimate_memory
+_BASE_MEMORY = 128 * 1024 * 1024  # OCRmyPDF pipeline, independent of the document
+_MEMORY_PER_JOB = 64 * 1024 * 1024  # Tesseract process including its language models
+_BYTES_PER_PIXEL = 16  # Rasterized page, its preprocessed copies and Tesseract's internal images
+_MIB = 1024 * 1024
+
+
+@dataclass
+class DocumentCost:
+    """
+    Estimated cost of the OCR of a document: its peak memory and, as a measure of the CPU time,
+    the number of pixels passed to Tesseract.
+    """
+    pages: int
+    megapixels: float
+    memory_bytes: int
+
+
+def estimate_memory(info: DocumentInfo | None, file_size: int, jobs: int) -> int:
+    """
+    Estimates the peak memory of an OCR run: up to `jobs` pages of the document are rasterized
+    and recognized at the same time, the document itself is held in memory (at least) twice.
+    """
+    if info is None:
+        return _BASE_MEMORY + 2 * file_size
+    concurrent_pages = max(1, min(info.pages, jobs))
+    return _BASE_MEMORY + 2 * file_size + concurrent_pages * (_MEMORY_PER_JOB + info.max_page_pixels * _BYTES_PER_PIXEL)
+
+
+class AdmissionControl:
+    """
+    Inspects documents before they are scheduled (page count, image sizes, file size, see OcrService.inspect)
+    and estimates their cost. Documents which exceed `ocr_max_megapixels` or could never fit into
+    `ocr_memory_budget` are rejected with a DocumentTooLargeError, all others wait in the scheduler
+    until their estimated memory fits into the budget (see MemoryBudget).
+    """
+
+    def __init__(self, settings: Settings, logger: Logger):
+        self.settings = settings
+        self.logger = logger
+
+    @property
+    def enabled(self) -> bool:
+        return self.settings.ocr_memory_budget > 0 or self.settings.ocr_max_megapixels > 0
+
+    async def admit(self, source: Source, file_name: str) -> DocumentCost | None:
+        """
+        Returns the estimated cost of the given document (None if admission control is disabled)
+        or raises a DocumentTooLargeError.
+        """
+        if not self.enabled:
+            return None
+        cost = await run_in_threadpool(self._estimate, source)
+        self.logger.debug(f"Estimated cost of {file_name}: {cost}")
+        max_megapixels = self.settings.ocr_max_megapixels
+        if max_megapixels > 0 and cost.megapixels > max_megapixels:
+            raise DocumentTooLargeError(f"Document has {cost.megapixels:.0f} megapixels to recognize, at most {max_megapixels} are allowed")
+        budget = self.settings.ocr_memory_budget
+        if budget > 0 and cost.memory_bytes > budget:
+            raise DocumentTooLargeError(
+                f"Document needs an estimated {cost.memory_bytes // _MIB} MiB of memory, more than the budget of {budget // _MIB} MiB")
+        return cost
+
+    def _estimate(self, source: Source) -> DocumentCost:
+        service = OcrService(self.logger)
+        if is_spooled(source):
+            info = service.inspect(source)
+            file_size = os.path.getsize(source)
+        else:
+            with io.BytesIO(source) as file:
+                info = service.inspect(file)
+            file_size = len(source)
+        memory = estimate_memory(info, file_size, self.settings.jobs_per_worker)
+        if info is None:
+            return DocumentCost(pages=0, megapixels=0, memory_bytes=memory)
+        return DocumentCost(pages=info.pages, megapixels=info.total_pixels / 1_000_000, memory_bytes=memory)
+
+
+class MemoryBudget:
+    """
+    Reserves the estimated memory of running tasks, so that their sum stays within `limit` bytes (0 = unlimited).
+    Waiting tasks are served in FIFO order, so large documents are not starved by a stream of small ones.
+    Tasks without estimated memory (e.g. splitting and merging of documents) never wait.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.reserved = 0
+        self._waiters: deque[tuple[int, asyncio.Future]] = deque()
+
+    async def acquire(self, amount: int):
+        amount = self._clamp(amount)
+        if self.limit <= 0 or amount == 0:
+            return
+        if not self._waiters and self.reserved + amount <= self.limit:
+            self.reserved += amount
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append((amount, waiter))
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The memory was reserved right before the cancellation
+                self.release(amount)
+            else:
+                self._waiters.remove((amount, waiter))
+                self._wake()
+            raise
+
+    def release(self, amount: int):
+        if self.limit <= 0:
+            return
+        self.reserved -= self._clamp(amount)
+        self._wake()
+
+    def _clamp(self, amount: int) -> int:
+        # Follow-up tasks of admitted documents are never rejected, so they must not wait forever
+        return min(amount, self.limit) if self.limit > 0 else amount
+
+    def _wake(self):
+        while self._waiters:
+            amount, waiter = self._waiters[0]
+            if waiter.done():
+                self._waiters.popleft()
+                continue
+            if self.reserved + amount > self.limit:
+                return
+            self._waiters.popleft()
+            self.reserved += amount
+            waiter.set_result(None)
@@ -1,61 +1,689 @@
+import asyncio
+import os
+import time
+import uuid
 from contextlib import asynccontextmanager
-from typing import Iterable
+from typing import AsyncIterator, Awaitable, Callable, Iterable, TypeVar
 
 from fastapi import FastAPI, File, Form, UploadFile, Request
 
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
 from nc_py_api import AsyncNextcloudApp, NextcloudApp
 from nc_py_api.ex_app import AppAPIAuthMiddleware, set_handlers
 import logging
 
 from ocrmypdf import ExitCodeException
 
+from . import metrics, tracing, worker
+from .admission import AdmissionControl
+from .cache import ResultCache
+from .compression import CompressionMiddleware
+from .exceptions import ClientDisconnectedError, DeadlineExceededError, InvalidBatchError, OcrBackendError
+from .fairshare import TaskOwner
+from .jobqueue import DurableJobStore, JobRunner, QueuedJob
+from .jobs import Job, JobStore
+from .languages import LanguageCatalog
+from .model.batchresult import BatchItemResult
+from .model.engineinfo import EngineInfo
+from .model.jobstatus import JobStatus
 from .model.ocrresult import ErrorResult, OcrResult
-from .ocrservice import OcrService
+from .model.ocrstream import OcrPageText, OcrProgress, OcrStreamError
+from .model.priority import Priority
+from .model.textresult import TextResult
+from .ocrplugin import PAGE_STAGES, PAGE_TEXT_STAGE, ProgressEvent
+from .ocrservice import OcrOutput, OcrService
+from .pagesplit import LocalChunkExecutor, PageSplitter
+from .parameters import ParameterProfiles, check_output
+from .responses import MULTIPART_MIXED, NDJSON, accepts_multipart, json_response, multipart_response, ndjson_result
+from .scheduler import EventCallback, OcrScheduler
+from .settings import Settings
+from .spooling import Source, discard, is_spooled, spool_upload
+
+SETTINGS = Settings.from_env()
+
+T = TypeVar("T")
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     set_handlers(app, enabled_handler)
+    tracing.configure(SETTINGS, logger)
+    # Invalid profiles fail the startup instead of every request using them
+    app.state.parameter_profiles = ParameterProfiles.from_json(SETTINGS.ocr_parameter_profiles)
+    app.state.languages = LanguageCatalog(logger)
+    await run_in_threadpool(app.state.languages.refresh)
+    os.makedirs(SETTINGS.scratch_dir, exist_ok=True)
+    app.state.scheduler = OcrScheduler(SETTINGS, logger)
+    app.state.scheduler.start()
+    app.state.admission = AdmissionControl(SETTINGS, logger)
+    app.state.splitter = PageSplitter(SETTINGS, app.state.scheduler, LocalChunkExecutor(app.state.scheduler), logger)
+    app.state.job_runner = None
+    if SETTINGS.ocr_job_queue_dir:
+        app.state.jobs = DurableJobStore(SETTINGS.ocr_job_queue_dir, SETTINGS.ocr_job_ttl, SETTINGS.ocr_job_lease, logger)
+        app.state.job_runner = JobRunner(app.state.jobs, lambda job, on_event: _process_queued_job(app, job, on_event), _job_error,
+                                         SETTINGS.ocr_workers, logger)
+    else:
+        app.state.jobs = JobStore(SETTINGS.ocr_job_ttl)
+    app.state.cache = None
+    if SETTINGS.ocr_cache_dir:
+        app.state.cache = ResultCache(SETTINGS.ocr_cache_dir, SETTINGS.ocr_cache_max_bytes, app.state.languages.engine_version, logger)
+    _register_gauges(app)
+    if app.state.job_runner is not None:
+        app.state.job_runner.start()
     yield
+    if app.state.job_runner is not None:
+        # Running jobs are returned to the queue, so that other replicas take them over
+        await app.state.job_runner.stop()
+    app.state.scheduler.shutdown()
+    if app.state.job_runner is not None:
+        app.state.jobs.close()
+    else:
+        app.state.jobs.clear()
+    tracing.shutdown()
 
 
 APP = FastAPI(lifespan=lifespan)
-APP.add_middleware(AppAPIAuthMiddleware, disable_for=["docs", "openapi.json"])
+# Added first, so that it runs inside of the authentication and knows the user
+APP.add_middleware(tracing.TraceMiddleware)
+APP.add_middleware(AppAPIAuthMiddleware, disable_for=["docs", "openapi.json"] + (["metrics"] if SETTINGS.ocr_metrics_public else []))
+APP.add_middleware(CompressionMiddleware, settings=SETTINGS)
+APP.add_middleware(metrics.RequestCounterMiddleware)
 logger = logging.getLogger('uvicorn.error') # Use same logging as uvicorn
 
+_PRIORITY_DESCRIPTION = "Priority class: interactive requests are always scheduled before bulk requests."
+_DEADLINE_DESCRIPTION = "Seconds after which the OCR (including waiting for a free worker) is cancelled and 504 is returned."
+_PROFILE_DESCRIPTION = "Name of a parameter profile (see /parameter_profiles). \"ocrmypdf_parameters\" are applied on top of the profile."
+_JOB_ID_PATTERN = r"^[A-Za-z0-9_-]{1,64}$"
+# Interval (seconds) in which synchronous requests check whether the client disconnected
+_DISCONNECT_POLL_INTERVAL = 1
+
 
 def enabled_handler(enabled: bool, _: NextcloudApp | AsyncNextcloudApp) -> str:
     # Nothing to do currently ...
     logger.debug(f"App enabled: {enabled}")
     return ""
 
+def to_error_result(exc: Exception) -> tuple[ErrorResult, int]:
+    """
+    Converts an exception into an ErrorResult and the corresponding HTTP status code.
+    """
+    if isinstance(exc, OcrBackendError):
+        return ErrorResult(message=str(exc)), exc.status_code
+    if isinstance(exc, ExitCodeException):
+        return ErrorResult(message=f"{str(exc)} ({exc.__class__.__name__})", ocr_my_pdf_exit_code=exc.exit_code), 500
+    return ErrorResult(message=f"{str(exc)} ({exc.__class__.__name__})"), 500
+
+def _error_response(exc: Exception, headers: dict[str, str] | None = None) -> JSONResponse:
+    error, status_code = to_error_result(exc)
+    metrics.record_error(error, status_code)
+    return JSONResponse(error.model_dump(by_alias=True, exclude_none=True), status_code=status_code, headers=headers)
+
 @APP.exception_handler(ExitCodeException)
 async def exit_code_exception_handler(_: Request, exc: ExitCodeException):
-    return JSONResponse({"message": f"{str(exc)} ({exc.__class__.__name__})", "ocrMyPdfExitCode": exc.exit_code}, status_code=500)
+    return _error_response(exc)
+
+@APP.exception_handler(OcrBackendError)
+async def backend_error_handler(_: Request, exc: OcrBackendError):
+    return _error_response(exc, exc.headers)
 
 @APP.exception_handler(Exception)
 async def exception_handler(_: Request, exc: Exception):
     # Exception will be logged by uvicorn automatically.
     # It will also be turned into an ErrorResult response.
-    return JSONResponse({"message": f"{str(exc)} ({exc.__class__.__name__})"}, status_code=500)
+    return _error_response(exc)
 
 
-@APP.post("/process_ocr", response_model=OcrResult, responses={500: {"model": ErrorResult}})
+@APP.post("/process_ocr", response_model=OcrResult, responses={
+        200: {"content": {MULTIPART_MIXED: {}}, "description": "OcrResult as JSON or, if requested via the Accept header, as multipart/mixed response"},
+        400: {"model": ErrorResult},
+        413: {"model": ErrorResult},
+        500: {"model": ErrorResult},
+        503: {"model": ErrorResult},
+        504: {"model": ErrorResult}})
 async def process_ocr(
+        request: Request,
         file: UploadFile = File(..., description="The file to be processed using OCR."), 
-        ocrmypdf_parameters: str = Form(None, description="Additional parameters for the OCRmyPdf process (see https://ocrmypdf.readthedocs.io/en/latest/cookbook.html#basic-examples).")
+        ocrmypdf_parameters: str = Form(None, description="Additional parameters for the OCRmyPdf process (see https://ocrmypdf.readthedocs.io/en/latest/cookbook.html#basic-examples)."),
+        parameter_profile: str | None = Form(None, description=_PROFILE_DESCRIPTION),
+        priority: Priority = Form(Priority.INTERACTIVE, description=_PRIORITY_DESCRIPTION),
+        deadline: float | None = Form(None, gt=0, description=_DEADLINE_DESCRIPTION)
     ):
     """
     Processes an OCR request.
     This endpoint accepts a file upload and optional OCR parameters to process the file using OCR (Optical Character Recognition).
+    The OCR itself runs in a separate worker process. If all workers are busy and the queue is full, 503 is returned.
+    Documents whose estimated cost exceeds the configured limits are rejected with 413.
+    The OCR is cancelled (including its Tesseract and Ghostscript processes) if the client disconnects or the deadline expires.
+
+    Clients sending "Accept: multipart/mixed" receive the recognized text (text/plain) and the resulting PDF
+    (application/pdf) as separate parts instead of a JSON document with a base64 encoded file.
+    """
+    scheduler: OcrScheduler = request.app.state.scheduler
+    splitter: PageSplitter = request.app.state.splitter
+    ocrmypdf_parameters = await _validate_parameters(request, ocrmypdf_parameters, parameter_profile)
+    source = await _read_upload(file)
+    try:
+        cache_key, output = await _cache_lookup(request.app, source, file.filename, ocrmypdf_parameters)
+        if output is None:
+            memory = await _admit(request, source, file.filename)
+            split = await splitter.should_split(source, ocrmypdf_parameters)
+            started_at = time.monotonic()
+            # Small documents are processed in memory, unless the result has to be written to disk anyway
+            if not (split or is_spooled(source) or accepts_multipart(request) or cache_key):
+                result = await _cancel_on_disconnect(request, _with_deadline(
+                    scheduler.run(worker.process, source, file.filename, ocrmypdf_parameters, scheduler.jobs_per_task,
+                                  on_event=metrics.count_pages(), owner=_owner(request, priority), memory=memory),
+                    deadline))
+                _record_ocr(started_at)
+                return _result_response(result)
+            output = await _cancel_on_disconnect(request, _with_deadline(
+                _submit_to_file(request.app, source, file.filename, ocrmypdf_parameters, split, _owner(request, priority), memory), deadline))
+            _record_ocr(started_at, output)
+            await _cache_store(request.app, cache_key, output)
+        return multipart_response(output) if accepts_multipart(request) else json_response(output)
+    finally:
+        discard(source)
+
+@APP.post("/process_ocr/text", response_model=TextResult, response_model_exclude_none=True, responses={
+        400: {"model": ErrorResult},
+        413: {"model": ErrorResult},
+        500: {"model": ErrorResult},
+        503: {"model": ErrorResult},
+        504: {"model": ErrorResult}})
+async def process_ocr_text(
+        request: Request,
+        file: UploadFile = File(..., description="The file to be processed using OCR."),
+        ocrmypdf_parameters: str = Form(None, description="Additional parameters for the OCRmyPdf process (see https://ocrmypdf.readthedocs.io/en/latest/cookbook.html#basic-examples)."),
+        parameter_profile: str | None = Form(None, description=_PROFILE_DESCRIPTION),
+        per_page: bool = Form(False, description="Additionally return the recognized text of every page."),
+        priority: Priority = Form(Priority.INTERACTIVE, description=_PRIORITY_DESCRIPTION),
+        deadline: float | None = Form(None, gt=0, description=_DEADLINE_DESCRIPTION)
+    ):
+    """
+    Text-only mode, e.g. for search indexing: only runs rasterization and Tesseract and returns the recognized text.
+    No output PDF is produced, so PDF/A conversion, optimization and base64 encoding are skipped.
+    Pages which already have text are not passed to Tesseract, their existing text is returned instead.
+    """
+    scheduler: OcrScheduler = request.app.state.scheduler
+    ocrmypdf_parameters = await _validate_parameters(request, ocrmypdf_parameters, parameter_profile, produces_pdf=False)
+    source = await _read_upload(file)
+    try:
+        memory = await _admit(request, source, file.filename)
+        started_at = time.monotonic()
+        pages = await _cancel_on_disconnect(request, _with_deadline(
+            scheduler.run(worker.process_text, source, file.filename, ocrmypdf_parameters, scheduler.jobs_per_task,
+                          on_event=metrics.count_pages(), owner=_owner(request, priority), memory=memory),
+            deadline))
+        _record_ocr(started_at)
+        return TextResult(filename=file.filename, recognized_text="\f".join(pages), pages=pages if per_page else None)
+    finally:
+        discard(source)
+
+@APP.post("/process_ocr/batch", response_model=list[BatchItemResult], response_model_exclude_none=True, responses={400: {"model": ErrorResult}, 503: {"model": ErrorResult}})
+async def process_ocr_batch(
+        request: Request,
+        files: list[UploadFile] = File(..., description="The files to be processed using OCR."),
+        ocrmypdf_parameters: list[str] | None = Form(None, description="Additional parameters for the OCRmyPdf process. Either once for all files or once per file (in the order of the files)."),
+        parameter_profile: str | None = Form(None, description=_PROFILE_DESCRIPTION + " Applies to all files."),
+        priority: Priority = Form(Priority.BULK, description=_PRIORITY_DESCRIPTION),
+        deadline: float | None = Form(None, gt=0, description=_DEADLINE_DESCRIPTION)
+    ):
+    """
+    Processes multiple (small) files in one request. The files are scheduled to the workers together,
+    the result contains one entry per file (in the order of the files) with either the OcrResult
+    or the ErrorResult of the file, so that a single bad file doesn't fail the whole batch.
+    The batch is rejected if the queue is full, files which don't fit into the queue anymore fail with 503.
+    The deadline applies to every file.
+    """
+    scheduler: OcrScheduler = request.app.state.scheduler
+    if len(files) > SETTINGS.ocr_batch_max_files:
+        raise InvalidBatchError(f"Too many files: at most {SETTINGS.ocr_batch_max_files} files are allowed per batch")
+    parameters = ocrmypdf_parameters or [None]
+    if len(parameters) == 1:
+        parameters = parameters * len(files)
+    if len(parameters) != len(files):
+        raise InvalidBatchError(f"Got {len(parameters)} OCR parameters for {len(files)} files")
+    scheduler.check_admission()
+    owner = _owner(request, priority)
+    return await _cancel_on_disconnect(request, asyncio.gather(
+        *(_process_batch_item(request, file, file_parameters, parameter_profile, owner, deadline) for file, file_parameters in zip(files, parameters))))
+
+@APP.post("/process_ocr/stream", responses={
+        200: {"content": {NDJSON: {}}, "description": "Newline delimited JSON events (see below)"},
+        400: {"model": ErrorResult},
+        413: {"model": ErrorResult},
+        503: {"model": ErrorResult}})
+async def process_ocr_stream(
+        request: Request,
+        file: UploadFile = File(..., description="The file to be processed using OCR."),
+        ocrmypdf_parameters: str = Form(None, description="Additional parameters for the OCRmyPdf process (see https://ocrmypdf.readthedocs.io/en/latest/cookbook.html#basic-examples)."),
+        parameter_profile: str | None = Form(None, description=_PROFILE_DESCRIPTION),
+        priority: Priority = Form(Priority.INTERACTIVE, description=_PRIORITY_DESCRIPTION),
+        deadline: float | None = Form(None, gt=0, description=_DEADLINE_DESCRIPTION)
+    ):
     """
-    service = OcrService(logger)
-    return service.ocr(file.file, file.filename, ocrmypdf_parameters)
+    Like /process_ocr, but streams the processing as newline delimited JSON. Every line is one of:
+    - {"type": "progress", "stage": ..., "pagesDone": ..., "pagesTotal": ...} - progress of the current stage (see OcrProgress)
+    - {"type": "page", "page": ..., "text": ...} - recognized text of a page, as soon as the page is finished (see OcrPageText)
+    - {"type": "result", "result": {...}} - the final OcrResult (last line)
+    - {"type": "error", "error": {...}} - the ErrorResult, if processing failed after the response started (last line)
+
+    Pages are not necessarily finished in page order.
+    """
+    splitter: PageSplitter = request.app.state.splitter
+    ocrmypdf_parameters = await _validate_parameters(request, ocrmypdf_parameters, parameter_profile)
+    source = await _read_upload(file)
+    events: asyncio.Queue[ProgressEvent | None] = asyncio.Queue()
+    try:
+        cache_key, output = await _cache_lookup(request.app, source, file.filename, ocrmypdf_parameters)
+        result = None
+        if output is None:
+            memory = await _admit(request, source, file.filename)
+            split = await splitter.should_split(source, ocrmypdf_parameters)
+            result = asyncio.ensure_future(_with_deadline(
+                _submit_to_file(request.app, source, file.filename, ocrmypdf_parameters, split, _owner(request, priority), memory, on_event=events.put_nowait),
+                deadline))
+            # All events are delivered before the result, so this marks the end of the events
+            result.add_done_callback(lambda _: events.put_nowait(None))
+    except Exception:
+        discard(source)
+        raise
+    return StreamingResponse(_stream_ocr(request, source, output, result, events, cache_key), media_type=NDJSON)
 
 @APP.get("/installed_languages", response_model=Iterable[str])
-def installed_languages():
+def installed_languages(request: Request, refresh: bool = False):
     """
     Retrieves the list of installed Tesseract languages - relevant for OCRmyPDF.
+    The list is determined once at startup. Use refresh=true to reload it explicitly (it's also reloaded
+    automatically if the tessdata directory changes).
+    """
+    catalog: LanguageCatalog = request.app.state.languages
+    return (catalog.refresh() if refresh else catalog.current()).languages
+
+@APP.get("/engine_info", response_model=EngineInfo)
+def engine_info(request: Request, refresh: bool = False):
+    """
+    Retrieves the installed Tesseract languages together with the versions of Tesseract and OCRmyPDF.
+    """
+    catalog: LanguageCatalog = request.app.state.languages
+    return catalog.refresh() if refresh else catalog.current()
+
+@APP.get("/parameter_profiles", response_model=dict[str, str])
+def parameter_profiles(request: Request):
+    """
+    Retrieves the parameter profiles configured via OCR_PARAMETER_PROFILES (name and canonical OCRmyPDF parameters).
+    """
+    profiles: ParameterProfiles = request.app.state.parameter_profiles
+    return profiles.parameters()
+
+@APP.post("/jobs", status_code=202, response_model=JobStatus, responses={400: {"model": ErrorResult}, 413: {"model": ErrorResult}, 503: {"model": ErrorResult}})
+async def submit_job(
+        request: Request,
+        file: UploadFile = File(..., description="The file to be processed using OCR."),
+        ocrmypdf_parameters: str = Form(None, description="Additional parameters for the OCRmyPdf process (see https://ocrmypdf.readthedocs.io/en/latest/cookbook.html#basic-examples)."),
+        parameter_profile: str | None = Form(None, description=_PROFILE_DESCRIPTION),
+        priority: Priority = Form(Priority.BULK, description=_PRIORITY_DESCRIPTION),
+        deadline: float | None = Form(None, gt=0, description=_DEADLINE_DESCRIPTION),
+        job_id: str | None = Form(None, pattern=_JOB_ID_PATTERN, description="Id of the job chosen by the client (e.g. a UUID). If a job with this id already exists, it is returned instead of submitting the file again, so that retries are safe.")
+    ):
+    """
+    Submits an OCR job and returns immediately.
+    Use the returned job id to poll the job status and to fetch the result once the job is finished.
+    If OCR_JOB_QUEUE_DIR is set, the job is stored in the durable job queue and processed by any replica.
+    """
+    splitter: PageSplitter = request.app.state.splitter
+    jobs: JobStore | DurableJobStore = request.app.state.jobs
+    ocrmypdf_parameters = await _validate_parameters(request, ocrmypdf_parameters, parameter_profile)
+    source = await _read_upload(file)
+    if isinstance(jobs, DurableJobStore):
+        try:
+            return await _queue_job(request, jobs, job_id or uuid.uuid4().hex, source, file.filename, ocrmypdf_parameters, _owner(request, priority), deadline)
+        finally:
+            discard(source)
+    if job_id is not None and (existing := jobs.find(job_id)) is not None:
+        discard(source)
+        return existing.status()
+    job = jobs.create(file.filename, job_id)
+    try:
+        cache_key, output = await _cache_lookup(request.app, source, file.filename, ocrmypdf_parameters)
+        if output is not None:
+            job.succeed(output)
+            discard(source)
+            return job.status()
+        memory = await _admit(request, source, file.filename)
+        # Job results are kept on disk until they expire
+        split = await splitter.should_split(source, ocrmypdf_parameters)
+        result = _with_deadline(
+            _submit_to_file(request.app, source, file.filename, ocrmypdf_parameters, split, _owner(request, priority), memory, on_event=job.on_progress),
+            deadline)
+    except Exception:
+        jobs.remove(job.job_id)
+        discard(source)
+        raise
+    job.task = asyncio.ensure_future(_complete_job(request, job, source, result, cache_key))
+    return job.status()
+
+@APP.get("/metrics", response_class=Response, responses={200: {"content": {metrics.CONTENT_TYPE: {}}}})
+async def get_metrics():
+    """
+    Exposes metrics about requests, the OCR queue, processing times and resource usage in the Prometheus text format.
+    Only requires AppAPI authentication if OCR_METRICS_PUBLIC is not set.
+    """
+    return Response(metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
+
+@APP.get("/jobs/{job_id}", response_model=JobStatus, responses={404: {"model": ErrorResult}})
+async def job_status(request: Request, job_id: str):
+    """
+    Retrieves the state and the page-level progress of an OCR job.
+    """
+    jobs: JobStore | DurableJobStore = request.app.state.jobs
+    job = await _call_job_store(jobs, jobs.get, job_id)
+    return job.status()
+
+@APP.get("/jobs/{job_id}/result", response_model=OcrResult, responses={
+        200: {"content": {MULTIPART_MIXED: {}}, "description": "OcrResult as JSON or, if requested via the Accept header, as multipart/mixed response"},
+        404: {"model": ErrorResult},
+        409: {"model": ErrorResult},
+        500: {"model": ErrorResult}})
+async def job_result(request: Request, job_id: str):
+    """
+    Retrieves the result of a finished OCR job. Returns 409 if the job is still running.
+    If the job failed, the error is returned like it would have been returned by /process_ocr.
+    Like /process_ocr, the result can be requested as multipart/mixed response via the Accept header.
+    """
+    jobs: JobStore | DurableJobStore = request.app.state.jobs
+    job = await _call_job_store(jobs, jobs.get_result, job_id)
+    if job.error is not None:
+        return JSONResponse(job.error.model_dump(by_alias=True, exclude_none=True), status_code=job.error_status_code)
+    # The output file is deleted when the job expires
+    return multipart_response(job.result, delete=False) if accepts_multipart(request) else json_response(job.result, delete=False)
+
+async def _call_job_store(jobs: JobStore | DurableJobStore, method: Callable[..., T], *args) -> T:
+    # The database of the durable job store may be locked by another replica, so it's never accessed on the event loop
+    if isinstance(jobs, DurableJobStore):
+        return await run_in_threadpool(method, *args)
+    return method(*args)
+
+async def _complete_job(request: Request, job: Job, source: Source, result: Awaitable[OcrOutput], cache_key: str | None):
+    started_at = time.monotonic()
+    try:
+        output = await result
+        _record_ocr(started_at, output)
+        await _cache_store(request.app, cache_key, output)
+        job.succeed(output)
+    except Exception as exc:
+        logger.debug(f"Job {job.job_id} failed: {exc}")
+        error, status_code = to_error_result(exc)
+        metrics.record_error(error, status_code)
+        job.fail(error, status_code)
+    finally:
+        discard(source)
+
+async def _queue_job(request: Request, jobs: DurableJobStore, job_id: str, source: Source, file_name: str, ocrmypdf_parameters: str | None,
+                     owner: TaskOwner, deadline: float | None) -> JobStatus:
+    existing = await run_in_threadpool(jobs.find, job_id)
+    if existing is not None:
+        return existing.status()
+    # Documents which are too large are rejected right away instead of failing the job later
+    memory = await _admit(request, source, file_name)
+    job, created = await run_in_threadpool(jobs.create, job_id, file_name, ocrmypdf_parameters, owner, deadline, memory, source)
+    if created:
+        runner: JobRunner = request.app.state.job_runner
+        runner.wakeup()
+    return job.status()
+
+async def _process_queued_job(app: FastAPI, job: QueuedJob, on_event: EventCallback) -> OcrOutput:
+    """
+    Processes a job claimed from the durable job queue (see JobRunner), like submit_job processes the jobs kept in memory.
+    The input file belongs to the job queue, which deletes it once the job finished.
+    """
+    splitter: PageSplitter = app.state.splitter
+    cache_key, output = await _cache_lookup(app, job.input_path, job.filename, job.ocrmypdf_parameters)
+    if output is not None:
+        return output
+    split = await splitter.should_split(job.input_path, job.ocrmypdf_parameters)
+    started_at = time.monotonic()
+    output = await _with_deadline(
+        _submit_to_file(app, job.input_path, job.filename, job.ocrmypdf_parameters, split, job.owner, job.memory, on_event=on_event), job.deadline)
+    _record_ocr(started_at, output)
+    await _cache_store(app, cache_key, output)
+    return output
+
+def _job_error(exc: Exception) -> tuple[ErrorResult, int]:
+    error, status_code = to_error_result(exc)
+    metrics.record_error(error, status_code)
+    return error, status_code
+
+def _submit_to_file(app: FastAPI, source: Source, file_name: str, ocrmypdf_parameters: str | None, split: bool, owner: TaskOwner, memory: int,
+                    on_event: EventCallback | None = None) -> Awaitable[OcrOutput]:
+    """
+    Schedules the OCR of the given document, writing the resulting PDF to the scratch directory.
+    Large documents are split into chunks, which are processed in parallel (see PageSplitter).
+    """
+    on_event = metrics.count_pages(on_event)
+    if split:
+        splitter: PageSplitter = app.state.splitter
+        return splitter.submit(source, file_name, ocrmypdf_parameters, on_event=on_event, owner=owner, memory=memory)
+    scheduler: OcrScheduler = app.state.scheduler
+    return scheduler.submit(worker.process_to_file, source, file_name, ocrmypdf_parameters, scheduler.jobs_per_task, SETTINGS.scratch_dir,
+                            on_event=on_event, owner=owner, memory=memory)
+
+async def _with_deadline(result: Awaitable[T], deadline: float | None) -> T:
+    """
+    Cancels the given OCR if it doesn't finish within the deadline of the request (or OCR_DEFAULT_DEADLINE).
+    """
+    deadline = deadline or SETTINGS.ocr_default_deadline
+    if not deadline:
+        return await result
+    try:
+        return await asyncio.wait_for(result, deadline)
+    except asyncio.TimeoutError:
+        metrics.CANCELLED.inc(reason=metrics.CANCELLED_DEADLINE)
+        raise DeadlineExceededError(deadline)
+
+async def _cancel_on_disconnect(request: Request, result: Awaitable[T]) -> T:
+    """
+    Awaits the given OCR, cancelling it as soon as the client disconnected (e.g. after Nextcloud's request timed out).
+    """
+    task = asyncio.ensure_future(result)
+    try:
+        while not (await asyncio.wait([task], timeout=_DISCONNECT_POLL_INTERVAL))[0]:
+            if await request.is_disconnected():
+                metrics.CANCELLED.inc(reason=metrics.CANCELLED_DISCONNECT)
+                raise ClientDisconnectedError()
+        return task.result()
+    finally:
+        # No-op if the OCR finished
+        task.cancel()
+
+async def _admit(request: Request, source: Source, file_name: str) -> int:
     """
-    service = OcrService(logger)
-    return service.installed_languages()
\ No newline at end of file
+    Rejects documents which are too large (see AdmissionControl). Returns the estimated memory of all others (0 if unknown).
+    """
+    admission: AdmissionControl = request.app.state.admission
+    with tracing.span("admission") as span:
+        cost = await admission.admit(source, file_name)
+        if span is not None and cost is not None:
+            span.set(pages=cost.pages, megapixels=round(cost.megapixels, 1), memory_bytes=cost.memory_bytes)
+    return cost.memory_bytes if cost is not None else 0
+
+def _owner(request: Request, priority: Priority) -> TaskOwner:
+    # Set by AppAPIAuthMiddleware, fair share is per Nextcloud user
+    return TaskOwner(request.scope.get("username", ""), priority)
+
+async def _read_upload(file: UploadFile) -> Source:
+    started_at = time.monotonic()
+    with tracing.span("upload", spooled=False) as span:
+        source = await spool_upload(file, SETTINGS)
+        if span is not None:
+            span.set(spooled=is_spooled(source))
+    metrics.STAGE_SECONDS.observe(time.monotonic() - started_at, stage=metrics.STAGE_UPLOAD)
+    if is_spooled(source):
+        metrics.record_file_size(metrics.INPUT_BYTES, source)
+    else:
+        metrics.INPUT_BYTES.observe(len(source))
+    return source
+
+def _record_ocr(started_at: float, output: OcrOutput | None = None):
+    metrics.STAGE_SECONDS.observe(time.monotonic() - started_at, stage=metrics.STAGE_OCR)
+    if output is not None:
+        metrics.record_file_size(metrics.OUTPUT_BYTES, output.file_path)
+
+def _result_response(result: OcrResult) -> Response:
+    # Serialized explicitly (instead of by FastAPI) to measure the serialization of the base64 encoded file
+    started_at = time.monotonic()
+    with tracing.span("serialization"):
+        content = result.model_dump_json(by_alias=True, exclude_none=True)
+    metrics.STAGE_SECONDS.observe(time.monotonic() - started_at, stage=metrics.STAGE_SERIALIZATION)
+    file_content = result.file_content
+    metrics.OUTPUT_BYTES.observe(len(file_content) * 3 // 4 - file_content[-2:].count("="))
+    return Response(content, media_type="application/json")
+
+def _register_gauges(app: FastAPI):
+    """
+    Registers the gauges which are determined at scrape time from the state of the given app.
+    """
+    scheduler: OcrScheduler = app.state.scheduler
+    jobs: JobStore | DurableJobStore = app.state.jobs
+    cache: ResultCache | None = app.state.cache
+    metrics.REGISTRY.register(metrics.Gauge("ocr_queue_depth", "Number of OCR tasks waiting for a free worker", lambda: scheduler.queue_depth))
+    metrics.REGISTRY.register(metrics.Gauge("ocr_in_flight", "Number of OCR tasks currently running", lambda: scheduler.in_flight))
+    metrics.REGISTRY.register(metrics.Gauge(
+        "ocr_queued_tasks", "Number of OCR tasks waiting for a free worker by priority class",
+        lambda: {(priority.value,): scheduler.waiting(priority) for priority in Priority}, ("priority",)))
+    metrics.REGISTRY.register(metrics.Gauge(
+        "ocr_running_tasks", "Number of OCR tasks currently running by priority class",
+        lambda: {(priority.value,): scheduler.running(priority) for priority in Priority}, ("priority",)))
+    metrics.REGISTRY.register(metrics.Gauge("ocr_memory_reserved_bytes", "Estimated memory of the running OCR tasks (see OCR_MEMORY_BUDGET)", lambda: scheduler.reserved_memory))
+    metrics.REGISTRY.register(metrics.Gauge("ocr_workers", "Number of OCR worker processes", lambda: SETTINGS.ocr_workers))
+    # The durable job store is counted in the background (see JobRunner), as its database may be locked by another replica
+    count_jobs = (lambda: jobs.state_counts) if isinstance(jobs, DurableJobStore) else jobs.count_by_state
+    metrics.REGISTRY.register(metrics.Gauge("ocr_jobs", "Number of jobs by state", lambda: {(state.value,): count for state, count in count_jobs().items()}, ("state",)))
+    metrics.REGISTRY.register(metrics.Gauge("process_resident_memory_bytes", "Resident memory of the web server process", metrics.resident_memory))
+    metrics.REGISTRY.register(metrics.Gauge(
+        "ocr_worker_resident_memory_bytes", "Resident memory of the OCR worker processes",
+        lambda: {(str(pid),): rss for pid in scheduler.worker_pids if (rss := metrics.resident_memory(pid)) is not None}, ("pid",)))
+    if cache is not None:
+        metrics.REGISTRY.register(metrics.Gauge("ocr_cache_bytes", "Size of the OCR result cache", lambda: cache.size))
+        metrics.REGISTRY.register(metrics.Gauge("ocr_cache_entries", "Number of entries in the OCR result cache", lambda: len(cache)))
+        metrics.REGISTRY.register(metrics.Gauge("ocr_cache_requests", "Lookups in the OCR result cache since startup", lambda: {("hit",): cache.hits, ("miss",): cache.misses}, ("result",)))
+
+async def _process_batch_item(request: Request, file: UploadFile, ocrmypdf_parameters: str | None, parameter_profile: str | None,
+                              owner: TaskOwner, deadline: float | None) -> BatchItemResult:
+    scheduler: OcrScheduler = request.app.state.scheduler
+    try:
+        ocrmypdf_parameters = await _validate_parameters(request, ocrmypdf_parameters, parameter_profile)
+        source = await _read_upload(file)
+        try:
+            cache_key, output = await _cache_lookup(request.app, source, file.filename, ocrmypdf_parameters)
+            memory = await _admit(request, source, file.filename) if output is None else 0
+            # Every file takes a place in the queue, the ones exceeding its capacity are rejected like single requests
+            if output is None and not (is_spooled(source) or cache_key):
+                started_at = time.monotonic()
+                result = await _with_deadline(scheduler.submit(worker.process, source, file.filename, ocrmypdf_parameters, scheduler.jobs_per_task,
+                                                               on_event=metrics.count_pages(), owner=owner, memory=memory), deadline)
+                _record_ocr(started_at)
+            else:
+                if output is None:
+                    started_at = time.monotonic()
+                    output = await _with_deadline(scheduler.submit(worker.process_to_file, source, file.filename, ocrmypdf_parameters, scheduler.jobs_per_task, SETTINGS.scratch_dir,
+                                                                   on_event=metrics.count_pages(), owner=owner, memory=memory), deadline)
+                    _record_ocr(started_at, output)
+                    await _cache_store(request.app, cache_key, output)
+                try:
+                    result = await run_in_threadpool(output.read_result)
+                finally:
+                    discard(output.file_path)
+        finally:
+            discard(source)
+        return BatchItemResult(filename=file.filename, status_code=200, result=result)
+    except Exception as exc:
+        logger.debug(f"Batch item {file.filename} failed: {exc}")
+        error, status_code = to_error_result(exc)
+        metrics.record_error(error, status_code)
+        return BatchItemResult(filename=file.filename, status_code=status_code, error=error)
+
+async def _stream_ocr(request: Request, source: Source, output: OcrOutput | None, result: asyncio.Future | None,
+                      events: asyncio.Queue, cache_key: str | None) -> AsyncIterator[bytes]:
+    started_at = time.monotonic()
+    try:
+        if result is not None:
+            while (event := await events.get()) is not None:
+                yield _stream_event(event).model_dump_json(by_alias=True, exclude_none=True).encode("utf-8") + b"\n"
+            try:
+                output = result.result()
+            except Exception as exc:
+                logger.debug(f"Streamed OCR failed: {exc}")
+                error, status_code = to_error_result(exc)
+                metrics.record_error(error, status_code)
+                yield OcrStreamError(error=error).model_dump_json(by_alias=True, exclude_none=True).encode("utf-8") + b"\n"
+                return
+            _record_ocr(started_at, output)
+            await _cache_store(request.app, cache_key, output)
+        async for chunk in iterate_in_threadpool(ndjson_result(output)):
+            yield chunk
+    finally:
+        if result is not None and not result.done():
+            # The client went away before the OCR finished
+            metrics.CANCELLED.inc(reason=metrics.CANCELLED_DISCONNECT)
+            result.cancel()
+            result.add_done_callback(lambda _: _discard_result(source, result))
+        else:
+            discard(source)
+            if output is None and result is not None and not result.cancelled() and result.exception() is None:
+                # The client went away after the OCR finished, but before its result was sent
+                output = result.result()
+            if output is not None:
+                discard(output.file_path)
+
+def _stream_event(event: ProgressEvent) -> OcrProgress | OcrPageText:
+    if event.stage == PAGE_TEXT_STAGE:
+        return OcrPageText(page=event.page, text=event.text)
+    if event.unit == "page" and event.stage in PAGE_STAGES:
+        return OcrProgress(stage=event.stage, pages_total=int(event.total) if event.total is not None else None, pages_done=int(event.completed))
+    return OcrProgress(stage=event.stage)
+
+def _discard_result(source: Source, result: asyncio.Future):
+    discard(source)
+    if not result.cancelled() and result.exception() is None:
+        discard(result.result().file_path)
+
+async def _validate_parameters(request: Request, ocrmypdf_parameters: str | None, parameter_profile: str | None,
+                               produces_pdf: bool = True) -> str | None:
+    """
+    Rejects requests with invalid parameters, unknown profiles or uninstalled languages before any expensive work is done.
+    Returns the canonical parameters (including the ones of the profile) the request is processed with.
+    produces_pdf is False for endpoints which only return the recognized text (and don't produce an output PDF).
+    """
+    profiles: ParameterProfiles = request.app.state.parameter_profiles
+    catalog: LanguageCatalog = request.app.state.languages
+    ocrmypdf_parameters = await run_in_threadpool(profiles.resolve, parameter_profile, ocrmypdf_parameters)
+    await run_in_threadpool(check_output, ocrmypdf_parameters, produces_pdf)
+    await run_in_threadpool(catalog.validate, OcrService(logger).requested_languages(ocrmypdf_parameters))
+    return ocrmypdf_parameters
+
+async def _cache_lookup(app: FastAPI, source: Source, file_name: str, ocrmypdf_parameters: str | None) -> tuple[str | None, OcrOutput | None]:
+    """
+    Returns the cache key for the given input and parameters and the cached result (if any).
+    The cache key is None if the cache is disabled.
+    """
+    cache: ResultCache | None = app.state.cache
+    if cache is None:
+        return None, None
+    normalized_parameters = OcrService(logger).normalize_parameters(ocrmypdf_parameters, SETTINGS.ocr_auto_language, SETTINGS.ocr_max_dpi)
+    with tracing.span("cache lookup") as span:
+        cache_key = await run_in_threadpool(cache.key, source, normalized_parameters)
+        output = await run_in_threadpool(cache.get, cache_key, file_name, SETTINGS.scratch_dir)
+        if span is not None:
+            span.set(hit=output is not None)
+    return cache_key, output
+
+async def _cache_store(app: FastAPI, cache_key: str | None, output: OcrOutput):
+    cache: ResultCache | None = app.state.cache
+    if cache is None or cache_key is None:
+        return
+    try:
+        await run_in_threadpool(cache.put, cache_key, output)
+    except OSError as exc:
+        # A broken cache must not break the OCR request
+        logger.warning(f"Failed to store OCR result in cache: {exc}")
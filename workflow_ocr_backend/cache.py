@@ -0,0 +1,156 @@
+from collections import OrderedDict
+import hashlib
+import json
+from logging import Logger
+import os
+from pathlib import Path
+import shutil
+import tempfile
+import threading
+
+from .ocrservice import OcrOutput
+from .spooling import CHUNK_SIZE, Source, is_spooled
+
+_PDF_SUFFIX = ".pdf"
+_TEXT_SUFFIX = ".txt"
+# Detected languages of results produced with automatic language selection (other results have no such file)
+_LANGUAGES_SUFFIX = ".json"
+
+
+class ResultCache:
+    """
+    Content-addressed on-disk cache of OCR results. Entries are keyed by the SHA-256 of the input,
+    the normalized OCR parameters and the versions of the OCR engines. If the cache exceeds
+    `max_bytes`, the least recently used entries are evicted.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, engine_version: str, logger: Logger):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.engine_version = engine_version
+        self.logger = logger
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, int] = OrderedDict()
+        self._size = 0
+        os.makedirs(directory, exist_ok=True)
+        self._load_entries()
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def key(self, source: Source, normalized_parameters: str) -> str:
+        digest = hashlib.sha256()
+        if is_spooled(source):
+            with open(source, "rb") as file:
+                while chunk := file.read(CHUNK_SIZE):
+                    digest.update(chunk)
+        else:
+            digest.update(source)
+        input_hash = digest.hexdigest()
+        return hashlib.sha256("\0".join((input_hash, normalized_parameters, self.engine_version)).encode("utf-8")).hexdigest()
+
+    def get(self, key: str, file_name: str, target_dir: str) -> OcrOutput | None:
+        """
+        Returns a private copy (hard link, if possible) of the cached result in target_dir,
+        which the caller is responsible for deleting.
+        """
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            try:
+                output_path = _link_or_copy(self._path(key, _PDF_SUFFIX), target_dir, "ocr-output-")
+                recognized_text = Path(self._path(key, _TEXT_SUFFIX)).read_text("utf-8")
+                detected_languages = self._read_languages(key)
+            except FileNotFoundError:
+                # Entry has been removed from disk by someone else
+                self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            os.utime(self._path(key, _PDF_SUFFIX))
+            self.hits += 1
+        self.logger.debug(f"OCR result cache hit for {file_name} ({key})")
+        return OcrOutput(filename=file_name, content_type="application/pdf", recognized_text=recognized_text, file_path=output_path,
+                         detected_languages=detected_languages)
+
+    def put(self, key: str, output: OcrOutput):
+        text = output.recognized_text.encode("utf-8")
+        languages = json.dumps(output.detected_languages).encode("utf-8") if output.detected_languages is not None else b""
+        size = os.path.getsize(output.file_path) + len(text) + len(languages)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            pdf_path = _link_or_copy(output.file_path, self.directory, "tmp-")
+            Path(self._path(key, _TEXT_SUFFIX)).write_bytes(text)
+            if languages:
+                _write_atomically(self._path(key, _LANGUAGES_SUFFIX), languages)
+            # The PDF is moved into place last, entries without it are incomplete
+            os.replace(pdf_path, self._path(key, _PDF_SUFFIX))
+            self._entries[key] = size
+            self._size += size
+            while self._size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def _load_entries(self):
+        entries = []
+        for pdf in Path(self.directory).glob(f"*{_PDF_SUFFIX}"):
+            text = pdf.with_suffix(_TEXT_SUFFIX)
+            if not text.exists():
+                pdf.unlink(missing_ok=True)
+                continue
+            stat = pdf.stat()
+            languages = pdf.with_suffix(_LANGUAGES_SUFFIX)
+            languages_size = languages.stat().st_size if languages.exists() else 0
+            entries.append((stat.st_mtime, pdf.stem, stat.st_size + text.stat().st_size + languages_size))
+        for _, key, size in sorted(entries):
+            self._entries[key] = size
+            self._size += size
+        while self._size > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key: str):
+        self._size -= self._entries.pop(key, 0)
+        Path(self._path(key, _PDF_SUFFIX)).unlink(missing_ok=True)
+        Path(self._path(key, _TEXT_SUFFIX)).unlink(missing_ok=True)
+        Path(self._path(key, _LANGUAGES_SUFFIX)).unlink(missing_ok=True)
+
+    def _read_languages(self, key: str) -> list[str] | None:
+        try:
+            return json.loads(Path(self._path(key, _LANGUAGES_SUFFIX)).read_text("utf-8"))
+        except FileNotFoundError:
+            return None
+
+    def _path(self, key: str, suffix: str) -> str:
+        return os.path.join(self.directory, key + suffix)
+
+
+def _write_atomically(path: str, data: bytes):
+    fd, temp_path = tempfile.mkstemp(prefix="tmp-", dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+def _link_or_copy(path: str, target_dir: str, prefix: str) -> str:
+    fd, target = tempfile.mkstemp(suffix=_PDF_SUFFIX, prefix=prefix, dir=target_dir)
+    os.close(fd)
+    try:
+        os.unlink(target)
+        os.link(path, target)
+    except OSError:
+        # Different file systems (or hard links not supported)
+        shutil.copyfile(path, target)
+    return target
@@ -0,0 +1,64 @@
+"""
+Cancellation of tasks which are already running in a worker process (see OcrScheduler and worker.cancellable).
+"""
+import os
+import signal
+
+# Task ids are uuid4 hex strings (see OcrScheduler)
+_TASK_ID_LENGTH = 32
+
+
+class CancelledTasks:
+    """
+    Ids of the most recently cancelled tasks, shared between the scheduler and its worker processes.
+    Implemented as a fixed size ring buffer in shared memory, so that it can be passed to the workers at startup.
+    """
+
+    def __init__(self, context, size: int = 256):
+        self.size = size
+        self._ids = context.Array("c", size * _TASK_ID_LENGTH)
+        self._next = context.Value("i", 0, lock=False)
+
+    def add(self, task_id: str):
+        with self._ids.get_lock():
+            offset = self._next.value * _TASK_ID_LENGTH
+            self._ids[offset:offset + _TASK_ID_LENGTH] = task_id.encode("ascii")
+            self._next.value = (self._next.value + 1) % self.size
+
+    def __contains__(self, task_id: str) -> bool:
+        encoded = task_id.encode("ascii")
+        with self._ids.get_lock():
+            ids = self._ids.raw
+        return any(ids[offset:offset + _TASK_ID_LENGTH] == encoded for offset in range(0, len(ids), _TASK_ID_LENGTH))
+
+
+def kill_descendants(pid: int) -> int:
+    """
+    Kills all descendants of the given process (e.g. Tesseract and Ghostscript started by OCRmyPDF)
+    and returns their number. Only works on Linux, where the process tree is read from /proc.
+    """
+    children: dict[int, list[int]] = {}
+    try:
+        entries = [entry.name for entry in os.scandir("/proc") if entry.name.isdigit()]
+    except OSError:
+        return 0
+    for name in entries:
+        try:
+            with open(f"/proc/{name}/stat") as file:
+                stat = file.read()
+            # The command name (2nd field) may contain spaces and parentheses, the parent pid follows the state
+            parent = int(stat.rsplit(")", 1)[1].split()[1])
+        except (OSError, ValueError, IndexError):
+            continue
+        children.setdefault(parent, []).append(int(name))
+    killed = 0
+    pending = list(children.get(pid, []))
+    while pending:
+        child = pending.pop()
+        pending.extend(children.get(child, []))
+        try:
+            os.kill(child, signal.SIGKILL)
+            killed += 1
+        except ProcessLookupError:
+            pass
+    return killed
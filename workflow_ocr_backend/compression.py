@@ -0,0 +1,248 @@
+"""
+Negotiated compression of responses (gzip or zstd, see Accept-Encoding) and decompression of compressed
+request bodies (Content-Encoding), to save bandwidth between Nextcloud and the backend.
+Responses are compressed while they are streamed, so that e.g. the base64 encoded PDF of a
+JSON response is never held in memory as a whole, and NDJSON events are still delivered right away.
+"""
+import zlib
+
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.exceptions import HTTPException
+from starlette.responses import JSONResponse
+import zstandard
+
+from . import metrics
+from .model.ocrresult import ErrorResult
+from .settings import Settings
+
+GZIP = "gzip"
+ZSTD = "zstd"
+# Preferred first if the client accepts several encodings equally
+ENCODINGS = (ZSTD, GZIP)
+# Already compressed or (like multipart responses) mostly consisting of a PDF
+_INCOMPRESSIBLE_TYPES = ("application/pdf", "application/zip", "application/gzip", "application/zstd", "image/", "multipart/")
+# Larger chunks are compressed in a thread, so that the event loop isn't blocked
+_THREAD_MIN_SIZE = 64 * 1024
+# Compressed request bodies are decompressed in a thread (a small chunk can expand to a lot of data), in slices of
+# this size, so that a single slice can't expand to more than a few dozen MiB before the size limit is checked
+# (deflate expands at most ~1000x, zstd's RLE blocks ~32000x)
+_DECOMPRESS_SLICE_SIZE = 1024
+
+
+class _Encoder:
+    """
+    Compresses a streamed response chunk by chunk. Every chunk is flushed, so that the client can decompress it right away.
+    """
+
+    def __init__(self, encoding: str, level: int):
+        if encoding == GZIP:
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            self._flush_chunk, self._flush_final = zlib.Z_SYNC_FLUSH, zlib.Z_FINISH
+        else:
+            self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+            self._flush_chunk, self._flush_final = zstandard.COMPRESSOBJ_FLUSH_BLOCK, zstandard.COMPRESSOBJ_FLUSH_FINISH
+
+    def compress(self, data: bytes, final: bool) -> bytes:
+        return self._compressor.compress(data) + self._compressor.flush(self._flush_final if final else self._flush_chunk)
+
+
+class _Decoder:
+    """
+    Decompresses a request body chunk by chunk. An invalid or too large body is rejected with an HTTPException,
+    which is also kept in `error`, so that the middleware can respond with an ErrorResult instead.
+    """
+
+    def __init__(self, encoding: str, max_size: int):
+        self.encoding = encoding
+        self.max_size = max_size
+        self.size = 0
+        self.error: HTTPException | None = None
+        if encoding == GZIP:
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            self._decompressor = zstandard.ZstdDecompressor().decompressobj()
+
+    def decompress(self, data: bytes, final: bool) -> bytes:
+        try:
+            return self._decompress(data, final)
+        except HTTPException as exc:
+            self.error = exc
+            raise
+
+    def _decompress(self, data: bytes, final: bool) -> bytes:
+        chunks = []
+        try:
+            for offset in range(0, len(data), _DECOMPRESS_SLICE_SIZE):
+                chunk = self._decompressor.decompress(data[offset:offset + _DECOMPRESS_SLICE_SIZE])
+                self.size += len(chunk)
+                if self.max_size and self.size > self.max_size:
+                    raise HTTPException(413, f"Decompressed request body exceeds {self.max_size} bytes")
+                chunks.append(chunk)
+        except (zlib.error, zstandard.ZstdError) as exc:
+            raise HTTPException(400, f"Invalid {self.encoding} request body: {exc}")
+        if final and not self._decompressor.eof:
+            raise HTTPException(400, f"Truncated {self.encoding} request body")
+        return b"".join(chunks)
+
+
+def negotiate(accept_encoding: str) -> str | None:
+    """
+    Returns the supported encoding the client prefers according to the given Accept-Encoding header
+    (with q values, zstd before gzip if both are accepted equally), or None if it accepts neither.
+    """
+    preferences: dict[str, float] = {}
+    for item in accept_encoding.split(","):
+        coding, *parameters = item.split(";")
+        quality = 1.0
+        for parameter in parameters:
+            name, _, value = parameter.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if coding.strip():
+            preferences[coding.strip().lower()] = quality
+    wildcard = preferences.get("*", 0.0)
+    quality, _, encoding = max((preferences.get(encoding, wildcard), -index, encoding) for index, encoding in enumerate(ENCODINGS))
+    return encoding if quality > 0 else None
+
+
+def is_compressible(content_type: str) -> bool:
+    return not content_type.split(";")[0].strip().lower().startswith(_INCOMPRESSIBLE_TYPES)
+
+
+class CompressionMiddleware:
+    """
+    Compresses responses of at least OCR_COMPRESSION_MIN_SIZE bytes with the encoding negotiated via Accept-Encoding
+    (level OCR_COMPRESSION_LEVEL) and decompresses request bodies sent with "Content-Encoding: gzip" or "zstd".
+    Request bodies with any other encoding are rejected with 415, invalid ones with 400 and ones which
+    exceed OCR_MAX_DECOMPRESSED_SIZE bytes when decompressed with 413.
+    """
+
+    def __init__(self, app, settings: Settings):
+        self.app = app
+        self.level = settings.ocr_compression_level
+        self.minimum_size = settings.ocr_compression_min_size
+        self.max_decompressed_size = settings.ocr_max_decompressed_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        headers = Headers(scope=scope)
+        content_encoding = headers.get("content-encoding", "identity").strip().lower()
+        if content_encoding not in ("", "identity"):
+            if content_encoding not in ENCODINGS:
+                message = f"Unsupported Content-Encoding of the request body: {content_encoding} (supported: {', '.join(ENCODINGS)})"
+                await _send_error(415, message, scope, receive, send)
+                return
+            # The length of the decompressed body is unknown
+            scope = {**scope, "headers": [(name, value) for name, value in scope["headers"] if name.lower() not in (b"content-encoding", b"content-length")]}
+            await self._call_decompressing(scope, receive, send, _Decoder(content_encoding, self.max_decompressed_size))
+            return
+        await self._call(scope, receive, send)
+
+    async def _call_decompressing(self, scope, receive, send, decoder: _Decoder):
+        """
+        Replaces the response of the app with an ErrorResult if the request body was rejected while the app read it.
+        """
+        started = False
+
+        async def replaceable_send(message):
+            nonlocal started
+            if decoder.error is not None and not started:
+                return
+            started = started or message["type"] == "http.response.start"
+            await send(message)
+
+        try:
+            await self._call(scope, _decompressing(receive, decoder), replaceable_send)
+        except Exception:
+            if decoder.error is None or started:
+                raise
+        if decoder.error is not None and not started:
+            await _send_error(decoder.error.status_code, decoder.error.detail, scope, receive, send)
+
+    async def _call(self, scope, receive, send):
+        headers = Headers(scope=scope)
+        encoding = negotiate(headers.get("accept-encoding", "")) if self.level > 0 else None
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        await self.app(scope, receive, _CompressingSend(send, encoding, self.level, self.minimum_size))
+
+
+async def _send_error(status_code: int, message: str, scope, receive, send):
+    error = ErrorResult(message=message)
+    metrics.record_error(error, status_code)
+    await JSONResponse(error.model_dump(by_alias=True, exclude_none=True), status_code=status_code)(scope, receive, send)
+
+
+def _decompressing(receive, decoder: _Decoder):
+    async def decompressing_receive():
+        message = await receive()
+        if message["type"] == "http.request":
+            more_body = message.get("more_body", False)
+            message = {**message, "body": await run_in_threadpool(decoder.decompress, message.get("body", b""), not more_body)}
+        return message
+    return decompressing_receive
+
+
+class _CompressingSend:
+    """
+    Holds back the start of the response until its first chunk, which decides whether it is compressed.
+    """
+
+    def __init__(self, send, encoding: str, level: int, minimum_size: int):
+        self.send = send
+        self.encoding = encoding
+        self.level = level
+        self.minimum_size = minimum_size
+        self.start: dict | None = None
+        self.encoder: _Encoder | None = None
+
+    async def __call__(self, message):
+        if message["type"] == "http.response.start":
+            self.start = message
+            return
+        if message["type"] != "http.response.body":
+            await self._send_start()
+            await self.send(message)
+            return
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if self.start is not None:
+            headers = MutableHeaders(raw=list(self.start["headers"]))
+            compressible = is_compressible(headers.get("content-type", "")) and self.start["status"] not in (204, 206, 304)
+            if compressible:
+                headers.add_vary_header("Accept-Encoding")
+            if compressible and "content-encoding" not in headers and (more_body or len(body) >= self.minimum_size):
+                self.encoder = _Encoder(self.encoding, self.level)
+                headers["Content-Encoding"] = self.encoding
+                if more_body:
+                    del headers["Content-Length"]
+                else:
+                    body = await self._compress(body, final=True)
+                    headers["Content-Length"] = str(len(body))
+                    self.start = {**self.start, "headers": headers.raw}
+                    await self._send_start()
+                    await self.send({**message, "body": body})
+                    return
+            self.start = {**self.start, "headers": headers.raw}
+            await self._send_start()
+        if self.encoder is None:
+            await self.send(message)
+            return
+        await self.send({**message, "body": await self._compress(body, final=not more_body)})
+
+    async def _compress(self, body: bytes, final: bool) -> bytes:
+        if len(body) >= _THREAD_MIN_SIZE:
+            return await run_in_threadpool(self.encoder.compress, body, final)
+        return self.encoder.compress(body, final)
+
+    async def _send_start(self):
+        if self.start is not None:
+            start, self.start = self.start, None
+            await self.send(start)
@@ -0,0 +1,82 @@
+class OcrBackendError(Exception):
+    """
+    Base class for errors raised by the backend itself (in contrast to errors raised by OCRmyPDF).
+    Will be turned into an ErrorResult response with the given status code and headers.
+    """
+    status_code: int = 500
+
+    def __init__(self, message: str, headers: dict[str, str] | None = None):
+        super().__init__(message)
+        self.headers = headers or {}
+
+
+class QueueFullError(OcrBackendError):
+    status_code = 503
+
+    def __init__(self, retry_after: int):
+        super().__init__("OCR queue is full, please retry later", {"Retry-After": str(retry_after)})
+
+
+class JobNotFoundError(OcrBackendError):
+    status_code = 404
+
+    def __init__(self, job_id: str):
+        super().__init__(f"Job {job_id} does not exist (or its result already expired)")
+
+
+class JobNotFinishedError(OcrBackendError):
+    status_code = 409
+
+    def __init__(self, job_id: str):
+        super().__init__(f"Job {job_id} is not finished yet")
+
+
+class UnknownLanguageError(OcrBackendError):
+    status_code = 400
+
+    def __init__(self, languages: list[str]):
+        super().__init__(f"Language(s) not installed: {', '.join(languages)}")
+
+
+class InvalidParametersError(OcrBackendError):
+    status_code = 400
+
+
+class InvalidBatchError(OcrBackendError):
+    status_code = 400
+
+
+class DocumentTooLargeError(OcrBackendError):
+    status_code = 413
+
+
+class WorkerCrashedError(OcrBackendError):
+    """
+    Raised when the worker process running a task terminated abruptly (e.g. killed by the OOM killer). Only this task fails,
+    the worker is replaced (see OcrScheduler).
+    """
+
+    def __init__(self):
+        super().__init__("OCR worker terminated abruptly (e.g. because it ran out of memory)")
+
+
+class TaskCancelledError(OcrBackendError):
+    """
+    Raised inside of a worker process when its task was cancelled (see worker.cancellable).
+    """
+    status_code = 499
+
+
+class ClientDisconnectedError(OcrBackendError):
+    # Non-standard "Client Closed Request" (nginx), the client doesn't receive the response anyway
+    status_code = 499
+
+    def __init__(self):
+        super().__init__("Client disconnected, OCR was cancelled")
+
+
+class DeadlineExceededError(OcrBackendError):
+    status_code = 504
+
+    def __init__(self, deadline: float):
+        super().__init__(f"OCR did not finish within the deadline of {deadline:g} seconds and was cancelled")
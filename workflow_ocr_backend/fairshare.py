@@ -0,0 +1,97 @@
+import asyncio
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+
+from .model.priority import Priority
+
+# Priority classes in the order they are served
+_PRIORITIES = (Priority.INTERACTIVE, Priority.BULK)
+
+
+@dataclass(frozen=True)
+class TaskOwner:
+    """
+    Nextcloud user (as authenticated by AppAPI) and priority class a task is scheduled for.
+    """
+    user: str = ""
+    priority: Priority = Priority.INTERACTIVE
+
+
+class FairSlots:
+    """
+    Replacement for a semaphore which hands out free worker slots by priority and fair share:
+    waiting interactive tasks always go first, within a priority class the users take turns
+    (round robin). Users are limited to `user_limit` concurrent tasks (0 = unlimited),
+    bulk tasks never occupy the last `reserved_interactive` slots.
+    """
+
+    def __init__(self, slots: int, user_limit: int = 0, reserved_interactive: int = 0):
+        self.slots = slots
+        self.user_limit = user_limit
+        self.bulk_limit = max(1, slots - reserved_interactive)
+        self._waiters: dict[Priority, OrderedDict[str, deque[asyncio.Future]]] = {priority: OrderedDict() for priority in _PRIORITIES}
+        self._running_by_user: dict[str, int] = {}
+        self._running_by_priority: dict[Priority, int] = {priority: 0 for priority in _PRIORITIES}
+
+    def running(self, priority: Priority) -> int:
+        return self._running_by_priority[priority]
+
+    def waiting(self, priority: Priority) -> int:
+        return sum(len(waiters) for waiters in self._waiters[priority].values())
+
+    async def acquire(self, owner: TaskOwner):
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters[owner.priority].setdefault(owner.user, deque()).append(waiter)
+        self._dispatch()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was granted right before the cancellation
+                self.release(owner)
+            else:
+                self._remove_waiter(owner, waiter)
+            raise
+
+    def release(self, owner: TaskOwner):
+        self._running_by_user[owner.user] -= 1
+        if self._running_by_user[owner.user] == 0:
+            del self._running_by_user[owner.user]
+        self._running_by_priority[owner.priority] -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        while sum(self._running_by_priority.values()) < self.slots:
+            owner = self._next_owner()
+            if owner is None:
+                return
+            users = self._waiters[owner.priority]
+            waiter = users[owner.user].popleft()
+            if users[owner.user]:
+                # Round robin: the user has to wait for the other users of the same priority class
+                users.move_to_end(owner.user)
+            else:
+                del users[owner.user]
+            if waiter.done():
+                # Cancelled, but the waiting task didn't get to remove it yet
+                continue
+            self._running_by_user[owner.user] = self._running_by_user.get(owner.user, 0) + 1
+            self._running_by_priority[owner.priority] += 1
+            waiter.set_result(None)
+
+    def _next_owner(self) -> TaskOwner | None:
+        for priority in _PRIORITIES:
+            if priority == Priority.BULK and self._running_by_priority[priority] >= self.bulk_limit:
+                continue
+            for user in self._waiters[priority]:
+                if self.user_limit <= 0 or self._running_by_user.get(user, 0) < self.user_limit:
+                    return TaskOwner(user, priority)
+        return None
+
+    def _remove_waiter(self, owner: TaskOwner, waiter: asyncio.Future):
+        users = self._waiters[owner.priority]
+        waiters = users.get(owner.user)
+        if waiters is not None and waiter in waiters:
+            waiters.remove(waiter)
+            if not waiters:
+                del users[owner.user]
@@ -0,0 +1,457 @@
+"""
+Durable job queue shared by all replicas of the backend (see OCR_JOB_QUEUE_DIR), without an external broker:
+jobs submitted via /jobs are stored in a SQLite database on a shared volume together with their input files,
+and every replica claims queued jobs from it (see JobRunner). A claimed job is leased for OCR_JOB_LEASE seconds
+and the lease is renewed while the job is running, so that the job is queued again if its replica dies.
+Results are written to the shared volume as well, so that any replica can return them.
+"""
+import asyncio
+from dataclasses import dataclass
+from datetime import datetime, timezone
+import json
+from logging import Logger
+import os
+from pathlib import Path
+import shutil
+import socket
+import sqlite3
+import threading
+import time
+from typing import Awaitable, Callable
+import uuid
+
+from starlette.concurrency import run_in_threadpool
+
+from .exceptions import JobNotFinishedError, JobNotFoundError, QueueFullError
+from .fairshare import TaskOwner
+from .jobs import Job
+from .model.jobstatus import JobState
+from .model.ocrresult import ErrorResult
+from .model.priority import Priority
+from .ocrplugin import ProgressEvent
+from .ocrservice import OcrOutput
+from .spooling import Source, is_spooled
+
+_DATABASE = "jobs.sqlite3"
+# A job whose replica died this often is failed instead of being queued again (e.g. because it crashes every replica)
+MAX_ATTEMPTS = 3
+# Seconds between two claims while the queue is empty (new jobs of this replica are claimed immediately)
+_POLL_INTERVAL = 1
+# Seconds a connection waits for a lock held by another replica
+_LOCK_TIMEOUT = 30
+# Seconds between two evictions of expired jobs (and updates of the job counts, see DurableJobStore.state_counts)
+_HOUSEKEEPING_INTERVAL = 10
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    filename TEXT NOT NULL,
+    parameters TEXT,
+    user TEXT NOT NULL,
+    priority TEXT NOT NULL,
+    deadline REAL,
+    memory INTEGER NOT NULL,
+    input TEXT NOT NULL,
+    state TEXT NOT NULL,
+    stage TEXT,
+    pages_total INTEGER,
+    pages_done INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    finished_at REAL,
+    lease_owner TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    result TEXT,
+    error TEXT,
+    error_status_code INTEGER
+);
+CREATE INDEX IF NOT EXISTS jobs_by_state ON jobs (state, priority, created_at);
+"""
+
+# Interactive jobs are claimed first, see Priority
+_PRIORITY_ORDER = f"CASE priority WHEN '{Priority.INTERACTIVE.value}' THEN 0 ELSE 1 END"
+
+
+@dataclass
+class QueuedJob:
+    """
+    A job claimed from the DurableJobStore, with everything needed to process it.
+    """
+    job_id: str
+    filename: str
+    ocrmypdf_parameters: str | None
+    owner: TaskOwner
+    deadline: float | None
+    memory: int
+    input_path: str
+    attempt: int
+    created_at: datetime
+
+
+class DurableJobStore:
+    """
+    Persistent store of jobs shared by several replicas. Offers the same read methods as JobStore,
+    the jobs it returns are snapshots of the database (or the live jobs of this replica, see track).
+    All methods access the database, which may be locked by another replica, so they must not be called on the event loop.
+    Expired jobs are evicted in the background (see JobRunner), reads skip them until then.
+    """
+
+    def __init__(self, directory: str, ttl: float, lease: float, logger: Logger, replica_id: str | None = None):
+        self.ttl = ttl
+        self.lease = lease
+        self.logger = logger
+        self.replica_id = replica_id or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._inputs = os.path.join(directory, "inputs")
+        self._results = os.path.join(directory, "results")
+        os.makedirs(self._inputs, exist_ok=True)
+        os.makedirs(self._results, exist_ok=True)
+        # WAL mode needs shared memory, which doesn't work on network file systems, so the default journal is kept
+        self._db = sqlite3.connect(os.path.join(directory, _DATABASE), timeout=_LOCK_TIMEOUT, isolation_level=None, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        self._active: dict[str, Job] = {}
+        # Counts as of the last update_state_counts, e.g. for metrics collected on the event loop
+        self.state_counts: dict[JobState, int] = {state: 0 for state in JobState}
+        with self._lock:
+            self._db.executescript(_SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __len__(self) -> int:
+        return self._query("SELECT COUNT(*) FROM jobs")[0][0]
+
+    def count_by_state(self) -> dict[JobState, int]:
+        counts = {state: 0 for state in JobState}
+        for state, count in self._query("SELECT state, COUNT(*) FROM jobs GROUP BY state"):
+            counts[JobState(state)] = count
+        return counts
+
+    def update_state_counts(self):
+        self.state_counts = self.count_by_state()
+
+    def create(self, job_id: str, filename: str, ocrmypdf_parameters: str | None, owner: TaskOwner, deadline: float | None,
+               memory: int, source: Source) -> tuple[Job, bool]:
+        """
+        Queues a job with a copy of the given input. Job ids are idempotent: if a job with the given id
+        already exists, it is returned instead and nothing is queued. Returns the job and whether it was created.
+        """
+        self.evict_expired()
+        existing = self.find(job_id)
+        if existing is not None:
+            return existing, False
+        # Unique per attempt to create the job, so that replicas racing for the same job id don't overwrite each other's input
+        input_name = f"{job_id}-{uuid.uuid4().hex}"
+        input_path = os.path.join(self._inputs, input_name)
+        if is_spooled(source):
+            shutil.copyfile(source, input_path)
+        else:
+            with open(input_path, "wb") as file:
+                file.write(source)
+        with self._transaction() as db:
+            created = db.execute(
+                "INSERT OR IGNORE INTO jobs (job_id, filename, parameters, user, priority, deadline, memory, input, state, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, filename, ocrmypdf_parameters, owner.user, owner.priority.value, deadline, memory, input_name,
+                 JobState.QUEUED.value, time.time())).rowcount == 1
+        if not created:
+            Path(input_path).unlink(missing_ok=True)
+        return self.get(job_id), created
+
+    def find(self, job_id: str) -> Job | None:
+        active = self._active.get(job_id)
+        if active is not None:
+            return active
+        rows = self._query("SELECT * FROM jobs WHERE job_id = ? AND (finished_at IS NULL OR finished_at > ?)", (job_id, time.time() - self.ttl))
+        return self._to_job(rows[0]) if rows else None
+
+    def get(self, job_id: str) -> Job:
+        job = self.find(job_id)
+        if job is None:
+            raise JobNotFoundError(job_id)
+        return job
+
+    def get_result(self, job_id: str) -> Job:
+        job = self.get(job_id)
+        if not job.finished:
+            raise JobNotFinishedError(job_id)
+        return job
+
+    def claim(self) -> QueuedJob | None:
+        """
+        Leases the next queued job (or a job whose lease expired) to this replica. Interactive jobs are claimed
+        before bulk jobs, older jobs before newer ones. Returns None if there is no job to claim.
+        """
+        now = time.time()
+        with self._transaction() as db:
+            abandoned = db.execute("SELECT job_id, input FROM jobs WHERE state = ? AND lease_expires < ? AND attempts >= ?",
+                                   (JobState.RUNNING.value, now, MAX_ATTEMPTS)).fetchall()
+            for row in abandoned:
+                error = ErrorResult(message=f"Job was abandoned by {MAX_ATTEMPTS} workers (e.g. because they crashed), giving up")
+                self._finish(db, row["job_id"], JobState.FAILED, now, error=error.model_dump_json(by_alias=True, exclude_none=True), error_status_code=500)
+            row = db.execute(
+                f"SELECT * FROM jobs WHERE state = ? OR (state = ? AND lease_expires < ?) ORDER BY {_PRIORITY_ORDER}, created_at LIMIT 1",
+                (JobState.QUEUED.value, JobState.RUNNING.value, now)).fetchone()
+            if row is not None:
+                db.execute("UPDATE jobs SET state = ?, stage = NULL, pages_total = NULL, pages_done = 0, lease_owner = ?, lease_expires = ?, "
+                           "attempts = attempts + 1 WHERE job_id = ?",
+                           (JobState.RUNNING.value, self.replica_id, now + self.lease, row["job_id"]))
+        for abandoned_row in abandoned:
+            self.logger.warning(f"Job {abandoned_row['job_id']} failed after {MAX_ATTEMPTS} attempts")
+            Path(self._inputs, abandoned_row["input"]).unlink(missing_ok=True)
+        if row is None:
+            return None
+        if row["state"] == JobState.RUNNING.value:
+            self.logger.info(f"Lease of job {row['job_id']} held by {row['lease_owner']} expired, job is processed again")
+        return QueuedJob(
+            job_id=row["job_id"], filename=row["filename"], ocrmypdf_parameters=row["parameters"],
+            owner=TaskOwner(row["user"], Priority(row["priority"])), deadline=row["deadline"], memory=row["memory"],
+            input_path=os.path.join(self._inputs, row["input"]), attempt=row["attempts"] + 1,
+            created_at=datetime.fromtimestamp(row["created_at"], timezone.utc))
+
+    def track(self, job: Job):
+        """
+        Registers a job claimed by this replica, so that its current progress is returned instead of the one of the last renew.
+        """
+        self._active[job.job_id] = job
+
+    def untrack(self, job_id: str):
+        self._active.pop(job_id, None)
+
+    def renew(self, job: Job) -> bool:
+        """
+        Extends the lease of the given job and persists its progress.
+        Returns False if this replica lost the lease (i.e. another replica may already process the job).
+        """
+        with self._transaction() as db:
+            return db.execute(
+                "UPDATE jobs SET lease_expires = ?, stage = ?, pages_total = ?, pages_done = ? WHERE job_id = ? AND state = ? AND lease_owner = ?",
+                (time.time() + self.lease, job.stage, job.pages_total, job.pages_done, job.job_id, JobState.RUNNING.value, self.replica_id)).rowcount == 1
+
+    def release(self, job_id: str):
+        """
+        Returns a job claimed by this replica to the queue, e.g. on shutdown, without counting it as an attempt.
+        """
+        with self._transaction() as db:
+            db.execute("UPDATE jobs SET state = ?, lease_owner = NULL, lease_expires = NULL, attempts = attempts - 1 "
+                       "WHERE job_id = ? AND state = ? AND lease_owner = ?",
+                       (JobState.QUEUED.value, job_id, JobState.RUNNING.value, self.replica_id))
+
+    def succeed(self, job: Job, output: OcrOutput) -> bool:
+        """
+        Moves the output file of the given job to the shared volume and marks the job as succeeded.
+        Returns False (and discards the output) if this replica lost the lease of the job.
+        """
+        result_path = os.path.join(self._results, f"{job.job_id}-{uuid.uuid4().hex}")
+        shutil.move(output.file_path, result_path)
+        result = json.dumps({"filename": output.filename, "content_type": output.content_type, "recognized_text": output.recognized_text,
+                             "file": os.path.basename(result_path), "detected_languages": output.detected_languages})
+        if not self._finish_leased(job, JobState.SUCCEEDED, result=result):
+            Path(result_path).unlink(missing_ok=True)
+            return False
+        return True
+
+    def fail(self, job: Job, error: ErrorResult, status_code: int) -> bool:
+        """
+        Marks the given job as failed. Returns False if this replica lost the lease of the job.
+        """
+        return self._finish_leased(job, JobState.FAILED, error=error.model_dump_json(by_alias=True, exclude_none=True), error_status_code=status_code)
+
+    def evict_expired(self):
+        """
+        Deletes jobs which finished more than `ttl` seconds ago, together with their output files.
+        """
+        # Checked without a write lock first, as this runs whenever a job is created
+        expired = self._query("SELECT job_id, result FROM jobs WHERE finished_at <= ?", (time.time() - self.ttl,))
+        if not expired:
+            return
+        with self._transaction() as db:
+            db.executemany("DELETE FROM jobs WHERE job_id = ?", [(row["job_id"],) for row in expired])
+        for row in expired:
+            if row["result"] is not None:
+                Path(self._results, json.loads(row["result"])["file"]).unlink(missing_ok=True)
+
+    def _finish_leased(self, job: Job, state: JobState, **columns) -> bool:
+        with self._transaction() as db:
+            row = db.execute("SELECT input FROM jobs WHERE job_id = ? AND state = ? AND lease_owner = ?",
+                             (job.job_id, JobState.RUNNING.value, self.replica_id)).fetchone()
+            if row is None:
+                return False
+            self._finish(db, job.job_id, state, time.time(), stage=job.stage, pages_total=job.pages_total, pages_done=job.pages_done, **columns)
+        Path(self._inputs, row["input"]).unlink(missing_ok=True)
+        return True
+
+    def _finish(self, db: sqlite3.Connection, job_id: str, state: JobState, finished_at: float, **columns):
+        assignments = "".join(f", {column} = ?" for column in columns)
+        db.execute(f"UPDATE jobs SET state = ?, finished_at = ?, lease_owner = NULL, lease_expires = NULL{assignments} WHERE job_id = ?",
+                   (state.value, finished_at, *columns.values(), job_id))
+
+    def _to_job(self, row: sqlite3.Row) -> Job:
+        result = None
+        if row["result"] is not None:
+            stored = json.loads(row["result"])
+            result = OcrOutput(stored["filename"], stored["content_type"], stored["recognized_text"],
+                               os.path.join(self._results, stored["file"]), stored["detected_languages"])
+        return Job(
+            job_id=row["job_id"], filename=row["filename"], state=JobState(row["state"]), stage=row["stage"],
+            pages_total=row["pages_total"], pages_done=row["pages_done"],
+            created_at=datetime.fromtimestamp(row["created_at"], timezone.utc),
+            finished_at=datetime.fromtimestamp(row["finished_at"], timezone.utc) if row["finished_at"] is not None else None,
+            result=result, error=ErrorResult.model_validate_json(row["error"]) if row["error"] is not None else None,
+            error_status_code=row["error_status_code"] or 500)
+
+    def _query(self, sql: str, parameters: tuple = ()) -> list[sqlite3.Row]:
+        with self._lock:
+            return self._db.execute(sql, parameters).fetchall()
+
+    def _transaction(self) -> "_Transaction":
+        return _Transaction(self._db, self._lock)
+
+
+class _Transaction:
+    """
+    Write transaction which takes the database lock right away (BEGIN IMMEDIATE),
+    so that two replicas can't claim the same job.
+    """
+
+    def __init__(self, db: sqlite3.Connection, lock: threading.Lock):
+        self._db = db
+        self._lock = lock
+
+    def __enter__(self) -> sqlite3.Connection:
+        self._lock.acquire()
+        try:
+            self._db.execute("BEGIN IMMEDIATE")
+        except BaseException:
+            self._lock.release()
+            raise
+        return self._db
+
+    def __exit__(self, exc_type, exc, traceback):
+        try:
+            self._db.execute("ROLLBACK" if exc_type is not None else "COMMIT")
+        finally:
+            self._lock.release()
+
+
+ProcessJob = Callable[[QueuedJob, Callable[[ProgressEvent], None]], Awaitable[OcrOutput]]
+ErrorConverter = Callable[[Exception], tuple[ErrorResult, int]]
+
+
+class JobRunner:
+    """
+    Claims jobs from a DurableJobStore and processes them (see ProcessJob), at most `concurrency` at the same time.
+    Renews the leases of the running jobs every third of the lease time and cancels a job if its lease was lost.
+    Jobs which are rejected because the local queue is full are returned to the queue, so that other replicas can take them.
+    Expired jobs are evicted and the job counts are updated every few seconds.
+    """
+
+    def __init__(self, store: DurableJobStore, process: ProcessJob, to_error: ErrorConverter, concurrency: int, logger: Logger):
+        self.store = store
+        self.process = process
+        self.to_error = to_error
+        self.logger = logger
+        self._slots = asyncio.Semaphore(concurrency)
+        self._wakeup = asyncio.Event()
+        self._claimer: asyncio.Task | None = None
+        self._housekeeper: asyncio.Task | None = None
+        self._running: dict[str, asyncio.Task] = {}
+
+    def start(self):
+        self._claimer = asyncio.ensure_future(self._claim_jobs())
+        self._housekeeper = asyncio.ensure_future(self._housekeeping())
+
+    async def stop(self):
+        """
+        Stops claiming jobs and returns the running jobs to the queue.
+        """
+        tasks = [task for task in (self._claimer, self._housekeeper, *self._running.values()) if task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._claimer = None
+        self._housekeeper = None
+
+    def wakeup(self):
+        """
+        Claims the next job right away, e.g. because a job was just queued.
+        """
+        self._wakeup.set()
+
+    async def _claim_jobs(self):
+        while True:
+            await self._slots.acquire()
+            try:
+                job = await run_in_threadpool(self.store.claim)
+            except (OSError, sqlite3.Error) as exc:
+                self.logger.warning(f"Failed to claim job: {exc}")
+                job = None
+            if job is None:
+                self._slots.release()
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), _POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            self._running[job.job_id] = asyncio.ensure_future(self._run(job))
+
+    async def _housekeeping(self):
+        while True:
+            try:
+                await run_in_threadpool(self.store.evict_expired)
+                await run_in_threadpool(self.store.update_state_counts)
+            except (OSError, sqlite3.Error) as exc:
+                self.logger.warning(f"Failed to evict expired jobs: {exc}")
+            await asyncio.sleep(_HOUSEKEEPING_INTERVAL)
+
+    async def _run(self, queued: QueuedJob):
+        job = Job(job_id=queued.job_id, filename=queued.filename, state=JobState.RUNNING, created_at=queued.created_at)
+        self.store.track(job)
+        processing = asyncio.ensure_future(self.process(queued, job.on_progress))
+        heartbeat = asyncio.ensure_future(self._renew_lease(job, processing))
+        try:
+            try:
+                output = await processing
+            except asyncio.CancelledError:
+                if heartbeat.done() and not heartbeat.result():
+                    # Lease lost, the job belongs to another replica now
+                    return
+                raise
+            except QueueFullError:
+                self.logger.debug(f"Queue is full, returning job {job.job_id} to the job queue")
+                await run_in_threadpool(self.store.release, job.job_id)
+                # Leave the job to other replicas for a moment
+                await asyncio.sleep(_POLL_INTERVAL)
+                return
+            except Exception as exc:
+                self.logger.debug(f"Job {job.job_id} failed: {exc}")
+                error, status_code = self.to_error(exc)
+                await run_in_threadpool(self.store.fail, job, error, status_code)
+                return
+            if not await run_in_threadpool(self.store.succeed, job, output):
+                self.logger.warning(f"Lost the lease of job {job.job_id} before it finished, discarding its result")
+        except asyncio.CancelledError:
+            processing.cancel()
+            await run_in_threadpool(self.store.release, job.job_id)
+            raise
+        finally:
+            heartbeat.cancel()
+            self.store.untrack(job.job_id)
+            self._running.pop(job.job_id, None)
+            self._slots.release()
+
+    async def _renew_lease(self, job: Job, processing: asyncio.Future) -> bool:
+        while True:
+            await asyncio.sleep(self.store.lease / 3)
+            try:
+                renewed = await run_in_threadpool(self.store.renew, job)
+            except (OSError, sqlite3.Error) as exc:
+                # Retried with the next heartbeat, the lease lasts for two more of them
+                self.logger.warning(f"Failed to renew the lease of job {job.job_id}: {exc}")
+                continue
+            if not renewed:
+                self.logger.warning(f"Lost the lease of job {job.job_id}, cancelling it")
+                processing.cancel()
+                return False
@@ -0,0 +1,125 @@
+import asyncio
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+import uuid
+
+from .exceptions import JobNotFinishedError, JobNotFoundError
+from .model.jobstatus import JobState, JobStatus
+from .model.ocrresult import ErrorResult
+from .ocrplugin import PAGE_STAGES, PAGE_TEXT_STAGE, ProgressEvent
+from .ocrservice import OcrOutput
+
+
+@dataclass
+class Job:
+    job_id: str
+    filename: str
+    state: JobState = JobState.QUEUED
+    stage: str | None = None
+    pages_total: int | None = None
+    pages_done: int = 0
+    created_at: datetime = field(default_factory=lambda: datetime.now(timezone.utc))
+    finished_at: datetime | None = None
+    result: OcrOutput | None = None
+    error: ErrorResult | None = None
+    error_status_code: int = 500
+    task: asyncio.Future | None = None
+
+    @property
+    def finished(self) -> bool:
+        return self.state in (JobState.SUCCEEDED, JobState.FAILED)
+
+    def on_progress(self, event: ProgressEvent):
+        if self.finished or event.stage == PAGE_TEXT_STAGE:
+            return
+        self.state = JobState.RUNNING
+        self.stage = event.stage
+        if event.unit == "page" and event.stage in PAGE_STAGES:
+            self.pages_total = int(event.total) if event.total is not None else None
+            self.pages_done = int(event.completed)
+
+    def succeed(self, result: OcrOutput):
+        self.result = result
+        self._finish(JobState.SUCCEEDED)
+
+    def fail(self, error: ErrorResult, status_code: int):
+        self.error = error
+        self.error_status_code = status_code
+        self._finish(JobState.FAILED)
+
+    def discard(self):
+        """
+        Deletes the output file of the job (if any).
+        """
+        if self.result is not None:
+            Path(self.result.file_path).unlink(missing_ok=True)
+            self.result = None
+
+    def status(self) -> JobStatus:
+        return JobStatus(
+            job_id=self.job_id, filename=self.filename, state=self.state, stage=self.stage,
+            pages_total=self.pages_total, pages_done=self.pages_done,
+            created_at=self.created_at, finished_at=self.finished_at, error=self.error)
+
+    def _finish(self, state: JobState):
+        self.state = state
+        self.finished_at = datetime.now(timezone.utc)
+        self.task = None
+
+
+class JobStore:
+    """
+    In-process store for asynchronously processed OCR jobs.
+    Finished jobs are evicted after `ttl` seconds, together with their output files.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = timedelta(seconds=ttl)
+        self._jobs: dict[str, Job] = {}
+
+    def __len__(self) -> int:
+        return len(self._jobs)
+
+    def count_by_state(self) -> dict[JobState, int]:
+        counts = {state: 0 for state in JobState}
+        for job in self._jobs.values():
+            counts[job.state] += 1
+        return counts
+
+    def create(self, filename: str, job_id: str | None = None) -> Job:
+        self.evict_expired()
+        job = Job(job_id=job_id or uuid.uuid4().hex, filename=filename)
+        self._jobs[job.job_id] = job
+        return job
+
+    def find(self, job_id: str) -> Job | None:
+        self.evict_expired()
+        return self._jobs.get(job_id)
+
+    def get(self, job_id: str) -> Job:
+        job = self.find(job_id)
+        if job is None:
+            raise JobNotFoundError(job_id)
+        return job
+
+    def get_result(self, job_id: str) -> Job:
+        job = self.get(job_id)
+        if not job.finished:
+            raise JobNotFinishedError(job_id)
+        return job
+
+    def remove(self, job_id: str):
+        job = self._jobs.pop(job_id, None)
+        if job is not None:
+            job.discard()
+
+    def clear(self):
+        for job_id in list(self._jobs):
+            self.remove(job_id)
+
+    def evict_expired(self):
+        now = datetime.now(timezone.utc)
+        expired = [job_id for job_id, job in self._jobs.items() if job.finished and job.finished_at + self.ttl <= now]
+        for job_id in expired:
+            self.remove(job_id)
@@ -0,0 +1,212 @@
+"""
+Narrows the languages passed to Tesseract down to the ones actually used in a document (see OcrService, OCR_AUTO_LANGUAGE).
+Tesseract's runtime grows with every language, so a few sample pages are inspected first:
+their script is detected by Tesseract's orientation and script detection (OSD), languages of
+the same script are told apart by the stopwords in the recognized texts of the sample pages.
+"""
+from logging import Logger
+import os
+import re
+import subprocess
+import tempfile
+from typing import BinaryIO, Iterable
+
+import pikepdf
+from PIL import Image
+
+# Scripts as reported by OSD, languages which are not listed here are never dropped
+_SCRIPTS: dict[str, set[str]] = {
+    **{language: {"Latin", "Fraktur"} for language in (
+        "eng", "deu", "fra", "ita", "spa", "por", "nld", "dan", "nor", "swe", "fin", "pol", "ces", "slk",
+        "hun", "ron", "hrv", "slv", "tur", "cat", "est", "lav", "lit", "isl", "gle", "vie", "ind", "frk")},
+    **{language: {"Cyrillic"} for language in ("rus", "ukr", "bel", "bul", "mkd", "srp", "kaz")},
+    "ell": {"Greek"},
+    **{language: {"Arabic"} for language in ("ara", "fas", "urd", "pus")},
+    "heb": {"Hebrew"},
+    **{language: {"Devanagari"} for language in ("hin", "mar", "nep", "san")},
+    "ben": {"Bengali"},
+    "tam": {"Tamil"},
+    "tel": {"Telugu"},
+    "kan": {"Kannada"},
+    "mal": {"Malayalam"},
+    "guj": {"Gujarati"},
+    "pan": {"Gurmukhi"},
+    "tha": {"Thai"},
+    "kor": {"Hangul", "Han"},
+    "jpn": {"Japanese", "Han", "Hiragana", "Katakana"},
+    "chi_sim": {"Han"},
+    "chi_tra": {"Han"},
+    "kat": {"Georgian"},
+    "hye": {"Armenian"},
+}
+
+# Frequent words which are (mostly) specific to a language, used to tell languages of the same script apart
+_STOPWORDS: dict[str, set[str]] = {
+    "eng": {"the", "and", "of", "to", "is", "that", "for", "with", "this", "are", "was", "be", "have", "from", "by", "which"},
+    "deu": {"der", "die", "und", "das", "ist", "nicht", "mit", "den", "von", "zu", "ein", "eine", "sich", "auf", "für", "dem", "des", "im", "auch", "wir"},
+    "fra": {"le", "les", "et", "est", "une", "des", "du", "pour", "dans", "qui", "pas", "sur", "avec", "ce", "cette", "aux", "sont", "nous", "vous"},
+    "ita": {"il", "di", "che", "gli", "della", "delle", "non", "sono", "nel", "alla", "anche", "questo", "è", "dei", "più", "essere"},
+    "spa": {"el", "los", "las", "y", "del", "por", "una", "es", "se", "como", "pero", "más", "está", "muy", "también", "su"},
+    "por": {"o", "os", "do", "da", "dos", "das", "em", "não", "um", "uma", "com", "são", "mais", "ao", "pelo", "também"},
+    "nld": {"het", "een", "en", "van", "dat", "op", "te", "zijn", "voor", "met", "niet", "aan", "er", "ook", "wordt"},
+    "pol": {"i", "w", "na", "nie", "się", "z", "jest", "to", "że", "do", "jak", "są", "oraz", "przez"},
+    "swe": {"och", "att", "det", "som", "en", "är", "av", "för", "med", "till", "den", "inte", "har", "om"},
+    "dan": {"og", "at", "det", "som", "en", "er", "af", "for", "med", "til", "den", "ikke", "har", "om"},
+}
+
+_OSD_SCRIPT = re.compile(r"^Script: (\S+)\s*$", re.MULTILINE)
+_OSD_SCRIPT_CONFIDENCE = re.compile(r"^Script confidence: ([\d.]+)\s*$", re.MULTILINE)
+_WORD = re.compile(r"\w+")
+
+# Number of pages whose script is detected
+_SAMPLE_PAGES = 3
+# Sample images are downscaled to at most this size (pixels of the longer side)
+_MAX_SAMPLE_SIZE = 2500
+# Text detection recognizes the sample pages once more, it's only worth it if the document has clearly more pages
+_MIN_PAGES_FOR_TEXT_DETECTION = 2 * _SAMPLE_PAGES
+# A language is kept if it has at least this number of stopwords and this share of the stopwords of the best language
+_MIN_STOPWORDS = 3
+_MIN_STOPWORD_SHARE = 0.3
+_TESSERACT_TIMEOUT = 60
+
+
+def narrow_by_script(languages: list[str], scripts: Iterable[str]) -> list[str]:
+    """
+    Returns the languages written in one of the given scripts (and all languages of unknown script).
+    """
+    scripts = set(scripts)
+    if not scripts:
+        return languages
+    narrowed = [language for language in languages if _SCRIPTS.get(_base_language(language), scripts) & scripts]
+    return narrowed or languages
+
+
+def narrow_by_text(languages: list[str], texts: Iterable[str]) -> list[str]:
+    """
+    Returns the languages whose stopwords occur (often enough) in at least one of the given texts of sample pages
+    (and all languages without stopwords): a language used on some pages only must not be dropped for the whole document.
+    """
+    kept: set[str] = set()
+    decided = False
+    for text in texts:
+        kept.update(_narrow_by_page_text(languages, text))
+        decided = True
+    if not decided:
+        return languages
+    return [language for language in languages if language in kept]
+
+
+def _narrow_by_page_text(languages: list[str], text: str) -> list[str]:
+    words = [word.lower() for word in _WORD.findall(text)]
+    hits = {language: sum(1 for word in words if word in _STOPWORDS[_base_language(language)])
+            for language in languages if _base_language(language) in _STOPWORDS}
+    best = max(hits.values(), default=0)
+    if best < _MIN_STOPWORDS:
+        # Not enough text to decide
+        return languages
+    return [language for language in languages
+            if language not in hits or (hits[language] >= _MIN_STOPWORDS and hits[language] >= _MIN_STOPWORD_SHARE * best)]
+
+
+def _base_language(language: str) -> str:
+    return language.removesuffix("_vert")
+
+
+class LanguageDetector:
+    def __init__(self, logger: Logger):
+        self.logger = logger
+
+    def detect(self, file: BinaryIO | str, languages: list[str], page_numbers: list[int] | None = None) -> list[str]:
+        """
+        Returns the smallest subset of the given languages (in the given order) matching the sample pages,
+        which are taken from page_numbers (0-based, all pages if None). Returns the given languages if
+        nothing can be detected, e.g. because Tesseract's "osd" data is not installed.
+        """
+        if len(languages) <= 1:
+            return languages
+        with tempfile.TemporaryDirectory(prefix="ocr-languages-") as sample_dir:
+            samples, page_count = self._sample_images(file, page_numbers, sample_dir)
+            if not samples:
+                return languages
+            scripts = [script for sample in samples if (script := self._detect_script(sample)) is not None]
+            narrowed = narrow_by_script(languages, scripts)
+            if len(narrowed) > 1 and page_count >= _MIN_PAGES_FOR_TEXT_DETECTION and sum(_base_language(language) in _STOPWORDS for language in narrowed) > 1:
+                texts = [text for sample in samples if (text := self._recognize(sample, narrowed)) is not None]
+                narrowed = narrow_by_text(narrowed, texts)
+        self.logger.debug(f"Detected scripts {scripts}, narrowed languages {'+'.join(languages)} to {'+'.join(narrowed)}")
+        return narrowed
+
+    def _sample_images(self, file: BinaryIO | str, page_numbers: list[int] | None, sample_dir: str) -> tuple[list[str], int]:
+        """
+        Writes the largest image of up to _SAMPLE_PAGES evenly distributed pages to sample_dir.
+        Returns the paths of the images and the number of pages to choose from.
+        """
+        try:
+            try:
+                with pikepdf.open(file) as pdf:
+                    candidates = page_numbers if page_numbers is not None else list(range(len(pdf.pages)))
+                    images = [self._largest_image(pdf.pages[index]) for index in _evenly_distributed(candidates, _SAMPLE_PAGES)]
+            except pikepdf.PdfError:
+                if not isinstance(file, str):
+                    file.seek(0)
+                with Image.open(file) as image:
+                    image.load()
+                    candidates, images = [0], [image.copy()]
+        except (OSError, ValueError, Image.DecompressionBombError):
+            return [], 0
+        finally:
+            if not isinstance(file, str):
+                file.seek(0)
+
+        paths = []
+        for index, image in enumerate(image for image in images if image is not None):
+            image.thumbnail((_MAX_SAMPLE_SIZE, _MAX_SAMPLE_SIZE))
+            if image.mode not in ("1", "L", "RGB"):
+                image = image.convert("RGB")
+            path = os.path.join(sample_dir, f"sample-{index}.png")
+            image.save(path)
+            paths.append(path)
+        return paths, len(candidates)
+
+    def _largest_image(self, page: pikepdf.Page) -> Image.Image | None:
+        images = list(page.get_images().values())
+        if not images:
+            return None
+        largest = max(images, key=lambda image: int(image.get("/Width", 0)) * int(image.get("/Height", 0)))
+        try:
+            return pikepdf.PdfImage(largest).as_pil_image()
+        except Exception as exc:
+            # E.g. unsupported image filters
+            self.logger.debug(f"Failed to extract sample image: {exc}")
+            return None
+
+    def _detect_script(self, path: str) -> str | None:
+        output = self._tesseract(path, "osd", "--psm", "0")
+        script = _OSD_SCRIPT.search(output or "")
+        confidence = _OSD_SCRIPT_CONFIDENCE.search(output or "")
+        # OSD reports a script with zero confidence if there is (almost) no text
+        if script is None or confidence is None or float(confidence[1]) <= 0:
+            return None
+        return script[1]
+
+    def _recognize(self, path: str, languages: list[str]) -> str | None:
+        return self._tesseract(path, "+".join(languages))
+
+    def _tesseract(self, path: str, languages: str, *args: str) -> str | None:
+        try:
+            result = subprocess.run(["tesseract", path, "stdout", "-l", languages, *args],
+                                    capture_output=True, text=True, timeout=_TESSERACT_TIMEOUT)
+        except (OSError, subprocess.TimeoutExpired) as exc:
+            self.logger.debug(f"Tesseract failed on sample page: {exc}")
+            return None
+        if result.returncode != 0:
+            self.logger.debug(f"Tesseract failed on sample page: {result.stderr.strip()}")
+            return None
+        return result.stdout
+
+
+def _evenly_distributed(items: list[int], count: int) -> list[int]:
+    if len(items) <= count:
+        return items
+    step = len(items) / count
+    return [items[int(index * step)] for index in range(count)]
@@ -0,0 +1,71 @@
+from logging import Logger
+import os
+import threading
+
+import ocrmypdf
+
+from .exceptions import UnknownLanguageError
+from .model.engineinfo import EngineInfo
+from .ocrservice import OcrService
+
+
+class LanguageCatalog:
+    """
+    Keeps the installed Tesseract languages and the OCR engine versions in memory, so that
+    Tesseract doesn't have to be spawned on every request. The information is refreshed
+    explicitly (refresh()) or if the tessdata directory changed.
+    """
+
+    def __init__(self, logger: Logger):
+        self.logger = logger
+        self._lock = threading.Lock()
+        self._info: EngineInfo | None = None
+        self._tessdata_mtime: float | None = None
+
+    @property
+    def engine_version(self) -> str:
+        info = self.current()
+        return f"ocrmypdf {info.ocrmypdf_version}, tesseract {info.tesseract_version}"
+
+    def current(self) -> EngineInfo:
+        if self._info is None or self._tessdata_changed():
+            return self.refresh()
+        return self._info
+
+    def refresh(self) -> EngineInfo:
+        with self._lock:
+            service = OcrService(self.logger)
+            try:
+                languages, tessdata_dir = service.language_info()
+                tesseract_version = service.tesseract_version()
+            except FileNotFoundError:
+                self.logger.warning("Tesseract not found, no languages available")
+                languages, tessdata_dir, tesseract_version = [], None, "not found"
+            self._info = EngineInfo(languages=languages, tesseract_version=tesseract_version, ocrmypdf_version=ocrmypdf.__version__, tessdata_dir=tessdata_dir)
+            self._tessdata_mtime = _mtime(tessdata_dir)
+            self.logger.debug(f"Loaded {len(languages)} Tesseract languages from {tessdata_dir} (Tesseract {tesseract_version})")
+            return self._info
+
+    def validate(self, languages: list[str]):
+        """
+        Raises UnknownLanguageError if any of the given languages is not installed.
+        """
+        installed = self.current().languages
+        if not installed:
+            # Tesseract itself is missing, OCRmyPDF will report that in more detail
+            return
+        unknown = [lang for lang in languages if lang not in installed]
+        if unknown:
+            raise UnknownLanguageError(unknown)
+
+    def _tessdata_changed(self) -> bool:
+        return _mtime(self._info.tessdata_dir) != self._tessdata_mtime
+
+
+def _mtime(directory: str | None) -> float | None:
+    if directory is None:
+        return None
+    try:
+        return os.stat(directory).st_mtime
+    except OSError:
+        return None
@@ -0,0 +1,242 @@
+"""
+Minimal Prometheus instrumentation (text exposition format 0.0.4), exposed via /metrics.
+Instruments are module-level, so every part of the backend can record without passing them around.
+Values which are already known elsewhere (queue depth, cache size, ...) are collected at scrape time.
+"""
+import bisect
+import math
+import os
+import threading
+from typing import Callable, Iterable, Iterator
+
+from .model.ocrresult import ErrorResult
+from .ocrplugin import ProgressEvent
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Stages of a request, see STAGE_SECONDS
+STAGE_UPLOAD = "upload"
+STAGE_QUEUE = "queue"
+STAGE_OCR = "ocr"
+STAGE_SERIALIZATION = "serialization"
+STAGE_RESPONSE = "response"
+
+# Reasons of CANCELLED
+CANCELLED_DISCONNECT = "disconnect"
+CANCELLED_DEADLINE = "deadline"
+
+Labels = tuple[str, ...]
+Sample = tuple[str, dict[str, str], float]
+
+
+class _Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict[str, str]) -> Labels:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} requires the labels {self.labelnames}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> Iterator[Sample]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> Iterator[Sample]:
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield self.name, dict(zip(self.labelnames, key)), value
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, buckets: Iterable[float], labelnames: Iterable[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = sorted(buckets)
+        # Per label set: counts per bucket (last one is +Inf) and the sum of all observations
+        self._values: dict[Labels, tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.setdefault(key, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            total[0] += value
+
+    def samples(self) -> Iterator[Sample]:
+        with self._lock:
+            values = [(key, list(counts), total[0]) for key, (counts, total) in self._values.items()]
+        for key, counts, total in values:
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + [math.inf], counts):
+                cumulative += count
+                yield f"{self.name}_bucket", {**labels, "le": _format_value(bound)}, cumulative
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, cumulative
+
+
+class Gauge(_Metric):
+    """
+    Gauge whose value is determined by a callback at scrape time. The callback returns
+    the value (None if unknown) or, for gauges with labels, a mapping of label values to values.
+    """
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, collect: Callable[[], float | dict[Labels, float] | None], labelnames: Iterable[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.collect = collect
+
+    def samples(self) -> Iterator[Sample]:
+        values = self.collect()
+        if values is None:
+            return
+        if not isinstance(values, dict):
+            values = {(): values}
+        for key, value in values.items():
+            yield self.name, dict(zip(self.labelnames, key)), value
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        # Re-registering replaces the metric, e.g. scrape time gauges bound to a new app instance
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {_escape(metric.documentation)}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in metric.samples():
+                if labels:
+                    label_text = ",".join(f'{key}="{_escape(value, quote=True)}"' for key, value in labels.items())
+                    lines.append(f"{name}{{{label_text}}} {_format_value(value)}")
+                else:
+                    lines.append(f"{name} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+_SECONDS_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+_BYTES_BUCKETS = tuple(16 * 1024 * 4 ** exponent for exponent in range(9))  # 16 KiB ... 1 GiB
+
+HTTP_REQUESTS = REGISTRY.register(Counter(
+    "ocr_http_requests_total", "HTTP requests by route and status code", ("method", "route", "status")))
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    "ocr_stage_duration_seconds",
+    "Duration of the stages of a request: upload (reading/spooling the upload), queue (waiting for a free worker), "
+    "ocr (from submission until the result is available, including the queue), serialization (base64 encoding) "
+    "and response (writing the response body)",
+    _SECONDS_BUCKETS, ("stage",)))
+INPUT_BYTES = REGISTRY.register(Histogram("ocr_input_bytes", "Size of the uploaded documents", _BYTES_BUCKETS))
+OUTPUT_BYTES = REGISTRY.register(Histogram("ocr_output_bytes", "Size of the resulting PDFs", _BYTES_BUCKETS))
+PAGES = REGISTRY.register(Counter("ocr_pages_total", "Number of pages processed by Tesseract"))
+CANCELLED = REGISTRY.register(Counter(
+    "ocr_cancelled_total", "OCR requests and jobs cancelled before they finished, by reason (disconnect or deadline)", ("reason",)))
+WORKER_RECYCLES = REGISTRY.register(Counter("ocr_worker_recycles_total", "Number of workers replaced due to the memory limit"))
+ERRORS = REGISTRY.register(Counter(
+    "ocr_errors_total", "Failed OCR requests and jobs by HTTP status code and OCRmyPDF exit code", ("status", "exit_code")))
+
+
+class RequestCounterMiddleware:
+    """
+    Counts all HTTP requests by method, route template (e.g. /jobs/{job_id}, so that the number of label values stays bounded)
+    and status code. A pure ASGI middleware, as BaseHTTPMiddleware hides client disconnects from request.is_disconnected().
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = None
+
+        async def counting_send(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        await self.app(scope, receive, counting_send)
+        if status is not None:
+            route = scope.get("route")
+            HTTP_REQUESTS.inc(method=scope["method"], route=route.path if route is not None else "unmatched", status=str(status))
+
+
+def record_error(error: ErrorResult, status_code: int):
+    exit_code = error.ocr_my_pdf_exit_code
+    ERRORS.inc(status=str(status_code), exit_code=str(exit_code) if exit_code is not None else "none")
+
+
+def record_file_size(histogram: Histogram, path: str):
+    try:
+        histogram.observe(os.path.getsize(path))
+    except OSError:
+        pass
+
+
+def count_pages(on_event: Callable[[ProgressEvent], None] | None = None) -> Callable[[ProgressEvent], None]:
+    """
+    Returns a progress event callback which counts the pages processed by Tesseract
+    and forwards all events to on_event.
+    """
+    completed = 0.0
+
+    def callback(event: ProgressEvent):
+        nonlocal completed
+        if event.stage == "OCR" and event.unit == "page" and event.completed > completed:
+            PAGES.inc(event.completed - completed)
+            completed = event.completed
+        if on_event is not None:
+            on_event(event)
+    return callback
+
+
+def resident_memory(pid: int | str = "self") -> int | None:
+    """
+    Returns the resident set size of the given process in bytes (None if unknown, e.g. on non-Linux systems).
+    """
+    try:
+        with open(f"/proc/{pid}/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _escape(text: str, quote: bool = False) -> str:
+    text = text.replace("\\", "\\\\").replace("\n", "\\n")
+    return text.replace('"', '\\"') if quote else text
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
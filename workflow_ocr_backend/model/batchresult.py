@@ -0,0 +1,9 @@
+from pydantic import BaseModel, Field
+
+from .ocrresult import ErrorResult, OcrResult
+
+class BatchItemResult(BaseModel):
+    filename: str = Field(description='Name of the file')
+    status_code: int = Field(serialization_alias='statusCode', description='HTTP status code /process_ocr would have returned for this file')
+    result: OcrResult | None = Field(default=None, description='Result, if the file was processed successfully')
+    error: ErrorResult | None = Field(default=None, description='Error, if processing the file failed')
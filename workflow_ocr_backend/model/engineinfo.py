@@ -0,0 +1,7 @@
+from pydantic import BaseModel, Field
+
+class EngineInfo(BaseModel):
+    languages: list[str] = Field(description='Installed Tesseract languages')
+    tesseract_version: str = Field(serialization_alias='tesseractVersion', description='Version of Tesseract')
+    ocrmypdf_version: str = Field(serialization_alias='ocrmypdfVersion', description='Version of OCRmyPDF')
+    tessdata_dir: str | None = Field(default=None, serialization_alias='tessdataDir', description='Directory the Tesseract languages are loaded from')
@@ -0,0 +1,23 @@
+from datetime import datetime
+from enum import Enum
+
+from pydantic import BaseModel, Field
+
+from .ocrresult import ErrorResult
+
+class JobState(str, Enum):
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+
+class JobStatus(BaseModel):
+    job_id: str = Field(serialization_alias='jobId', description='Id of the job')
+    filename: str = Field(description='Name of the file')
+    state: JobState = Field(description='Current state of the job')
+    stage: str | None = Field(default=None, description='Current processing stage reported by OCRmyPDF. For example: OCR')
+    pages_total: int | None = Field(default=None, serialization_alias='pagesTotal', description='Number of pages to be processed (if already known)')
+    pages_done: int = Field(default=0, serialization_alias='pagesDone', description='Number of pages already processed')
+    created_at: datetime = Field(serialization_alias='createdAt', description='Time the job was submitted')
+    finished_at: datetime | None = Field(default=None, serialization_alias='finishedAt', description='Time the job finished (if applicable)')
+    error: ErrorResult | None = Field(default=None, description='Error of a failed job')
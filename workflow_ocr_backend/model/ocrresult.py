@@ -8,4 +8,5 @@ class OcrResult(BaseModel):
     filename: str = Field(description='Name of the file')
     content_type: str = Field(serialization_alias='contentType', description='Content type of the file. For example: application/pdf')
     recognized_text: str = Field(serialization_alias='recognizedText', description='Recognized text from the file')
+    detected_languages: list[str] | None = Field(default=None, serialization_alias='detectedLanguages', description='Languages Tesseract was run with, if they were narrowed down automatically (see OCR_AUTO_LANGUAGE)')
     file_content: str = Field(serialization_alias='fileContent', description='Base64 encoded file content')
\ No newline at end of file
@@ -0,0 +1,20 @@
+from typing import Literal
+
+from pydantic import BaseModel, Field
+
+from .ocrresult import ErrorResult
+
+class OcrProgress(BaseModel):
+    type: Literal['progress'] = Field(default='progress', description='Type of the event')
+    stage: str | None = Field(default=None, description='Current processing stage reported by OCRmyPDF. For example: OCR')
+    pages_total: int | None = Field(default=None, serialization_alias='pagesTotal', description='Number of pages to be processed (if known)')
+    pages_done: int | None = Field(default=None, serialization_alias='pagesDone', description='Number of pages already processed (if known)')
+
+class OcrPageText(BaseModel):
+    type: Literal['page'] = Field(default='page', description='Type of the event')
+    page: int = Field(description='Page number (starting at 1)')
+    text: str | None = Field(default=None, description='Recognized text of the page. Not set if OCR was skipped for the page')
+
+class OcrStreamError(BaseModel):
+    type: Literal['error'] = Field(default='error', description='Type of the event')
+    error: ErrorResult = Field(description='Error which stopped the processing')
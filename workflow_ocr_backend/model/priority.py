@@ -0,0 +1,5 @@
+from enum import Enum
+
+class Priority(str, Enum):
+    INTERACTIVE = 'interactive'
+    BULK = 'bulk'
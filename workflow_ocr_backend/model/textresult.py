@@ -0,0 +1,6 @@
+from pydantic import BaseModel, Field
+
+class TextResult(BaseModel):
+    filename: str = Field(description='Name of the file')
+    recognized_text: str = Field(serialization_alias='recognizedText', description='Recognized text from the file. Pages are separated by a form feed')
+    pages: list[str] | None = Field(default=None, description='Recognized text of every page (only if requested)')
@@ -0,0 +1,279 @@
+"""
+OCRmyPDF plugin which forwards the progress of an OCR run to a reporter callback
+(see worker.py) and downsamples over-resolved pages before OCR ("--max-ocr-dpi").
+If enabled, the durations of OCRmyPDF's steps are reported as well (see StageTiming).
+Registered in the plugin manager passed to ocrmypdf.ocr (see ocrservice.py).
+"""
+from argparse import ArgumentParser, Namespace
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+import resource
+import time
+from typing import Callable
+
+from ocrmypdf import PageContext, hookimpl
+from ocrmypdf.builtin_plugins import ghostscript, tesseract_ocr
+from ocrmypdf.builtin_plugins.concurrency import StandardExecutor
+from ocrmypdf.cli import numeric
+from ocrmypdf.helpers import Resolution
+from ocrmypdf.imageops import downsample_image
+from PIL import Image
+
+from .exceptions import TaskCancelledError
+
+# Stages of OCRmyPDF which process the document page by page
+PAGE_STAGES = ("OCR", "Image processing")
+# Stage of the events carrying the recognized text of a single page
+PAGE_TEXT_STAGE = "Page finished"
+# Stage of the timing of a whole task in the worker, including its CPU usage
+TASK_STAGE = "Worker"
+
+
+@dataclass(frozen=True)
+class ProgressEvent:
+    stage: str | None
+    unit: str | None = None
+    total: float | None = None
+    completed: float = 0
+    # Only set for PAGE_TEXT_STAGE events: 1-based page number and its recognized text (None if OCR was skipped for the page)
+    page: int | None = None
+    text: str | None = None
+
+
+@dataclass(frozen=True)
+class StageTiming:
+    """
+    Duration of a single step of a task (wall clock time in nanoseconds since the epoch), see tracing.py.
+    """
+    stage: str
+    start: int
+    end: int
+    attributes: dict[str, str | int | float] = field(default_factory=dict)
+
+
+_reporter: Callable[[ProgressEvent | StageTiming], None] | None = None
+_cancelled = False
+_timings = False
+# Max. resolution pages are rasterized with (0 = unlimited), set for every OCR run by check_options
+_max_raster_dpi = 0
+
+
+def set_reporter(reporter: Callable[[ProgressEvent | StageTiming], None] | None):
+    global _reporter, _cancelled
+    # A new reporter belongs to a new task, which is not cancelled (yet)
+    _reporter = reporter
+    _cancelled = False
+
+
+def cancel():
+    """
+    Aborts the running OCR run at its next progress report (may be called from any thread).
+    """
+    global _cancelled
+    _cancelled = True
+
+
+def set_timings(enabled: bool):
+    global _timings
+    _timings = enabled
+
+
+def report(event: ProgressEvent):
+    # Progress is reported by OCRmyPDF's main thread, so raising here aborts the pipeline
+    if _cancelled:
+        raise TaskCancelledError("OCR run was cancelled")
+    if _reporter is not None:
+        _reporter(event)
+
+
+@contextmanager
+def timed(stage: str, usage: bool = False, **attributes: str | int | float):
+    """
+    Reports the duration of the enclosed step (if timings are enabled), with usage=True also the CPU time
+    of the process and its (finished) child processes, e.g. Tesseract and Ghostscript.
+    """
+    if not _timings:
+        yield
+        return
+    start = time.time_ns()
+    before = (resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)) if usage else None
+    try:
+        yield
+    finally:
+        if before is not None:
+            after = (resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN))
+            attributes["cpu.self_seconds"], attributes["cpu.children_seconds"] = (
+                max(0.0, round(end.ru_utime + end.ru_stime - begin.ru_utime - begin.ru_stime, 3)) for begin, end in zip(before, after))
+        # Not passed to report(): timings are also reported while a cancelled run is torn down
+        if _reporter is not None:
+            _reporter(StageTiming(stage, start, time.time_ns(), attributes))
+
+
+class ProgressReporter:
+    """
+    Implements OCRmyPDF's ProgressBar protocol. Since nothing is displayed,
+    the "disable" flag (progress_bar=False) is ignored.
+    """
+
+    def __init__(self, *, total: float | None = None, desc: str | None = None, unit: str | None = None, disable: bool = False, **kwargs):
+        self.total = total
+        self.desc = desc
+        self.unit = unit
+        self.completed = 0
+        self._timing = timed(desc or "OCRmyPDF")
+
+    def __enter__(self):
+        self._timing.__enter__()
+        self._report()
+        return self
+
+    def __exit__(self, *args):
+        self._timing.__exit__(*args)
+        return False
+
+    def update(self, n: float = 1, *, completed: float | None = None):
+        self.completed = completed if completed is not None else self.completed + n
+        self._report()
+
+    def _report(self):
+        report(ProgressEvent(self.desc, self.unit, self.total, self.completed))
+
+
+class PageTextExecutor(StandardExecutor):
+    """
+    Reports the recognized text of every page as soon as the page is finished.
+    """
+
+    def __call__(self, *, task_finished=None, **kwargs):
+        def finished(result, pbar):
+            if task_finished is not None:
+                task_finished(result, pbar)
+            # Page results of the OCR pipeline carry the page number and the path of the page's text file
+            pageno, text_path = getattr(result, "pageno", None), getattr(result, "text", None)
+            if pageno is not None:
+                text = Path(text_path).read_text(encoding="utf-8") if text_path is not None else None
+                report(ProgressEvent(PAGE_TEXT_STAGE, page=pageno + 1, text=text))
+
+        return super().__call__(task_finished=finished, **kwargs)
+
+
+@hookimpl
+def get_progressbar_class():
+    return ProgressReporter
+
+
+@hookimpl
+def get_executor(progressbar_class):
+    return PageTextExecutor(pbar_class=progressbar_class)
+
+
+class TimedOcrEngine:
+    """
+    Reports the duration of every Tesseract run of the wrapped OCR engine (per page).
+    """
+
+    def __init__(self, engine):
+        self._engine = engine
+
+    def __getattr__(self, name: str):
+        return getattr(self._engine, name)
+
+    def generate_hocr(self, input_file, output_hocr, output_text, options):
+        with timed("Tesseract", page=_page_number(input_file)):
+            return self._engine.generate_hocr(input_file, output_hocr, output_text, options)
+
+    def generate_pdf(self, input_file, output_pdf, output_text, options):
+        with timed("Tesseract", page=_page_number(input_file)):
+            return self._engine.generate_pdf(input_file, output_pdf, output_text, options)
+
+
+def _page_number(path: Path) -> int:
+    # Intermediate files of OCRmyPDF are named after their (1-based) page number, e.g. 000001_ocr.png
+    prefix = Path(path).name.split("_", 1)[0]
+    return int(prefix) if prefix.isdigit() else 0
+
+
+@hookimpl(wrapper=True)
+def get_ocr_engine():
+    engine = yield
+    return TimedOcrEngine(engine) if _timings and engine is not None else engine
+
+
+@hookimpl(wrapper=True, specname="rasterize_pdf_page")
+def time_rasterization(pageno):
+    with timed("Rasterization", page=pageno):
+        return (yield)
+
+
+@hookimpl
+def add_options(parser: ArgumentParser):
+    group = parser.add_argument_group("Downsampling", "Downsampling of over-resolved pages before OCR")
+    group.add_argument("--max-ocr-dpi", type=numeric(int, 0), default=0, metavar="DPI",
+                       help="Pages with a higher resolution are downsampled to this resolution before OCR. 0 disables downsampling")
+    group.add_argument("--downsample-output", action="store_true",
+                       help="Also downsample the page images which replace the original pages in the output PDF "
+                            "(only produced with --force-ocr, --deskew, --clean-final or --remove-background)")
+
+
+@hookimpl
+def check_options(options: Namespace):
+    global _max_raster_dpi
+    # Without lossless reconstruction, the rasterized page replaces the original one in the output PDF.
+    # --clean stores the (full) page resolution in the cleaned image, so only the OCR image is downsampled then.
+    _max_raster_dpi = options.max_ocr_dpi if options.lossless_reconstruction and not options.clean else 0
+
+
+@hookimpl
+def rasterize_pdf_page(input_file, output_file, raster_device, raster_dpi, pageno, page_dpi, rotation, filter_vector, stop_on_soft_error):
+    scale = downsample_scale(page_dpi or raster_dpi, _max_raster_dpi)
+    if scale is None:
+        # Rasterized by the builtin plugin
+        return None
+    return ghostscript.rasterize_pdf_page(
+        input_file=input_file, output_file=output_file, raster_device=raster_device,
+        raster_dpi=Resolution(raster_dpi.x * scale, raster_dpi.y * scale), pageno=pageno,
+        page_dpi=Resolution(page_dpi.x * scale, page_dpi.y * scale) if page_dpi else None,
+        rotation=rotation, filter_vector=filter_vector, stop_on_soft_error=stop_on_soft_error)
+
+
+@hookimpl
+def filter_ocr_image(page: PageContext, image: Image.Image) -> Image.Image | None:
+    downsampled = _downsample(image, page.options.max_ocr_dpi)
+    if downsampled is None:
+        return None
+    # The builtin hook is skipped once a result is returned, it keeps the image within Tesseract's limits
+    return tesseract_ocr.filter_ocr_image(page=page, image=downsampled)
+
+
+@hookimpl
+def filter_page_image(page: PageContext, image_filename: Path) -> Path | None:
+    if not page.options.downsample_output:
+        return None
+    with Image.open(image_filename) as image:
+        image_format = image.format
+        downsampled = _downsample(image, page.options.max_ocr_dpi)
+        if downsampled is None:
+            return None
+    output_filename = image_filename.with_name(f"{image_filename.stem}_downsampled{image_filename.suffix}")
+    downsampled.save(output_filename, format=image_format, dpi=downsampled.info["dpi"])
+    return output_filename
+
+
+def downsample_scale(dpi: Resolution, max_dpi: int) -> float | None:
+    """
+    Returns the factor by which an image of the given resolution is scaled down to max_dpi (None if it isn't over-resolved).
+    """
+    if max_dpi <= 0 or max(dpi.x, dpi.y) <= max_dpi:
+        return None
+    return max_dpi / max(dpi.x, dpi.y)
+
+
+def _downsample(image: Image.Image, max_dpi: int) -> Image.Image | None:
+    scale = downsample_scale(Resolution(*image.info["dpi"]), max_dpi)
+    if scale is None:
+        return None
+    if image.mode in ("1", "P"):
+        # Would be resized with nearest neighbour resampling, which loses thin strokes
+        image = image.convert("L" if image.mode == "1" else "RGB")
+    return downsample_image(image, (max(1, round(image.width * scale)), max(1, round(image.height * scale))))
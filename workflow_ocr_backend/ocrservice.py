@@ -1,81 +1,442 @@
 
 import base64
+from dataclasses import dataclass
 from datetime import datetime, timezone
 import io
+import json
+import os
+import re
 from logging import Logger
+import tempfile
 from typing import BinaryIO, Iterable
 import ocrmypdf
+from pdfminer.high_level import extract_text
+import pikepdf
+from PIL import Image
 
+from . import ocrplugin
+from .languagedetect import LanguageDetector
 from .model.ocrresult import OcrResult
+from .parameters import Value, parse_parameters, plugin_manager
 import subprocess
 
+# Parameters which only affect how OCRmyPDF runs, but not its result
+_NON_RESULT_PARAMETERS = ("jobs", "use-threads", "no-use-threads", "verbose", "quiet", "no-progress-bar")
+# Operators which show text, draw an image (inline images are parsed as a separate instruction type) or paint a path
+_TEXT_OPERATORS = {"Tj", "TJ", "'", '"'}
+_IMAGE_OPERATORS = {"Do"}
+_PATH_OPERATORS = {"S", "s", "f", "F", "f*", "B", "B*", "b", "b*", "sh"}
+# Max. nesting depth of Form XObjects which is inspected by the pre-scan
+_MAX_FORM_DEPTH = 4
+# Pages without (higher resolution) images are rasterized with at least this resolution
+_MIN_RASTER_DPI = 300
+# XMP properties which claim PDF/A conformance
+_PDFA_METADATA = ("pdfaid:part", "pdfaid:conformance")
+
+# Document-level structures which refer to the pages of a PDF, they are lost when it is split into chunks
+_PAGE_REFERENCING_STRUCTURES = ("/Outlines", "/AcroForm", "/PageLabels", "/Names")
+# Placeholder of the sidecar for pages which were not passed to Tesseract (e.g. due to --skip-text)
+_SKIPPED_PAGES = re.compile(r"\[OCR skipped on page\(s\) (\d+)(?:-(\d+))?\]")
+
+def shift_skipped_pages(sidecar_text: str, offset: int) -> str:
+    """
+    Shifts the page numbers of the skipped pages placeholders by offset, e.g. for the sidecar of a chunk of a split document.
+    """
+    def shift(match: re.Match) -> str:
+        pages = "-".join(str(int(page) + offset) for page in match.groups() if page is not None)
+        return f"[OCR skipped on page(s) {pages}]"
+    return _SKIPPED_PAGES.sub(shift, sidecar_text) if offset else sidecar_text
+
+@dataclass
+class OcrOutput:
+    """
+    Result of an OCR run whose output PDF has been written to a file.
+    """
+    filename: str
+    content_type: str
+    recognized_text: str
+    file_path: str
+    detected_languages: list[str] | None = None
+
+    def read_result(self) -> OcrResult:
+        """
+        Reads the output file into an OcrResult (i.e. base64 encodes it in memory).
+        """
+        with open(self.file_path, "rb") as file:
+            file_base64 = base64.b64encode(file.read()).decode("utf-8")
+        return OcrResult(filename=self.filename, content_type=self.content_type, recognized_text=self.recognized_text,
+                         detected_languages=self.detected_languages, file_content=file_base64)
+
+@dataclass
+class PageScan:
+    """
+    Result of the pre-scan of a single page.
+    """
+    has_text: bool
+    has_images: bool
+    # Painted paths, which may be text converted to outlines
+    has_paths: bool = False
+
+    @property
+    def needs_ocr(self) -> bool:
+        # Pages without images and paths (e.g. blank pages) have nothing to recognize
+        return (self.has_images or self.has_paths) and not self.has_text
+
+@dataclass
+class DocumentInfo:
+    """
+    Size of a document as it is rasterized for Tesseract (see OcrService.inspect).
+    """
+    pages: int
+    max_page_pixels: int
+    total_pixels: int
+
 class OcrService:
+    """
+    Runs OCRmyPDF. With auto_language, the requested languages are narrowed down to the ones
+    detected on a few sample pages before Tesseract runs on the whole document (see LanguageDetector).
+    max_dpi is the default of the "--max-ocr-dpi" parameter (see ocrplugin), 0 means no downsampling.
+    """
+
     def __init__(self, logger: Logger):
         self.logger = logger
 
-    def ocr(self, file: BinaryIO, file_name: str, ocrmypdf_parameters: str) -> OcrResult:
+    def ocr(self, file: BinaryIO | str, file_name: str, ocrmypdf_parameters: str, jobs: int | None = None, auto_language: bool = False,
+            max_dpi: int = 0) -> OcrResult:
         output_buffer = io.BytesIO() 
-        sidecar_buffer = io.BytesIO()
     
+        try:
+            sidecar_text, languages = self._run_ocr(file, output_buffer, file_name, ocrmypdf_parameters, jobs, auto_language, max_dpi)
+            with ocrplugin.timed("Base64 encoding"):
+                file_base64 = base64.b64encode(output_buffer.getvalue()).decode("utf-8")
+            return OcrResult(filename=file_name, content_type="application/pdf", recognized_text=sidecar_text, detected_languages=languages, file_content=file_base64)
+        
+        finally:
+            output_buffer.close()
+
+    def ocr_to_file(self, file: BinaryIO | str, file_name: str, ocrmypdf_parameters: str, output_path: str, jobs: int | None = None,
+                    auto_language: bool = False, max_dpi: int = 0) -> OcrOutput:
+        """
+        Like ocr(), but writes the resulting PDF directly to output_path instead of returning it base64 encoded.
+        """
+        sidecar_text, languages = self._run_ocr(file, output_path, file_name, ocrmypdf_parameters, jobs, auto_language, max_dpi)
+        return OcrOutput(filename=file_name, content_type="application/pdf", recognized_text=sidecar_text, file_path=output_path, detected_languages=languages)
+
+    def ocr_text(self, file: BinaryIO | str, file_name: str, ocrmypdf_parameters: str, jobs: int | None = None, auto_language: bool = False,
+                 max_dpi: int = 0) -> list[str]:
+        """
+        Text-only mode: runs only rasterization and Tesseract, without producing an output PDF
+        (no PDF/A conversion, no optimization). Returns the text of every page. For pages which
+        already have text (and are therefore skipped by Tesseract), the existing text is returned.
+        """
+        sidecar_text, _ = self._run_ocr(file, None, file_name, ocrmypdf_parameters, jobs, auto_language, max_dpi)
+        pages = []
+        for page_text in sidecar_text.split("\f"):
+            skipped = _SKIPPED_PAGES.fullmatch(page_text.strip())
+            if skipped is None:
+                pages.append(page_text)
+                continue
+            first_page, last_page = int(skipped[1]), int(skipped[2] or skipped[1])
+            pages.extend(self._page_texts(file, range(first_page - 1, last_page)))
+        return pages
+
+    def _run_ocr(self, file: BinaryIO | str, output: BinaryIO | str | None, file_name: str, ocrmypdf_parameters: str, jobs: int | None,
+                 auto_language: bool, max_dpi: int) -> tuple[str, list[str] | None]:
+        """
+        Runs OCRmyPDF and returns the sidecar text together with the automatically chosen languages
+        (None if the languages were not narrowed down). If output is None, no output PDF is produced.
+        """
+        sidecar_buffer = io.BytesIO()
+
         try:
             current_time = datetime.now(timezone.utc).isoformat()
             self.logger.debug(f"{current_time} - Start processing file {file_name} (OCR parameters: {ocrmypdf_parameters})")
 
-            kwargs = self._split_parameters(ocrmypdf_parameters)
-            exit_code = ocrmypdf.ocr(file, output_buffer, sidecar=sidecar_buffer, progress_bar=False, **kwargs)
+            # Parameters are passed as "--skip-text", but are looked up (and added) with their keyword name
+            kwargs = {key.replace("-", "_"): value for key, value in self._split_parameters(ocrmypdf_parameters).items()}
+            scan = None
+            searchable = False
+            if not (kwargs.get("force_ocr") or kwargs.get("redo_ocr")):
+                with ocrplugin.timed("Pre-scan"):
+                    scan = self.prescan(file)
+                searchable = scan is not None and not any(page.needs_ocr for page in scan)
+                if searchable and output is None:
+                    self.logger.debug(f"{file_name} does not need OCR, returning its text")
+                    return self._extract_text(file), None
+                # OCRmyPDF still runs for an output PDF (e.g. the PDF/A conversion, --rotate-pages or --title change it)
+                if scan is not None and any(page.has_text for page in scan):
+                    # Only pages without text are passed to Tesseract (instead of failing with PriorOcrFoundError)
+                    kwargs.setdefault("skip_text", True)
+            languages = None
+            requested_languages = self.requested_languages(ocrmypdf_parameters)
+            if auto_language and len(requested_languages) > 1 and not searchable:
+                # Only sample pages which are actually passed to Tesseract
+                page_numbers = [index for index, page in enumerate(scan) if page.needs_ocr] if scan is not None else None
+                with ocrplugin.timed("Language detection"):
+                    languages = LanguageDetector(self.logger).detect(file, requested_languages, page_numbers)
+                kwargs["language"] = languages
+            if max_dpi > 0:
+                kwargs.setdefault("max_ocr_dpi", max_dpi)
+            if jobs is not None:
+                # A request may use fewer processes than the budget of the worker (which admission control relies on), but not more
+                kwargs["jobs"] = min(kwargs["jobs"], jobs) if kwargs.get("jobs") else jobs
+            kwargs["plugin_manager"] = plugin_manager()
+            if output is None:
+                kwargs["output_type"] = "none"
+                output = os.devnull
+            with ocrplugin.timed("OCRmyPDF"):
+                exit_code = ocrmypdf.ocr(file, output, sidecar=sidecar_buffer, progress_bar=False, **kwargs)
 
             if exit_code != 0:
                 raise Exception(f"ocr failed ({exit_code})")
-            
-            file_base64 = base64.b64encode(output_buffer.getvalue()).decode("utf-8")
-            output_buffer.close()
-
-            sidecar_text = sidecar_buffer.getvalue().decode("utf-8")
-            sidecar_buffer.close()
 
             current_time = datetime.now(timezone.utc).isoformat()
             self.logger.debug(f"{current_time} - Finished processing file {file_name}")
 
-            return OcrResult(filename=file_name, content_type="application/pdf", recognized_text=sidecar_text, file_content=file_base64)
-        
+            if searchable:
+                # The sidecar only contains placeholders for the skipped pages
+                return self._extract_text(file), languages
+            return sidecar_buffer.getvalue().decode("utf-8"), languages
+
         finally:
-            output_buffer.close()
             sidecar_buffer.close()
 
+    def prescan(self, file: BinaryIO | str) -> list[PageScan] | None:
+        """
+        Inspects the content streams of all pages for text and images, without rendering anything.
+        Returns None if the file is not a PDF.
+        """
+        try:
+            with pikepdf.open(file) as pdf:
+                return [self._scan_content(page.obj, 0) for page in pdf.pages]
+        except pikepdf.PdfError:
+            return None
+        finally:
+            if not isinstance(file, str):
+                file.seek(0)
+
+    def _scan_content(self, content: pikepdf.Object, depth: int) -> PageScan:
+        scan = PageScan(has_text=False, has_images=False)
+        xobjects = content.get("/Resources", {}).get("/XObject", {})
+        for instruction in pikepdf.parse_content_stream(content):
+            if isinstance(instruction, pikepdf.ContentStreamInlineImage):
+                scan.has_images = True
+                continue
+            operator = str(instruction.operator)
+            if operator in _TEXT_OPERATORS:
+                scan.has_text = True
+            elif operator in _PATH_OPERATORS:
+                scan.has_paths = True
+            elif operator in _IMAGE_OPERATORS:
+                xobject = xobjects.get(str(instruction.operands[0]))
+                if xobject is None:
+                    continue
+                subtype = xobject.get("/Subtype")
+                if subtype == pikepdf.Name.Image:
+                    scan.has_images = True
+                elif subtype == pikepdf.Name.Form and depth < _MAX_FORM_DEPTH:
+                    nested = self._scan_content(xobject, depth + 1)
+                    scan.has_text |= nested.has_text
+                    scan.has_images |= nested.has_images
+                    scan.has_paths |= nested.has_paths
+            if scan.has_text and scan.has_images:
+                break
+        return scan
+
+    def _extract_text(self, file: BinaryIO | str) -> str:
+        """
+        Returns the text of an (already searchable) PDF, separated by form feeds like the sidecar of OCRmyPDF.
+        """
+        if not isinstance(file, str):
+            file.seek(0)
+        ocrplugin.report(ocrplugin.ProgressEvent("Extracting text"))
+        with ocrplugin.timed("Extracting text"):
+            # pdfminer ends every page with a form feed, OCRmyPDF only puts one between pages
+            return extract_text(file).removesuffix("\f")
+
+    def _page_texts(self, file: BinaryIO | str, page_numbers: range) -> list[str]:
+        if not isinstance(file, str):
+            file.seek(0)
+        # pdfminer ends every page with a form feed
+        return extract_text(file, page_numbers=page_numbers).split("\f")[:len(page_numbers)]
+
+    def page_count(self, file: BinaryIO | str) -> int | None:
+        """
+        Returns the number of pages of the given PDF or None if the file is not a PDF.
+        """
+        try:
+            with pikepdf.open(file) as pdf:
+                return len(pdf.pages)
+        except pikepdf.PdfError:
+            return None
+        finally:
+            if not isinstance(file, str):
+                file.seek(0)
+
+    def splittable_page_count(self, file: BinaryIO | str) -> int | None:
+        """
+        Returns the number of pages of the given PDF, or None if the file is not a PDF or can't be split
+        without losing outlines, form fields, page labels or named destinations.
+        """
+        try:
+            with pikepdf.open(file) as pdf:
+                if any(key in pdf.Root for key in _PAGE_REFERENCING_STRUCTURES):
+                    return None
+                return len(pdf.pages)
+        except pikepdf.PdfError:
+            return None
+        finally:
+            if not isinstance(file, str):
+                file.seek(0)
+
+    def inspect(self, file: BinaryIO | str) -> DocumentInfo | None:
+        """
+        Estimates the number of pixels OCRmyPDF rasterizes for the given PDF or image without rendering anything:
+        a PDF page is assumed to be rasterized with the resolution of its largest image. Returns None if the
+        file is neither a PDF nor an image.
+        """
+        try:
+            try:
+                with pikepdf.open(file) as pdf:
+                    pixels = [self._page_pixels(page) for page in pdf.pages]
+                return DocumentInfo(pages=len(pixels), max_page_pixels=max(pixels, default=0), total_pixels=sum(pixels))
+            except pikepdf.PdfError:
+                pass
+            if not isinstance(file, str):
+                file.seek(0)
+            try:
+                # Only reads the header, the image is not decoded
+                with Image.open(file) as image:
+                    pages = getattr(image, "n_frames", 1)
+                    return DocumentInfo(pages=pages, max_page_pixels=image.width * image.height, total_pixels=image.width * image.height * pages)
+            except (OSError, ValueError, Image.DecompressionBombError):
+                return None
+        finally:
+            if not isinstance(file, str):
+                file.seek(0)
+
+    def _page_pixels(self, page: pikepdf.Page) -> int:
+        left, bottom, right, top = (float(value) for value in page.mediabox)
+        width, height = abs(right - left) / 72, abs(top - bottom) / 72
+        if width <= 0 or height <= 0:
+            return 0
+        dpi = _MIN_RASTER_DPI
+        for image in page.get_images().values():
+            # The larger side of the image covers at most the larger side of the page (regardless of rotation)
+            dpi = max(dpi, max(int(image.get("/Width", 0)), int(image.get("/Height", 0))) / max(width, height))
+        return round(width * dpi) * round(height * dpi)
+
+    def split_pages(self, file: BinaryIO | str, pages_per_chunk: int, target_dir: str) -> list[str]:
+        """
+        Splits the given PDF into chunks of pages_per_chunk pages, written to new files in target_dir.
+        """
+        chunk_paths = []
+        try:
+            with pikepdf.open(file) as pdf:
+                for first_page in range(0, len(pdf.pages), pages_per_chunk):
+                    fd, chunk_path = tempfile.mkstemp(suffix=".pdf", prefix="ocr-chunk-", dir=target_dir)
+                    os.close(fd)
+                    chunk_paths.append(chunk_path)
+                    with pikepdf.new() as chunk:
+                        chunk.pages.extend(pdf.pages[first_page:first_page + pages_per_chunk])
+                        chunk.save(chunk_path)
+            return chunk_paths
+        except BaseException:
+            for chunk_path in chunk_paths:
+                os.unlink(chunk_path)
+            raise
+
+    def merge_pdfs(self, paths: list[str], output_path: str) -> list[int]:
+        """
+        Merges the given PDFs (in the given order) into output_path and returns their page counts. Document information,
+        XMP metadata and output intents (PDF/A) are taken from the first PDF. The merged PDF only claims PDF/A conformance
+        if all PDFs do (e.g. chunks which didn't need OCR are returned unchanged instead of converted to PDF/A).
+        """
+        sources = []
+        try:
+            with pikepdf.new() as merged:
+                for path in paths:
+                    source = pikepdf.open(path)
+                    sources.append(source)
+                    merged.pages.extend(source.pages)
+                first = sources[0]
+                merged.docinfo = merged.copy_foreign(first.docinfo)
+                pdfa = all(source.open_metadata().pdfa_status for source in sources)
+                for key in ("/Metadata", "/OutputIntents") if pdfa else ("/Metadata",):
+                    if key in first.Root:
+                        merged.Root[key] = merged.copy_foreign(first.Root[key])
+                if not pdfa and first.open_metadata().pdfa_status:
+                    with merged.open_metadata(set_pikepdf_as_editor=False, update_docinfo=False) as metadata:
+                        for key in _PDFA_METADATA:
+                            if key in metadata:
+                                del metadata[key]
+                merged.save(output_path)
+            return [len(source.pages) for source in sources]
+        finally:
+            for source in sources:
+                source.close()
+
     def installed_languages(self) -> Iterable[str]:
+        return self.language_info()[0]
+
+    def preload(self, languages: Iterable[str]):
+        """
+        Prepares the current process for OCR runs: creates the OCRmyPDF plugin manager and reads the
+        traineddata of the given languages once, so that Tesseract finds them in the page cache.
+        """
+        plugin_manager()
+        tessdata_dir = self.language_info()[1]
+        if tessdata_dir is None:
+            return
+        for language in languages:
+            path = os.path.join(tessdata_dir, f"{language}.traineddata")
+            try:
+                with open(path, "rb") as file:
+                    while file.read(1024 * 1024):
+                        pass
+            except OSError as exc:
+                self.logger.debug(f"Failed to preload {path}: {exc}")
+
+    def language_info(self) -> tuple[list[str], str | None]:
+        """
+        Returns the installed Tesseract languages and the tessdata directory they were loaded from (if reported by Tesseract).
+        """
         result = subprocess.run(["tesseract", "--list-langs"], capture_output=True, text=True)
-        languages = result.stdout.splitlines()[1:]  # Skip the first line
-        return [lang for lang in languages if lang != "osd"]
+        lines = result.stdout.splitlines()
+        # First line looks like: List of available languages in "/usr/share/tessdata/" (3):
+        match = re.search(r'"(.+)"', lines[0]) if lines else None
+        languages = lines[1:]  # Skip the first line
+        return [lang for lang in languages if lang != "osd"], match.group(1) if match else None
 
-    def _split_parameters(self, ocrmypdf_parameters: str) -> dict[str, str | bool | Iterable[str] | int | float]:
-        if ocrmypdf_parameters is None:
-            return {}
-        
-        params = {}
+    def tesseract_version(self) -> str:
+        result = subprocess.run(["tesseract", "--version"], capture_output=True, text=True)
+        output = result.stdout or result.stderr  # Older Tesseract versions print to stderr
+        return output.splitlines()[0].removeprefix("tesseract ") if output else "unknown"
 
-        for param in [p.strip() for p in ocrmypdf_parameters.split("--")]:
-            if not param:
-                continue
-            splitted_param = [p.strip() for p in param.split(" ")]
-            key = splitted_param[0]
-            length = len(splitted_param)
-            if length >= 2:
-                value = splitted_param[1]
-                # Multiple values
-                if "+" in value:
-                    value = value.split("+")
-                # Single value (might be of type str, bool, int or float)
-                elif value.isnumeric():
-                    value = int(value)
-                elif value.replace(".", "", 1).isnumeric():
-                    value = float(value)
-                elif value.lower() == "true":
-                    value = True
-                elif value.lower() == "false":
-                    value = False
-            else:
-                # Flag
-                value = True
-
-            params[key] = value
-        return params
+    def requested_languages(self, ocrmypdf_parameters: str) -> list[str]:
+        return list(self._split_parameters(ocrmypdf_parameters).get("language", ()))
+
+    def selects_pages(self, ocrmypdf_parameters: str) -> bool:
+        return "pages" in self._split_parameters(ocrmypdf_parameters)
+
+    def normalize_parameters(self, ocrmypdf_parameters: str, auto_language: bool = False, max_dpi: int = 0) -> str:
+        """
+        Returns a canonical representation of the given parameters, ignoring parameters which don't affect the result.
+        """
+        kwargs = {key.replace("_", "-"): value for key, value in self._split_parameters(ocrmypdf_parameters).items()}
+        for key in _NON_RESULT_PARAMETERS:
+            kwargs.pop(key, None)
+        if auto_language:
+            # Not an OCRmyPDF parameter, but results might have been produced with less languages
+            kwargs["auto-language"] = True
+        if max_dpi > 0:
+            kwargs.setdefault("max-ocr-dpi", max_dpi)
+        if not kwargs.get("max-ocr-dpi"):
+            kwargs.pop("max-ocr-dpi", None)
+            # Without downsampling, the output is not downsampled either
+            kwargs.pop("downsample-output", None)
+        return json.dumps(kwargs, sort_keys=True)
+
+    def _split_parameters(self, ocrmypdf_parameters: str | None) -> dict[str, Value]:
+        # Keyed by option name, e.g. "skip-text" (see parameters.parse_parameters)
+        return parse_parameters(ocrmypdf_parameters)
@@ -0,0 +1,153 @@
+import asyncio
+import dataclasses
+import io
+from logging import Logger
+from typing import Awaitable, Callable, Protocol, TypeVar
+
+from starlette.concurrency import run_in_threadpool
+
+from . import worker
+from .fairshare import TaskOwner
+from .ocrplugin import PAGE_STAGES, PAGE_TEXT_STAGE, ProgressEvent
+from .ocrservice import OcrOutput, OcrService
+from .scheduler import EventCallback, OcrScheduler
+from .settings import Settings
+from .spooling import Source, discard, is_spooled
+
+T = TypeVar("T")
+
+
+class ChunkExecutor(Protocol):
+    """
+    Runs the OCR of a single chunk of a split document. LocalChunkExecutor uses the local
+    worker pool, other implementations might distribute the chunks to further backend replicas.
+    """
+
+    def submit(self, chunk_path: str, file_name: str, ocrmypdf_parameters: str | None, output_dir: str, on_event: EventCallback | None, owner: TaskOwner,
+               memory: int) -> Awaitable[OcrOutput]:
+        ...
+
+
+class LocalChunkExecutor:
+    def __init__(self, scheduler: OcrScheduler):
+        self.scheduler = scheduler
+
+    def submit(self, chunk_path: str, file_name: str, ocrmypdf_parameters: str | None, output_dir: str, on_event: EventCallback | None, owner: TaskOwner,
+               memory: int) -> Awaitable[OcrOutput]:
+        # The document as a whole has already been admitted, so its chunks must not be rejected
+        return self.scheduler.submit(worker.process_to_file, chunk_path, file_name, ocrmypdf_parameters, self.scheduler.jobs_per_task, output_dir,
+                                     on_event=on_event, admit=False, owner=owner, memory=memory)
+
+
+class PageSplitter:
+    """
+    Split/merge pipeline for very large PDFs: documents with more than `ocr_split_pages` pages are split
+    into chunks of that size, which are processed concurrently by the ChunkExecutor. Afterwards,
+    the resulting PDFs are merged and their recognized texts are concatenated in page order.
+    """
+
+    def __init__(self, settings: Settings, scheduler: OcrScheduler, executor: ChunkExecutor, logger: Logger):
+        self.settings = settings
+        self.scheduler = scheduler
+        self.executor = executor
+        self.logger = logger
+
+    @property
+    def enabled(self) -> bool:
+        return self.settings.ocr_split_pages > 0
+
+    async def should_split(self, source: Source, ocrmypdf_parameters: str | None) -> bool:
+        # An explicit page selection (--pages) refers to the page numbers of the whole document
+        if not self.enabled or OcrService(self.logger).selects_pages(ocrmypdf_parameters):
+            return False
+        page_count = await run_in_threadpool(self._page_count, source)
+        return page_count is not None and page_count > max(self.settings.ocr_split_pages, self.settings.ocr_split_min_pages)
+
+    def submit(self, source: Source, file_name: str, ocrmypdf_parameters: str | None, on_event: EventCallback | None = None, owner: TaskOwner = TaskOwner(),
+               memory: int = 0) -> Awaitable[OcrOutput]:
+        """
+        Schedules the split/merge pipeline for the given document. Like OcrScheduler.submit, admission
+        is checked immediately. The caller is responsible for deleting the resulting file.
+        The estimated memory of the whole document is reserved for each chunk (chunks have the same page sizes).
+        """
+        self.scheduler.check_admission()
+        return asyncio.ensure_future(self._run(source, file_name, ocrmypdf_parameters, on_event, owner, memory))
+
+    async def _run(self, source: Source, file_name: str, ocrmypdf_parameters: str | None, on_event: EventCallback | None, owner: TaskOwner,
+                   memory: int) -> OcrOutput:
+        scratch_dir = self.settings.scratch_dir
+        chunk_paths: list[str] = []
+        results: list[asyncio.Future[OcrOutput]] = []
+        try:
+            split = self.scheduler.submit(worker.split, source, self.settings.ocr_split_pages, scratch_dir, admit=False, owner=owner)
+            chunk_paths = await _owned_files(split, lambda paths: paths)
+            self.logger.debug(f"Split {file_name} into {len(chunk_paths)} chunks of up to {self.settings.ocr_split_pages} pages")
+            progress = _ChunkProgress(len(chunk_paths), self.settings.ocr_split_pages, on_event)
+            results = [asyncio.ensure_future(self.executor.submit(chunk_path, file_name, ocrmypdf_parameters, scratch_dir, progress.callback(index), owner, memory))
+                       for index, chunk_path in enumerate(chunk_paths)]
+            chunks = await asyncio.gather(*results)
+            merge = self.scheduler.submit(worker.merge, chunks, file_name, scratch_dir, admit=False, owner=owner)
+            return await _owned_files(merge, lambda output: [output.file_path])
+        finally:
+            # If one chunk failed, the remaining ones are not needed anymore
+            for result in results:
+                result.cancel()
+            await asyncio.gather(*results, return_exceptions=True)
+            for chunk_path in chunk_paths:
+                discard(chunk_path)
+            for result in results:
+                if not result.cancelled() and result.exception() is None:
+                    discard(result.result().file_path)
+
+    def _page_count(self, source: Source) -> int | None:
+        service = OcrService(self.logger)
+        if is_spooled(source):
+            return service.splittable_page_count(source)
+        with io.BytesIO(source) as file:
+            return service.splittable_page_count(file)
+
+
+async def _owned_files(task: Awaitable[T], paths: Callable[[T], list[str]]) -> T:
+    """
+    Awaits a split or merge task which writes new files. Splitting and merging are not aborted when
+    the pipeline is cancelled, so the files are deleted once the task finished instead of being leaked.
+    """
+    task = asyncio.ensure_future(task)
+    try:
+        return await asyncio.shield(task)
+    except asyncio.CancelledError:
+        def discard_files(finished: asyncio.Future[T]):
+            if not finished.cancelled() and finished.exception() is None:
+                for path in paths(finished.result()):
+                    discard(path)
+        task.add_done_callback(discard_files)
+        raise
+
+
+class _ChunkProgress:
+    """
+    Combines the page-level progress events of all chunks into progress events of the whole document.
+    """
+
+    def __init__(self, chunk_count: int, pages_per_chunk: int, on_event: EventCallback | None):
+        self.pages_per_chunk = pages_per_chunk
+        self.on_event = on_event
+        self.totals = [0.0] * chunk_count
+        self.completed = [0.0] * chunk_count
+
+    def callback(self, index: int) -> EventCallback | None:
+        if self.on_event is None:
+            return None
+        return lambda event: self._update(index, event)
+
+    def _update(self, index: int, event: ProgressEvent):
+        if event.stage == PAGE_TEXT_STAGE:
+            # Page numbers of a chunk start at 1
+            self.on_event(dataclasses.replace(event, page=event.page + index * self.pages_per_chunk))
+            return
+        if event.unit != "page" or event.stage not in PAGE_STAGES:
+            self.on_event(event)
+            return
+        self.totals[index] = event.total or 0
+        self.completed[index] = event.completed
+        self.on_event(ProgressEvent(event.stage, event.unit, sum(self.totals), sum(self.completed)))
@@ -0,0 +1,202 @@
+"""
+Parsing and validation of OCRmyPDF parameters: the "ocrmypdf_parameters" of requests and the profiles of OCR_PARAMETER_PROFILES.
+Parameters are parsed with OCRmyPDF's own argument parser (including the options added by ocrplugin) and checked
+like OCRmyPDF checks them before processing, so that invalid parameters are rejected with 400 before any OCR work is done.
+Every distinct parameter string is parsed once per process, the parsed parameters are keyed by option name (e.g. "skip-text").
+"""
+import argparse
+import functools
+import json
+import os
+import shlex
+from typing import Iterator
+
+from ocrmypdf import _validation
+from ocrmypdf.api import get_plugin_manager
+from ocrmypdf.cli import get_parser
+from ocrmypdf.exceptions import BadArgsError, MissingDependencyError
+
+from . import ocrplugin
+from .exceptions import InvalidParametersError
+
+Value = str | bool | int | float | tuple[str, ...]
+
+# Set by the backend itself: the input and output files, the sidecar and the plugins (which would load arbitrary modules)
+_RESERVED_OPTIONS = {"help", "version", "sidecar", "plugins", "keep_temporary_files"}
+_INPUT_FILE = "stream://input_file"
+_OUTPUT_FILE = "stream://output_file"
+_NOT_GIVEN = object()
+
+
+@functools.cache
+def plugin_manager():
+    # Creating the plugin manager loads all plugins, so it's created once per process and reused for all OCR runs
+    return get_plugin_manager([ocrplugin.__name__])
+
+
+def parse_parameters(ocrmypdf_parameters: str | None) -> dict[str, Value]:
+    """
+    Returns the options set by the given parameters (e.g. "--language eng+deu -s") keyed by their option name
+    (e.g. {"language": ("eng", "deu"), "skip-text": True}). Options set to their default are omitted.
+    Raises InvalidParametersError if OCRmyPDF would reject the parameters.
+    """
+    if not ocrmypdf_parameters or not ocrmypdf_parameters.strip():
+        return {}
+    return dict(_parse(ocrmypdf_parameters))
+
+
+def format_parameters(options: dict[str, Value]) -> str:
+    """
+    Returns the canonical parameter string of the given options, the inverse of parse_parameters.
+    """
+    arguments = []
+    for name, value in options.items():
+        if value is True:
+            arguments.append(f"--{name}")
+        elif isinstance(value, tuple):
+            for item in value:
+                arguments.extend((f"--{name}", item))
+        elif value is not False:
+            arguments.extend((f"--{name}", str(value)))
+    return shlex.join(arguments)
+
+
+def check_output(ocrmypdf_parameters: str | None, produces_pdf: bool):
+    """
+    Runs OCRmyPDF's check of the output options: requests which return a PDF can't use "--output-type none",
+    requests which only return the recognized text can (their output file is os.devnull).
+    """
+    options = argparse.Namespace(output_type=parse_parameters(ocrmypdf_parameters).get("output-type"),
+                                 output_file=_OUTPUT_FILE if produces_pdf else os.devnull)
+    try:
+        _validation.check_options_output(options)
+    except BadArgsError:
+        raise InvalidParametersError("Invalid OCR parameters: --output-type none produces no PDF, it can only be used when requesting the text")
+
+
+def merge_parameters(*parameters: str | None) -> str:
+    """
+    Combines the given parameters (e.g. of a profile and of a request) into one canonical parameter string.
+    Options of later parameters replace the same options of earlier ones, the combination is validated again.
+    """
+    options = {}
+    for ocrmypdf_parameters in parameters:
+        options.update(parse_parameters(ocrmypdf_parameters))
+    merged = format_parameters(options)
+    parse_parameters(merged)
+    return merged
+
+
+@functools.lru_cache(maxsize=1024)
+def _parse(ocrmypdf_parameters: str) -> tuple[tuple[str, Value], ...]:
+    try:
+        arguments = [*shlex.split(ocrmypdf_parameters), "--", _INPUT_FILE, _OUTPUT_FILE]
+    except ValueError as exc:
+        raise InvalidParametersError(f"Invalid OCR parameters: {exc}")
+    # New parsers for every parse, as OCRmyPDF's language option appends to its default
+    parser = _parser()
+    actions = [action for action in parser._actions if action.option_strings and action.default != argparse.SUPPRESS]
+    reserved = [argument for argument in arguments if argument.startswith("-") and
+                any(argument.split("=")[0] in action.option_strings for action in parser._actions if action.dest in _RESERVED_OPTIONS)]
+    if reserved:
+        raise InvalidParametersError(f"Invalid OCR parameters: {', '.join(reserved)} can't be set by requests")
+    try:
+        parsed = parser.parse_args(arguments)
+        # Options which weren't given keep the placeholder (lists stay empty), so that explicit defaults (e.g. "--max-ocr-dpi 0") are kept
+        given = _parser().parse_args(arguments, argparse.Namespace(**{action.dest: [] if isinstance(action.default, list) else _NOT_GIVEN for action in actions}))
+    except ValueError as exc:
+        raise InvalidParametersError(f"Invalid OCR parameters: {exc}")
+
+    options: dict[str, Value] = {}
+    seen = set()
+    for action in actions:
+        value = getattr(given, action.dest)
+        if action.dest in seen or value is _NOT_GIVEN or value == []:
+            continue
+        if isinstance(action, argparse.BooleanOptionalAction):
+            options[_option_name(action.option_strings[0 if value else 1])] = True
+        elif isinstance(action, (argparse._StoreTrueAction, argparse._StoreFalseAction)):
+            if value != action.const:
+                # Set by the other option of the same destination, e.g. "--no-use-threads" instead of "--use-threads"
+                continue
+            options[_option_name(max(action.option_strings, key=len))] = True
+        else:
+            options[_option_name(max(action.option_strings, key=len))] = tuple(value) if isinstance(value, list) else value
+        seen.add(action.dest)
+    _check(parsed)
+    return tuple(options.items())
+
+
+def _parser() -> argparse.ArgumentParser:
+    parser = get_parser()
+    # Otherwise e.g. "--keep-temp" would pass as "--keep-temporary-files"
+    parser.allow_abbrev = False
+    plugin_manager().hook.add_options(parser=parser)
+    parser.enable_api_mode()
+    return parser
+
+
+def _option_name(option: str) -> str:
+    return option.removeprefix("--")
+
+
+def _check(options: argparse.Namespace):
+    """
+    Runs OCRmyPDF's checks of option combinations (e.g. only one of --force-ocr, --skip-text and --redo-ocr).
+    Checks of the plugins are skipped, as they check the installed programs and set up the plugins for an OCR run.
+    """
+    try:
+        _validation.check_options_metadata(options)
+        _validation.set_lossless_reconstruction(options)
+        _validation.check_options_preprocessing(options)
+        _validation.check_options_ocr_behavior(options)
+    except (BadArgsError, MissingDependencyError, ValueError) as exc:
+        raise InvalidParametersError(f"Invalid OCR parameters: {exc}")
+
+
+class ParameterProfiles:
+    """
+    Named parameter sets defined by the admin (OCR_PARAMETER_PROFILES), validated once at startup.
+    Requests select a profile by name, their own parameters are applied on top of it (see resolve).
+    """
+
+    def __init__(self, profiles: dict[str, str]):
+        self._profiles: dict[str, str] = {}
+        for name, ocrmypdf_parameters in profiles.items():
+            try:
+                self._profiles[name] = format_parameters(parse_parameters(ocrmypdf_parameters))
+            except InvalidParametersError as exc:
+                raise ValueError(f"Invalid OCR profile {name}: {exc}") from exc
+
+    @classmethod
+    def from_json(cls, profiles: str) -> "ParameterProfiles":
+        """
+        Reads profiles from a JSON object mapping the profile names to their parameters, e.g. {"fast-text": "--language eng"}.
+        """
+        if not profiles.strip():
+            return cls({})
+        try:
+            parsed = json.loads(profiles)
+        except json.JSONDecodeError as exc:
+            raise ValueError(f"Invalid OCR profiles: {exc}") from exc
+        if not isinstance(parsed, dict) or not all(isinstance(value, str) for value in parsed.values()):
+            raise ValueError("Invalid OCR profiles: expected a JSON object mapping profile names to OCRmyPDF parameters")
+        return cls(parsed)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._profiles)
+
+    def parameters(self) -> dict[str, str]:
+        return dict(self._profiles)
+
+    def resolve(self, profile: str | None, ocrmypdf_parameters: str | None) -> str | None:
+        """
+        Returns the validated parameters of a request: the parameters of the given profile (if any),
+        with the options of ocrmypdf_parameters replacing the same options of the profile.
+        Raises InvalidParametersError for unknown profiles and invalid parameters.
+        """
+        if profile is None:
+            return format_parameters(parse_parameters(ocrmypdf_parameters)) if ocrmypdf_parameters else ocrmypdf_parameters
+        if profile not in self._profiles:
+            raise InvalidParametersError(f"Unknown OCR profile: {profile} (available: {', '.join(self._profiles) or 'none'})")
+        return merge_parameters(self._profiles[profile], ocrmypdf_parameters)
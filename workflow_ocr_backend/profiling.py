@@ -0,0 +1,58 @@
+"""
+Sampling profiler for single OCR tasks (see OCR_PROFILE_DIR and tracing.py).
+"""
+from collections import Counter
+import os
+import sys
+import threading
+
+# Interval (seconds) in which the stacks of all threads are sampled
+_SAMPLE_INTERVAL = 0.01
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of all threads of the current process (e.g. OCRmyPDF's page threads waiting for Tesseract)
+    and writes them in the "collapsed" format of flamegraph.pl, which can also be opened with speedscope.
+    Unlike cProfile, it sees all threads and adds almost no overhead to the profiled code.
+    """
+
+    def __init__(self, interval: float = _SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks: Counter[str] = Counter()
+        self._stopped = threading.Event()
+        self._sampler: threading.Thread | None = None
+
+    def __enter__(self):
+        self._sampler = threading.Thread(target=self._run, name="ocr-profiler", daemon=True)
+        self._sampler.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stopped.set()
+        self._sampler.join()
+        return False
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self._sample()
+
+    def _sample(self):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == threading.get_ident():
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            # Root first, the thread name is the root of every stack
+            stack.append(names.get(thread_id, str(thread_id)))
+            self.stacks[";".join(reversed(stack))] += 1
+
+    def write(self, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as file:
+            for stack, count in self.stacks.most_common():
+                file.write(f"{stack} {count}\n")
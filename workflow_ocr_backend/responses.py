@@ -0,0 +1,120 @@
+import base64
+import mmap
+import os
+from pathlib import Path
+import time
+from typing import Iterator
+import uuid
+
+from fastapi import Request
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
+
+from . import metrics, tracing
+from .model.ocrresult import OcrResult
+from .ocrservice import OcrOutput
+
+MULTIPART_MIXED = "multipart/mixed"
+NDJSON = "application/x-ndjson"
+CHUNK_SIZE = 1024 * 1024
+# Must be a multiple of 3, so that the base64 encoded chunks can simply be concatenated
+BASE64_CHUNK_SIZE = 3 * 256 * 1024
+
+
+def accepts_multipart(request: Request) -> bool:
+    """
+    Checks if the client opted in for a multipart/mixed response (instead of JSON) via the Accept header.
+    """
+    accept = request.headers.get("accept", "")
+    return any(media_range.split(";")[0].strip().lower() == MULTIPART_MIXED for media_range in accept.split(","))
+
+
+def multipart_response(output: OcrOutput, delete: bool = True) -> StreamingResponse:
+    """
+    Builds a multipart/mixed response with two parts: the recognized text (text/plain) and
+    the resulting PDF (application/pdf). The PDF is streamed from its file (which is deleted afterwards
+    if requested), so neither the file content nor a base64 representation of it is held in memory.
+    """
+    boundary = uuid.uuid4().hex
+    return StreamingResponse(
+        _delete_after(_multipart_body(output, boundary), output, delete),
+        media_type=f"{MULTIPART_MIXED}; boundary={boundary}",
+        background=BackgroundTask(_delete_file, output.file_path) if delete else None)
+
+
+def json_response(output: OcrOutput, delete: bool = True) -> StreamingResponse:
+    """
+    Builds the same JSON document as returned for an OcrResult, but base64 encodes the PDF
+    chunk by chunk (memory mapped) while it is streamed to the client.
+    """
+    return StreamingResponse(
+        _delete_after(_json_body(output), output, delete),
+        media_type="application/json",
+        background=BackgroundTask(_delete_file, output.file_path) if delete else None)
+
+
+def ndjson_result(output: OcrOutput) -> Iterator[bytes]:
+    """
+    Yields the final line of a streamed OCR response: {"type": "result", "result": <OcrResult>},
+    with the PDF base64 encoded chunk by chunk like in json_response.
+    """
+    yield b'{"type":"result","result":'
+    yield from _json_body(output)
+    yield b"}\n"
+
+
+def _delete_after(body: Iterator[bytes], output: OcrOutput, delete: bool) -> Iterator[bytes]:
+    # Sync generators: Starlette iterates them in a threadpool, so file reads don't block the event loop
+    started_at = time.monotonic()
+    started_at_ns = time.time_ns()
+    try:
+        yield from body
+        metrics.STAGE_SECONDS.observe(time.monotonic() - started_at, stage=metrics.STAGE_RESPONSE)
+        # Every chunk is produced in a copy of the request's context, so the span is recorded once it's finished
+        tracing.record(tracing.current(), "response", started_at_ns, time.time_ns())
+    finally:
+        if delete:
+            _delete_file(output.file_path)
+
+
+def _multipart_body(output: OcrOutput, boundary: str) -> Iterator[bytes]:
+    yield _part_header(boundary, "text/plain; charset=utf-8", 'inline; name="recognizedText"')
+    yield output.recognized_text.encode("utf-8")
+    yield _part_header(boundary, output.content_type, f'attachment; name="file"; filename="{_quote(output.filename)}"', first=False)
+    with open(output.file_path, "rb") as file:
+        while chunk := file.read(CHUNK_SIZE):
+            yield chunk
+    yield f"\r\n--{boundary}--\r\n".encode("ascii")
+
+
+def _json_body(output: OcrOutput) -> Iterator[bytes]:
+    metadata = OcrResult(filename=output.filename, content_type=output.content_type, recognized_text=output.recognized_text,
+                         detected_languages=output.detected_languages, file_content="")
+    document = metadata.model_dump_json(by_alias=True, exclude_none=True).encode("utf-8")
+    # Split the document right behind the opening quote of the (empty) file content
+    prefix, suffix = document.rsplit(b'""', 1)
+    yield prefix + b'"'
+    encoding_time = 0.0
+    with open(output.file_path, "rb") as file:
+        if os.fstat(file.fileno()).st_size > 0:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                for offset in range(0, len(mapped), BASE64_CHUNK_SIZE):
+                    started_at = time.monotonic()
+                    chunk = base64.b64encode(mapped[offset:offset + BASE64_CHUNK_SIZE])
+                    encoding_time += time.monotonic() - started_at
+                    yield chunk
+    metrics.STAGE_SECONDS.observe(encoding_time, stage=metrics.STAGE_SERIALIZATION)
+    yield b'"' + suffix
+
+
+def _part_header(boundary: str, content_type: str, content_disposition: str, first: bool = True) -> bytes:
+    delimiter = f"--{boundary}" if first else f"\r\n--{boundary}"
+    return f"{delimiter}\r\nContent-Type: {content_type}\r\nContent-Disposition: {content_disposition}\r\n\r\n".encode("utf-8")
+
+
+def _quote(file_name: str) -> str:
+    return file_name.replace("\\", "\\\\").replace('"', '\\"')
+
+
+def _delete_file(path: str):
+    Path(path).unlink(missing_ok=True)
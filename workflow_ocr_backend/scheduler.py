@@ -0,0 +1,322 @@
+import asyncio
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from logging import Logger
+import multiprocessing
+from multiprocessing.queues import Queue
+import threading
+import time
+from typing import Awaitable, Callable, TypeVar
+import uuid
+
+from . import metrics, tracing, worker
+from .admission import MemoryBudget
+from .cancellation import CancelledTasks
+from .exceptions import QueueFullError, WorkerCrashedError
+from .fairshare import FairSlots, TaskOwner
+from .model.priority import Priority
+from .ocrplugin import ProgressEvent, StageTiming
+from .settings import Settings
+
+T = TypeVar("T")
+EventCallback = Callable[[ProgressEvent], None]
+
+# Max. time to wait for outstanding progress events after a task finished
+_EVENT_DRAIN_TIMEOUT = 5
+# Max. time a cancelled task keeps its worker slot while the worker tears the OCR run down
+_CANCEL_TIMEOUT = 30
+
+
+def _crashed(running: Future) -> bool:
+    return running.done() and not running.cancelled() and isinstance(running.exception(), BrokenProcessPool)
+
+
+class _Subscription:
+    def __init__(self, callback: EventCallback | None, span: tracing.Span | None):
+        self.callback = callback
+        # Span of the task, receives the timings reported by the worker
+        self.span = span
+        self.drained = asyncio.Event()
+
+
+class _Worker:
+    """
+    A worker process. Every worker has a pool of its own, so that it can be replaced without affecting the other workers.
+    """
+
+    def __init__(self, executor: ProcessPoolExecutor):
+        self.executor = executor
+        # Known once the process started (see OcrScheduler._start_worker)
+        self.pid: int | None = None
+        self.tasks = 0
+
+
+class OcrScheduler:
+    """
+    Runs OCR work in a pool of worker processes, so that the event loop stays responsive.
+    At most `ocr_workers` tasks are running at the same time, further `ocr_queue_size` tasks
+    may wait for a free worker. Everything beyond that is rejected with a QueueFullError.
+
+    Functions executed by the scheduler receive a unique task id as first argument. Progress
+    events reported by the worker for this task id (see worker.task_events) are passed to the
+    `on_event` callback on the event loop thread. All events are delivered before the result.
+
+    All workers are started (and preloaded, see worker.init_worker) right away, so that the first
+    request doesn't pay for it. A worker is replaced after `ocr_worker_max_tasks` tasks or once it
+    exceeds `ocr_worker_max_memory`. Its replacement is started after it exited, the other workers keep running.
+    A worker which terminated abruptly (e.g. killed by the OOM killer) is replaced as well, only its task fails.
+
+    Free workers are assigned by priority class and fair share across users (see FairSlots).
+    Before a task waits for a worker, its estimated memory is reserved from `ocr_memory_budget` (see MemoryBudget).
+
+    Cancelling the awaitable returned by `submit` also cancels a task which is already running:
+    the worker aborts the OCR run and kills its child processes (see worker.cancellable).
+
+    Tasks of traced requests are recorded as spans, together with the timings reported by the worker (see tracing.py).
+    """
+
+    def __init__(self, settings: Settings, logger: Logger):
+        self.settings = settings
+        self.logger = logger
+        # Use "spawn" so that workers don't inherit the event loop and threads of the web server
+        self._context = multiprocessing.get_context("spawn")
+        self._workers: list[_Worker] = []
+        self._idle: asyncio.Queue[_Worker] | None = None
+        self._replacements: set[asyncio.Task] = set()
+        self._slots: FairSlots | None = None
+        self._memory = MemoryBudget(settings.ocr_memory_budget)
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._events: Queue | None = None
+        self._cancelled: CancelledTasks | None = None
+        self._event_listener: threading.Thread | None = None
+        self._subscribers: dict[str, _Subscription] = {}
+        self._pending = 0
+        self._running = 0
+
+    @property
+    def jobs_per_task(self) -> int:
+        return self.settings.jobs_per_worker
+
+    @property
+    def in_flight(self) -> int:
+        return self._running
+
+    @property
+    def queue_depth(self) -> int:
+        return self._pending - self._running
+
+    def running(self, priority: Priority) -> int:
+        return self._slots.running(priority) if self._slots is not None else 0
+
+    def waiting(self, priority: Priority) -> int:
+        return self._slots.waiting(priority) if self._slots is not None else 0
+
+    @property
+    def reserved_memory(self) -> int:
+        return self._memory.reserved
+
+    @property
+    def worker_pids(self) -> list[int]:
+        return [started.pid for started in self._workers if started.pid is not None]
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._events = self._context.Queue()
+        self._cancelled = CancelledTasks(self._context)
+        self._event_listener = threading.Thread(target=self._listen_events, name="ocr-events", daemon=True)
+        self._event_listener.start()
+        self._idle = asyncio.Queue()
+        for _ in range(self.settings.ocr_workers):
+            self._idle.put_nowait(self._start_worker())
+        self._slots = FairSlots(self.settings.ocr_workers, self.settings.ocr_user_max_tasks, self.settings.ocr_reserved_interactive_workers)
+        self.logger.debug(f"Started OCR scheduler with {self.settings.ocr_workers} workers ({self.jobs_per_task} jobs each)")
+
+    def shutdown(self):
+        for replacement in self._replacements:
+            replacement.cancel()
+        self._idle = None
+        for stopped in self._workers:
+            stopped.executor.shutdown(wait=True, cancel_futures=True)
+        self._workers.clear()
+        if self._event_listener is not None:
+            self._events.put(None)
+            self._event_listener.join()
+            self._event_listener = None
+
+    def _start_worker(self) -> _Worker:
+        started = _Worker(ProcessPoolExecutor(
+            max_workers=1,
+            mp_context=self._context,
+            initializer=worker.init_worker,
+            initargs=(self.logger.getEffectiveLevel(), self._events, self._cancelled, self.settings.ocr_preload_languages.split("+"),
+                      self.settings.ocr_auto_language, self.settings.ocr_max_dpi)))
+        # The process is spawned on demand, so the ping spawns (and preloads) it right away. Tasks are counted by
+        # the scheduler (not by max_tasks_per_child), so the ping doesn't count towards ocr_worker_max_tasks
+        def set_pid(ping: Future):
+            if not ping.cancelled() and ping.exception() is None:
+                started.pid = ping.result()
+
+        started.executor.submit(worker.ping).add_done_callback(set_pid)
+        self._workers.append(started)
+        return started
+
+    def _release_worker(self, released: _Worker, busy: bool = False, crashed: bool = False):
+        """
+        Makes the worker available for the next task, or replaces it if it ran its max. number of tasks,
+        exceeds the memory limit, is still busy with a task that was cancelled or terminated abruptly.
+        """
+        released.tasks += 1
+        max_tasks = self.settings.ocr_worker_max_tasks
+        max_memory = self.settings.ocr_worker_max_memory
+        if crashed:
+            reason = "terminated abruptly"
+        elif busy:
+            reason = "is still running a cancelled task"
+        elif max_tasks > 0 and released.tasks >= max_tasks:
+            reason = f"ran {released.tasks} tasks"
+        elif max_memory > 0 and released.pid is not None and (metrics.resident_memory(released.pid) or 0) > max_memory:
+            reason = f"exceeded {max_memory} bytes of memory"
+            metrics.WORKER_RECYCLES.inc()
+        else:
+            self._idle.put_nowait(released)
+            return
+        self.logger.info(f"OCR worker {released.pid} {reason}, replacing it")
+        replacement = asyncio.ensure_future(self._replace_worker(released))
+        self._replacements.add(replacement)
+        replacement.add_done_callback(self._replacements.discard)
+
+    async def _replace_worker(self, retired: _Worker):
+        self._workers.remove(retired)
+        # The replacement is only started after the retired worker exited, so there are never more than ocr_workers processes
+        await asyncio.to_thread(retired.executor.shutdown, wait=True)
+        if self._idle is not None:
+            self._idle.put_nowait(self._start_worker())
+
+    def check_admission(self):
+        """
+        Raises QueueFullError if there is no capacity left for another task.
+        """
+        if self._pending >= self.settings.ocr_workers + self.settings.ocr_queue_size:
+            raise QueueFullError(self.settings.ocr_retry_after)
+
+    def submit(self, fn: Callable[..., T], *args, on_event: EventCallback | None = None, admit: bool = True, owner: TaskOwner = TaskOwner(),
+               memory: int = 0) -> Awaitable[T]:
+        """
+        Schedules fn(task_id, *args) for execution in a worker process on behalf of the given owner.
+        The task needs an estimated `memory` bytes (see AdmissionControl).
+        Admission is checked immediately: raises QueueFullError if there is no capacity left.
+        Use admit=False for follow-up tasks of an already admitted request, which must not be rejected.
+        """
+        if self._idle is None:
+            raise RuntimeError("OCR scheduler is not running")
+        if admit:
+            self.check_admission()
+
+        self._pending += 1
+        return asyncio.ensure_future(self._execute(fn, args, on_event, owner, memory))
+
+    async def run(self, fn: Callable[..., T], *args, on_event: EventCallback | None = None, owner: TaskOwner = TaskOwner(), memory: int = 0) -> T:
+        return await self.submit(fn, *args, on_event=on_event, owner=owner, memory=memory)
+
+    async def _execute(self, fn: Callable[..., T], args: tuple, on_event: EventCallback | None, owner: TaskOwner, memory: int) -> T:
+        task_id = uuid.uuid4().hex
+        subscription = _Subscription(on_event, None) if on_event is not None or tracing.current() is not None else None
+        if subscription is not None:
+            self._subscribers[task_id] = subscription
+        queued_at = time.monotonic()
+        queued_at_ns = time.time_ns()
+        try:
+            # Memory first, so that a task waiting for memory doesn't keep a worker idle which other tasks could use
+            await self._memory.acquire(memory)
+            try:
+                await self._slots.acquire(owner)
+                try:
+                    metrics.STAGE_SECONDS.observe(time.monotonic() - queued_at, stage=metrics.STAGE_QUEUE)
+                    tracing.record(tracing.current(), "queue", queued_at_ns, time.time_ns(), priority=owner.priority.value)
+                    self._running += 1
+                    assigned = running = None
+                    try:
+                        with tracing.span(fn.__name__, task_id=task_id) as span:
+                            if span is not None:
+                                subscription.span = span
+                                instrumentation = worker.Instrumentation(timings=True, profile_path=tracing.profile_path(task_id))
+                                assigned, running = await self._submit(worker.instrumented, task_id, instrumentation, fn, *args)
+                            else:
+                                assigned, running = await self._submit(fn, task_id, *args)
+                            future = asyncio.wrap_future(running)
+                            try:
+                                return await future
+                            except BrokenProcessPool as exc:
+                                raise WorkerCrashedError() from exc
+                            except asyncio.CancelledError:
+                                if not running.done():
+                                    await self._cancel_running(task_id, running)
+                                raise
+                            finally:
+                                # A worker which terminated abruptly doesn't report the end of the events of its task
+                                if subscription is not None and future.done() and not future.cancelled() and not _crashed(running):
+                                    await self._drain(task_id, subscription)
+                    finally:
+                        self._running -= 1
+                        if assigned is not None and self._idle is not None:
+                            self._release_worker(assigned, busy=not running.done(), crashed=_crashed(running))
+                finally:
+                    self._slots.release(owner)
+            finally:
+                self._memory.release(memory)
+        finally:
+            self._pending -= 1
+            self._subscribers.pop(task_id, None)
+
+    async def _submit(self, fn: Callable[..., T], *args) -> tuple[_Worker, Future]:
+        """
+        Submits fn(*args) to an idle worker. A slot guarantees that there is one (or one is about to be replaced).
+        Workers which terminated while they were idle are replaced and skipped.
+        """
+        while True:
+            assigned = await self._idle.get()
+            try:
+                return assigned, assigned.executor.submit(fn, *args)
+            except BrokenProcessPool:
+                self._release_worker(assigned, crashed=True)
+
+    async def _cancel_running(self, task_id: str, running: Future):
+        """
+        Tells the worker to abort the given task and waits (keeping the worker slot) until it did.
+        """
+        self._cancelled.add(task_id)
+        self.logger.debug(f"Cancelling running task {task_id}")
+        finished = asyncio.wrap_future(running)
+        await asyncio.wait([finished], timeout=_CANCEL_TIMEOUT)
+        if not finished.done():
+            self.logger.warning(f"Task {task_id} is still running {_CANCEL_TIMEOUT} seconds after it was cancelled")
+        elif not finished.cancelled():
+            # The result (usually a TaskCancelledError) is discarded
+            finished.exception()
+
+    async def _drain(self, task_id: str, subscription: _Subscription):
+        try:
+            await asyncio.wait_for(subscription.drained.wait(), _EVENT_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.logger.warning(f"Missing progress events of task {task_id}")
+
+    def _listen_events(self):
+        while (item := self._events.get()) is not None:
+            self._loop.call_soon_threadsafe(self._dispatch_event, *item)
+
+    def _dispatch_event(self, task_id: str, event: ProgressEvent | StageTiming | None):
+        subscription = self._subscribers.get(task_id)
+        if subscription is None:
+            return
+        if event is None:
+            subscription.drained.set()
+            return
+        if isinstance(event, StageTiming):
+            tracing.record(subscription.span, event.stage, event.start, event.end, **event.attributes)
+            return
+        if subscription.callback is None:
+            return
+        try:
+            subscription.callback(event)
+        except Exception:
+            self.logger.exception(f"Failed to dispatch progress event of task {task_id}")
@@ -0,0 +1,66 @@
+import math
+import os
+import tempfile
+
+from pydantic import BaseModel, Field
+
+
+def _default_workers() -> int:
+    # OCRmyPDF recommends roughly sqrt(cpu_count) processes with sqrt(cpu_count) jobs each
+    return max(1, round(math.sqrt(os.cpu_count() or 1)))
+
+
+class Settings(BaseModel):
+    """
+    Runtime configuration of the backend. Every field can be overridden by an
+    environment variable with the same name in upper case (e.g. OCR_WORKERS=4).
+    """
+    ocr_workers: int = Field(default_factory=_default_workers, ge=1, description='Number of OCR worker processes')
+    ocr_jobs_per_worker: int = Field(default=0, ge=0, description='Value for the OCRmyPDF "--jobs" parameter of a single OCR run. 0 means "CPU count / workers"')
+    ocr_worker_max_tasks: int = Field(default=0, ge=0, description='Worker processes are replaced after this number of tasks (to contain leaks). 0 means never')
+    ocr_worker_max_memory: int = Field(default=0, ge=0, description='Worker processes are replaced once they exceed this resident memory in bytes (after their current task). 0 means no limit')
+    ocr_preload_languages: str = Field(default="eng", description='Languages (separated by "+") whose traineddata is read by every worker at startup')
+    ocr_auto_language: bool = Field(default=False, description='Narrow the requested languages down to the ones detected on a few sample pages before running Tesseract on the whole document')
+    ocr_max_dpi: int = Field(default=0, ge=0, description='Pages with a higher resolution are downsampled to this resolution before OCR, unless a request sets "--max-ocr-dpi" itself. 0 disables downsampling')
+    ocr_user_max_tasks: int = Field(default=0, ge=0, description='Max. number of OCR tasks of a single user running at the same time. 0 means no limit')
+    ocr_reserved_interactive_workers: int = Field(default=0, ge=0, description='Number of workers which are never used by bulk requests, so that interactive requests always find a free worker')
+    ocr_memory_budget: int = Field(default=0, ge=0, description='Max. sum of the estimated memory (bytes) of all running OCR tasks. Documents which exceed it on their own are rejected. 0 means no limit')
+    ocr_max_megapixels: int = Field(default=0, ge=0, description='Documents with more megapixels to recognize (summed up over all pages) are rejected. 0 means no limit')
+    ocr_queue_size: int = Field(default=32, ge=0, description='Number of OCR requests which may wait for a free worker before new requests are rejected')
+    ocr_job_ttl: int = Field(default=3600, ge=0, description='Number of seconds the result of a job submitted via /jobs is kept after the job finished')
+    ocr_job_queue_dir: str = Field(default="", description='Directory on a volume shared by all replicas for the durable job queue (database, inputs and results of jobs submitted via /jobs). Jobs are only kept in memory if empty')
+    ocr_job_lease: int = Field(default=60, ge=3, description='Seconds a replica holds a job of the durable job queue without renewing its lease, before the job is queued again for other replicas')
+    ocr_default_deadline: float = Field(default=0, ge=0, description='Seconds after which an OCR request is cancelled if it has no "deadline" of its own. 0 means no deadline')
+    ocr_retry_after: int = Field(default=10, ge=0, description='Value (seconds) of the "Retry-After" header sent when the OCR queue is full')
+    ocr_batch_max_files: int = Field(default=100, ge=1, description='Max. number of files accepted by a single batch request')
+    ocr_split_pages: int = Field(default=0, ge=0, description='PDFs with more pages are split into chunks of this number of pages, which are processed in parallel. 0 disables splitting')
+    ocr_split_min_pages: int = Field(default=0, ge=0, description='Only PDFs with more than this number of pages are split (in addition to "ocr_split_pages")')
+    ocr_parameter_profiles: str = Field(default="", description='Named OCRmyPDF parameter sets requests can select via "parameter_profile", as JSON object (e.g. {"fast-text": "--language eng --skip-text"}). Validated at startup')
+
+    ocr_scratch_dir: str = Field(default="", description='Directory (e.g. tmpfs or SSD) for spooled uploads and OCR outputs. Defaults to the system temp directory')
+    ocr_spool_threshold: int = Field(default=16 * 1024 * 1024, ge=0, description='Uploads larger than this number of bytes are spooled to the scratch directory instead of being held in memory')
+    ocr_cache_dir: str = Field(default="", description='Directory of the OCR result cache. The cache is disabled if empty')
+    ocr_cache_max_bytes: int = Field(default=1024 * 1024 * 1024, ge=0, description='Max. size of the OCR result cache in bytes')
+    ocr_trace_file: str = Field(default="", description='File the spans of all requests are appended to (OTLP/JSON, one export request per line). Tracing is disabled if neither this nor "ocr_trace_endpoint" is set')
+    ocr_trace_endpoint: str = Field(default="", description='OTLP/HTTP endpoint (e.g. http://collector:4318/v1/traces) the spans of all requests are exported to in JSON encoding')
+    ocr_profile_dir: str = Field(default="", description='Directory for profiles of single requests (see "ocr_profile_users"). Profiling is disabled if empty')
+    ocr_profile_users: str = Field(default="", description='Nextcloud users (separated by ",") who may request a profile via the "X-OCR-Profile: true" header')
+    ocr_compression_level: int = Field(default=6, ge=0, le=9, description='Level (1 = fastest, 9 = smallest) of the gzip/zstd compression of responses negotiated via Accept-Encoding. 0 disables compression of responses')
+    ocr_compression_min_size: int = Field(default=1024, ge=0, description='Responses smaller than this number of bytes are not compressed')
+    ocr_max_decompressed_size: int = Field(default=1024 * 1024 * 1024, ge=0, description='Max. size (bytes) of a compressed request body after decompression. 0 means no limit')
+    ocr_metrics_public: bool = Field(default=False, description='Serve /metrics without AppAPI authentication (e.g. for a Prometheus scraper inside the container network)')
+
+    @property
+    def scratch_dir(self) -> str:
+        return self.ocr_scratch_dir or tempfile.gettempdir()
+
+    @property
+    def jobs_per_worker(self) -> int:
+        if self.ocr_jobs_per_worker > 0:
+            return self.ocr_jobs_per_worker
+        return max(1, (os.cpu_count() or 1) // self.ocr_workers)
+
+    @classmethod
+    def from_env(cls) -> "Settings":
+        values = {name: os.environ[name.upper()] for name in cls.model_fields if name.upper() in os.environ}
+        return cls(**values)
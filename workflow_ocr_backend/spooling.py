@@ -0,0 +1,44 @@
+from pathlib import Path
+import shutil
+import tempfile
+
+from fastapi import UploadFile
+from starlette.concurrency import run_in_threadpool
+
+from .settings import Settings
+
+CHUNK_SIZE = 1024 * 1024
+
+# Source of an OCR run: either the content of a (small) upload or the path of a spooled file
+Source = bytes | str
+
+
+async def spool_upload(file: UploadFile, settings: Settings) -> Source:
+    """
+    Returns the content of uploads up to `ocr_spool_threshold` bytes. Larger uploads are copied
+    (chunk by chunk) into a file in the scratch directory, whose path is returned instead.
+    """
+    if file.size is not None and file.size <= settings.ocr_spool_threshold:
+        return await file.read()
+    return await run_in_threadpool(_copy_to_scratch, file, settings.scratch_dir)
+
+
+def is_spooled(source: Source) -> bool:
+    return isinstance(source, str)
+
+
+def discard(source: Source):
+    if is_spooled(source):
+        Path(source).unlink(missing_ok=True)
+
+
+def _copy_to_scratch(file: UploadFile, scratch_dir: str) -> str:
+    file.file.seek(0)
+    with tempfile.NamedTemporaryFile(prefix="ocr-input-", dir=scratch_dir, delete=False) as spooled:
+        try:
+            shutil.copyfileobj(file.file, spooled, CHUNK_SIZE)
+        except BaseException:
+            spooled.close()
+            Path(spooled.name).unlink(missing_ok=True)
+            raise
+        return spooled.name
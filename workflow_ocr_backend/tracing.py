@@ -0,0 +1,297 @@
+"""
+Opt-in tracing of requests (see OCR_TRACE_FILE and OCR_TRACE_ENDPOINT): every request is recorded as a trace of spans
+around its stages, including the steps reported by the worker processes (see ocrplugin.StageTiming). Traces are exported
+in the OTLP/JSON format, so they can be read by any OpenTelemetry collector. A W3C "traceparent" header of the caller is continued.
+Like metrics.py, the module is used without passing a tracer around: new spans are children of the current span (a context variable).
+
+Users listed in OCR_PROFILE_USERS can additionally request a profile of the OCR tasks of a single request (see SamplingProfiler).
+"""
+from contextlib import contextmanager
+import contextvars
+import json
+from logging import Logger
+import os
+import queue
+import re
+import secrets
+import threading
+import time
+from typing import Iterator
+import urllib.request
+
+from .settings import Settings
+
+TRACE_ID_HEADER = "X-OCR-Trace-Id"
+PROFILE_HEADER = "X-OCR-Profile"
+
+_SERVICE_NAME = "workflow_ocr_backend"
+# Enum values of the OTLP protocol
+_SPAN_KIND_INTERNAL = 1
+_SPAN_KIND_SERVER = 2
+_STATUS_ERROR = 2
+_TRACEPARENT = re.compile(r"[0-9a-f]{2}-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}")
+# Polled periodically by AppAPI and Prometheus, their traces would only be noise
+_UNTRACED_PATHS = {"/heartbeat", "/metrics"}
+_EXPORT_TIMEOUT = 10
+
+Attribute = str | bool | int | float
+
+
+class Trace:
+    """
+    Spans of a single request. They are exported together once the request span ended,
+    spans which end afterwards (e.g. of asynchronous jobs) are exported on their own.
+    """
+
+    def __init__(self, trace_id: str, profile: bool = False):
+        self.trace_id = trace_id
+        self.profile = profile
+        self.root: Span | None = None
+        self._spans: list[Span] = []
+        self._finished = False
+        self._lock = threading.Lock()
+
+    def add(self, span: "Span"):
+        with self._lock:
+            if self._finished:
+                spans = [span]
+            else:
+                self._spans.append(span)
+                if span is not self.root:
+                    return
+                spans, self._spans, self._finished = self._spans, [], True
+        if _exporter is not None:
+            _exporter.export(spans)
+
+
+class Span:
+    def __init__(self, trace: Trace, name: str, parent_id: str | None, kind: int = _SPAN_KIND_INTERNAL, start: int | None = None,
+                 attributes: dict[str, Attribute] | None = None):
+        self.trace = trace
+        self.name = name
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.kind = kind
+        self.start = start if start is not None else time.time_ns()
+        self.end_time: int | None = None
+        self.attributes = dict(attributes or {})
+        self.error: str | None = None
+
+    def set(self, **attributes: Attribute):
+        self.attributes.update(attributes)
+
+    def fail(self, exc: BaseException):
+        self.error = f"{exc.__class__.__name__}: {exc}"
+
+    def end(self, end: int | None = None):
+        self.end_time = end if end is not None else time.time_ns()
+        self.trace.add(self)
+
+    def to_otlp(self) -> dict:
+        span = {
+            "traceId": self.trace.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start),
+            "endTimeUnixNano": str(self.end_time),
+            "attributes": [_attribute(key, value) for key, value in self.attributes.items()],
+        }
+        if self.parent_id is not None:
+            span["parentSpanId"] = self.parent_id
+        if self.error is not None:
+            span["status"] = {"code": _STATUS_ERROR, "message": self.error}
+        return span
+
+
+def _attribute(key: str, value: Attribute) -> dict:
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        # 64 bit integers are strings in OTLP/JSON
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+def otlp_payload(spans: list[Span]) -> dict:
+    """
+    Returns an OTLP ExportTraceServiceRequest (JSON encoding) with the given spans.
+    """
+    return {"resourceSpans": [{
+        "resource": {"attributes": [_attribute("service.name", _SERVICE_NAME)]},
+        "scopeSpans": [{"scope": {"name": __name__}, "spans": [span.to_otlp() for span in spans]}],
+    }]}
+
+
+class _Exporter:
+    """
+    Appends finished spans to a file (one OTLP/JSON request per line, as read by the "otlpjsonfile" receiver
+    of the OpenTelemetry collector) and/or posts them to an OTLP/HTTP endpoint, in a background thread.
+    """
+
+    def __init__(self, file: str, endpoint: str, logger: Logger):
+        self.file = file
+        self.endpoint = endpoint
+        self.logger = logger
+        self._queue: queue.SimpleQueue[list[Span] | None] = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, name="ocr-trace-export", daemon=True)
+        self._thread.start()
+
+    def export(self, spans: list[Span]):
+        self._queue.put(spans)
+
+    def shutdown(self):
+        self._queue.put(None)
+        self._thread.join(_EXPORT_TIMEOUT)
+
+    def _run(self):
+        while (spans := self._queue.get()) is not None:
+            payload = json.dumps(otlp_payload(spans), separators=(",", ":"))
+            if self.file:
+                try:
+                    with open(self.file, "a", encoding="utf-8") as file:
+                        file.write(payload + "\n")
+                except OSError as exc:
+                    self.logger.warning(f"Failed to write trace to {self.file}: {exc}")
+            if self.endpoint:
+                request = urllib.request.Request(self.endpoint, data=payload.encode("utf-8"), headers={"Content-Type": "application/json"})
+                try:
+                    with urllib.request.urlopen(request, timeout=_EXPORT_TIMEOUT):
+                        pass
+                except OSError as exc:
+                    self.logger.warning(f"Failed to export trace to {self.endpoint}: {exc}")
+
+
+_exporter: _Exporter | None = None
+_profile_dir = ""
+_profile_users: frozenset[str] = frozenset()
+_current: contextvars.ContextVar[Span | None] = contextvars.ContextVar("ocr_span", default=None)
+
+
+def configure(settings: Settings, logger: Logger):
+    global _exporter, _profile_dir, _profile_users
+    shutdown()
+    if settings.ocr_trace_file or settings.ocr_trace_endpoint:
+        _exporter = _Exporter(settings.ocr_trace_file, settings.ocr_trace_endpoint, logger)
+    _profile_dir = settings.ocr_profile_dir
+    _profile_users = frozenset(user.strip() for user in settings.ocr_profile_users.split(",") if user.strip())
+
+
+def shutdown():
+    """
+    Exports the remaining spans.
+    """
+    global _exporter
+    if _exporter is not None:
+        _exporter.shutdown()
+        _exporter = None
+
+
+def current() -> Span | None:
+    """
+    Returns the current span or None if the current request is not traced.
+    """
+    return _current.get()
+
+
+@contextmanager
+def span(name: str, **attributes: Attribute) -> Iterator[Span | None]:
+    """
+    Records the enclosed code as child of the current span (nothing is recorded if the current request is not traced).
+    """
+    parent = _current.get()
+    if parent is None:
+        yield None
+        return
+    child = Span(parent.trace, name, parent.span_id, attributes=attributes)
+    token = _current.set(child)
+    try:
+        yield child
+    except BaseException as exc:
+        child.fail(exc)
+        raise
+    finally:
+        _current.reset(token)
+        child.end()
+
+
+def record(parent: Span | None, name: str, start: int, end: int, **attributes: Attribute):
+    """
+    Adds an already finished span (e.g. measured by a worker process) as child of parent.
+    """
+    if parent is not None:
+        Span(parent.trace, name, parent.span_id, start=start, attributes=attributes).end(end)
+
+
+def profile_path(task_id: str) -> str | None:
+    """
+    Returns the path the profile of the given task is written to, or None if the current request is not profiled.
+    """
+    current_span = _current.get()
+    if current_span is None or not current_span.trace.profile:
+        return None
+    return os.path.join(_profile_dir, current_span.trace.trace_id, f"{task_id}.folded")
+
+
+class TraceMiddleware:
+    """
+    Traces all HTTP requests if an exporter is configured and profiles requests of OCR_PROFILE_USERS with
+    the header "X-OCR-Profile: true". The trace id is returned in the X-OCR-Trace-Id header.
+    Has to run inside of AppAPIAuthMiddleware (i.e. has to be added before it), which authenticates the user.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in _UNTRACED_PATHS:
+            await self.app(scope, receive, send)
+            return
+        headers = {name.decode("latin-1").lower(): value.decode("latin-1") for name, value in scope["headers"]}
+        user = scope.get("username", "")
+        profile = bool(_profile_dir) and headers.get(PROFILE_HEADER.lower(), "").lower() == "true" and user in _profile_users
+        if _exporter is None and not profile:
+            await self.app(scope, receive, send)
+            return
+
+        parent = _TRACEPARENT.fullmatch(headers.get("traceparent", "").strip())
+        trace = Trace(parent[1] if parent else secrets.token_hex(16), profile)
+        root = trace.root = Span(trace, f"{scope['method']} {scope['path']}", parent[2] if parent else None, kind=_SPAN_KIND_SERVER,
+                                 attributes={"http.request.method": scope["method"], "url.path": scope["path"]})
+        if user:
+            root.set(**{"enduser.id": user})
+        body_received = False
+
+        async def traced_receive():
+            nonlocal body_received
+            message = await receive()
+            if message["type"] == "http.request" and not message.get("more_body", False) and not body_received:
+                # The request body (e.g. the multipart upload) is parsed while it's received
+                body_received = True
+                record(root, "receive body", root.start, time.time_ns())
+            return message
+
+        async def traced_send(message):
+            if message["type"] == "http.response.start":
+                root.set(**{"http.response.status_code": message["status"]})
+                if message["status"] >= 500:
+                    root.error = f"HTTP {message['status']}"
+                message = {**message, "headers": [*message.get("headers", []), (TRACE_ID_HEADER.lower().encode("latin-1"), trace.trace_id.encode("latin-1"))]}
+            await send(message)
+
+        token = _current.set(root)
+        try:
+            await self.app(scope, traced_receive, traced_send)
+        except BaseException as exc:
+            root.fail(exc)
+            raise
+        finally:
+            _current.reset(token)
+            # Use the route template (e.g. /jobs/{job_id}) like OpenTelemetry's instrumentations
+            route = scope.get("route")
+            if route is not None:
+                root.name = f"{scope['method']} {route.path}"
+                root.set(**{"http.route": route.path})
+            root.end()
@@ -0,0 +1,205 @@
+"""
+Functions executed inside of the OCR worker processes (see OcrScheduler).
+Everything passed into or returned from here has to be picklable.
+"""
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass
+import io
+import itertools
+import logging
+import os
+import tempfile
+import threading
+from multiprocessing.queues import Queue
+from typing import BinaryIO, Callable, Iterator, TypeVar
+
+from . import ocrplugin
+from .cancellation import CancelledTasks, kill_descendants
+from .exceptions import TaskCancelledError
+from .model.ocrresult import OcrResult
+from .ocrplugin import ProgressEvent
+from .ocrservice import OcrOutput, OcrService, shift_skipped_pages
+from .profiling import SamplingProfiler
+from .spooling import Source, is_spooled
+
+T = TypeVar("T")
+
+logger = logging.getLogger('uvicorn.error')
+
+# Interval (seconds) in which a running task checks whether it was cancelled
+_CANCEL_POLL_INTERVAL = 0.2
+
+_events: Queue | None = None
+_cancelled: CancelledTasks | None = None
+_auto_language = False
+_max_dpi = 0
+
+
+def init_worker(log_level: int, events: Queue, cancelled: CancelledTasks, preload_languages: list[str], auto_language: bool,
+                max_dpi: int):
+    global _events, _cancelled, _auto_language, _max_dpi
+    logging.basicConfig(level=log_level)
+    logger.setLevel(log_level)
+    _events = events
+    _cancelled = cancelled
+    _auto_language = auto_language
+    _max_dpi = max_dpi
+    try:
+        OcrService(logger).preload(preload_languages)
+    except Exception as exc:
+        # The worker is still usable, only the first OCR run will be slower
+        logger.warning(f"Failed to preload OCR worker: {exc}")
+
+
+def ping() -> int:
+    """
+    Starts the worker process (see OcrScheduler._start_worker) and returns its pid.
+    """
+    return os.getpid()
+
+
+@dataclass(frozen=True)
+class Instrumentation:
+    """
+    Instrumentation of a single task requested by the scheduler for traced requests (see tracing.py).
+    """
+    # Report the durations of the steps of the task (see ocrplugin.StageTiming)
+    timings: bool = False
+    # Write a profile of the task to this file (see SamplingProfiler)
+    profile_path: str | None = None
+
+
+def instrumented(task_id: str, instrumentation: Instrumentation, fn: Callable[..., T], *args) -> T:
+    """
+    Runs fn(task_id, *args) with the given instrumentation.
+    """
+    ocrplugin.set_timings(instrumentation.timings)
+    profiler = SamplingProfiler() if instrumentation.profile_path is not None else None
+    try:
+        with profiler or nullcontext():
+            return fn(task_id, *args)
+    finally:
+        ocrplugin.set_timings(False)
+        if profiler is not None:
+            try:
+                profiler.write(instrumentation.profile_path)
+            except OSError as exc:
+                logger.warning(f"Failed to write profile of task {task_id}: {exc}")
+        # Like in task_events, the scheduler waits for this before the result is returned (also for tasks without progress events)
+        _events.put((task_id, None))
+
+
+@contextmanager
+def task_events(task_id: str):
+    """
+    Forwards all progress events reported while running the given task to the scheduler.
+    A worker process only runs one task at a time, so the reporter can be replaced per task.
+    """
+    ocrplugin.set_reporter(lambda event: _events.put((task_id, event)))
+    try:
+        ocrplugin.report(ProgressEvent("Started"))
+        with ocrplugin.timed(ocrplugin.TASK_STAGE, usage=True):
+            yield
+    finally:
+        ocrplugin.set_reporter(None)
+        # Tells the scheduler that no more events will follow for this task
+        _events.put((task_id, None))
+
+
+@contextmanager
+def cancellable(task_id: str):
+    """
+    Tears the OCR run down once the scheduler cancelled the given task: OCRmyPDF is aborted at its next
+    progress report (see ocrplugin.cancel) and all child processes (Tesseract, Ghostscript) are killed
+    until the task returns. Raises a TaskCancelledError in this case.
+    """
+    finished = threading.Event()
+    cancelled = threading.Event()
+
+    def watch():
+        while not finished.wait(_CANCEL_POLL_INTERVAL):
+            if not cancelled.is_set():
+                if task_id not in _cancelled:
+                    continue
+                logger.info(f"Task {task_id} was cancelled, aborting OCR")
+                cancelled.set()
+                ocrplugin.cancel()
+            # OCRmyPDF might start further processes until it noticed the cancellation
+            kill_descendants(os.getpid())
+
+    watcher = threading.Thread(target=watch, name="ocr-cancel", daemon=True)
+    watcher.start()
+    try:
+        yield
+    except Exception as exc:
+        if cancelled.is_set() and not isinstance(exc, TaskCancelledError):
+            raise TaskCancelledError(f"Task {task_id} was cancelled") from exc
+        raise
+    finally:
+        finished.set()
+        watcher.join()
+
+
+def process(task_id: str, source: Source, file_name: str, ocrmypdf_parameters: str | None, jobs: int) -> OcrResult:
+    with task_events(task_id), cancellable(task_id), _open_source(source) as file:
+        service = OcrService(logger)
+        return service.ocr(file, file_name, ocrmypdf_parameters, jobs=jobs, auto_language=_auto_language, max_dpi=_max_dpi)
+
+
+def process_text(task_id: str, source: Source, file_name: str, ocrmypdf_parameters: str | None, jobs: int) -> list[str]:
+    with task_events(task_id), cancellable(task_id), _open_source(source) as file:
+        service = OcrService(logger)
+        return service.ocr_text(file, file_name, ocrmypdf_parameters, jobs=jobs, auto_language=_auto_language, max_dpi=_max_dpi)
+
+
+def process_to_file(task_id: str, source: Source, file_name: str, ocrmypdf_parameters: str | None, jobs: int, output_dir: str | None) -> OcrOutput:
+    """
+    Writes the resulting PDF to a new temporary file in output_dir. The caller is responsible for deleting it.
+    """
+    fd, output_path = tempfile.mkstemp(suffix=".pdf", prefix="ocr-output-", dir=output_dir)
+    os.close(fd)
+    try:
+        with task_events(task_id), cancellable(task_id), _open_source(source) as file:
+            service = OcrService(logger)
+            return service.ocr_to_file(file, file_name, ocrmypdf_parameters, output_path, jobs=jobs, auto_language=_auto_language, max_dpi=_max_dpi)
+    except BaseException:
+        os.unlink(output_path)
+        raise
+
+
+def split(task_id: str, source: Source, pages_per_chunk: int, output_dir: str) -> list[str]:
+    with _open_source(source) as file:
+        return OcrService(logger).split_pages(file, pages_per_chunk, output_dir)
+
+
+def merge(task_id: str, chunks: list[OcrOutput], file_name: str, output_dir: str) -> OcrOutput:
+    """
+    Merges the OCR outputs of consecutive chunks of a document into a new temporary file in output_dir.
+    """
+    fd, output_path = tempfile.mkstemp(suffix=".pdf", prefix="ocr-output-", dir=output_dir)
+    os.close(fd)
+    try:
+        page_counts = OcrService(logger).merge_pdfs([chunk.file_path for chunk in chunks], output_path)
+    except BaseException:
+        os.unlink(output_path)
+        raise
+    # Like in the sidecar of OCRmyPDF, the texts of consecutive pages are separated by a form feed.
+    # Skipped pages are numbered within their chunk, but have to refer to the pages of the merged document
+    offsets = itertools.accumulate(page_counts[:-1], initial=0)
+    recognized_text = "\f".join(shift_skipped_pages(chunk.recognized_text, offset) for chunk, offset in zip(chunks, offsets))
+    # Every chunk detected its own languages
+    detected_languages = None
+    if any(chunk.detected_languages is not None for chunk in chunks):
+        detected_languages = list(dict.fromkeys(language for chunk in chunks for language in chunk.detected_languages or []))
+    return OcrOutput(filename=file_name, content_type=chunks[0].content_type, recognized_text=recognized_text, file_path=output_path,
+                     detected_languages=detected_languages)
+
+
+@contextmanager
+def _open_source(source: Source) -> Iterator[BinaryIO | str]:
+    # Spooled files are passed to OCRmyPDF by path, so they are never read into memory
+    if is_spooled(source):
+        yield source
+    else:
+        with io.BytesIO(source) as file:
+            yield file